@@ -0,0 +1,32 @@
+"""keyset pagination indexes
+
+Revision ID: 3d9e52b1a0f7
+Revises: 7cb39fac4f1c
+Create Date: 2026-10-18 11:03:27.194027
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3d9e52b1a0f7'
+down_revision = '7cb39fac4f1c'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('ix_user_created_at_id', 'user', ['created_at', 'id'])
+    op.create_index('ix_channel_created_at_id', 'channel', ['created_at', 'id'])
+    op.create_index('ix_device_created_at_id', 'device', ['created_at', 'id'])
+    op.create_index('ix_alert_created_at_id', 'alert', ['created_at', 'id'])
+    op.create_index('ix_alert_channel_id_created_at_id', 'alert', ['channel_id', 'created_at', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_alert_channel_id_created_at_id', 'alert')
+    op.drop_index('ix_alert_created_at_id', 'alert')
+    op.drop_index('ix_device_created_at_id', 'device')
+    op.drop_index('ix_channel_created_at_id', 'channel')
+    op.drop_index('ix_user_created_at_id', 'user')
@@ -0,0 +1,30 @@
+"""alert shards
+
+Revision ID: 5a2c7e9d4b18
+Revises: 3d9e52b1a0f7
+Create Date: 2026-10-18 14:12:08.531904
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5a2c7e9d4b18'
+down_revision = '3d9e52b1a0f7'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+def upgrade():
+    op.add_column('alert', sa.Column('shards_total', sa.Integer, nullable=False, server_default='1'))
+    op.add_column('alert', sa.Column('completed_shards', postgresql.ARRAY(sa.Integer), nullable=False,
+                                     server_default='{}'))
+    op.add_column('alert', sa.Column('completed_at', sa.DateTime, nullable=True))
+
+
+def downgrade():
+    op.drop_column('alert', 'completed_at')
+    op.drop_column('alert', 'completed_shards')
+    op.drop_column('alert', 'shards_total')
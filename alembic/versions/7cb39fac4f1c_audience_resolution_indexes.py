@@ -0,0 +1,30 @@
+"""audience resolution indexes
+
+Revision ID: 7cb39fac4f1c
+Revises: 59539ba41f8d
+Create Date: 2026-10-18 10:12:41.482913
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7cb39fac4f1c'
+down_revision = '59539ba41f8d'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('ix_subscriptions_channel_id_user_id', 'subscriptions', ['channel_id', 'user_id'])
+    op.create_index('ix_device_user_audience', 'device',
+                    ['user_id', 'platform', 'mute', 'mobile_app_id', 'mobile_app_ver', 'platform_id'])
+    op.create_index('ix_device_platform_audience', 'device',
+                    ['platform', 'mute', 'mobile_app_id', 'mobile_app_ver', 'platform_id'])
+
+
+def downgrade():
+    op.drop_index('ix_device_platform_audience', 'device')
+    op.drop_index('ix_device_user_audience', 'device')
+    op.drop_index('ix_subscriptions_channel_id_user_id', 'subscriptions')
@@ -0,0 +1,24 @@
+"""channel audience version
+
+Revision ID: 8e4f0b6a7c31
+Revises: 5a2c7e9d4b18
+Create Date: 2026-10-18 16:40:51.207315
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8e4f0b6a7c31'
+down_revision = '5a2c7e9d4b18'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('channel', sa.Column('audience_version', sa.Integer, nullable=False, server_default='0'))
+
+
+def downgrade():
+    op.drop_column('channel', 'audience_version')
@@ -0,0 +1,37 @@
+"""scheduled task
+
+Revision ID: b4d19c2f6e05
+Revises: 8e4f0b6a7c31
+Create Date: 2026-10-18 19:05:37.418226
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b4d19c2f6e05'
+down_revision = '8e4f0b6a7c31'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+def upgrade():
+    op.create_table('scheduled_task',
+                    sa.Column('id', sa.Integer, nullable=False),
+                    sa.Column('key', sa.String(length=255), nullable=True),
+                    sa.Column('priority', sa.String(length=10), nullable=False),
+                    sa.Column('message', postgresql.JSONB, nullable=False),
+                    sa.Column('send_at', sa.DateTime, nullable=False),
+                    sa.Column('released_at', sa.DateTime, nullable=True),
+                    sa.Column('created_at', sa.DateTime, nullable=True),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('key'))
+    op.create_index('ix_scheduled_task_send_at', 'scheduled_task', ['send_at'],
+                    postgresql_where=sa.text('released_at IS NULL'))
+
+
+def downgrade():
+    op.drop_index('ix_scheduled_task_send_at', 'scheduled_task')
+    op.drop_table('scheduled_task')
@@ -0,0 +1,33 @@
+"""created_at not null
+
+Revision ID: c7a3e1f59d20
+Revises: b4d19c2f6e05
+Create Date: 2026-10-18 21:41:12.603517
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c7a3e1f59d20'
+down_revision = 'b4d19c2f6e05'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# keyset pagination orders and compares rows by (created_at, id), rows without creation time would sort
+# first and never match a cursor; they are dated to epoch, so they come last in descending order
+TABLES = ['user', 'channel', 'device', 'alert']
+
+
+def upgrade():
+    for table in TABLES:
+        op.execute('UPDATE "%s" SET created_at = \'epoch\' WHERE created_at IS NULL' % table)
+        op.alter_column(table, 'created_at', existing_type=sa.DateTime, nullable=False,
+                        server_default=sa.text('now()'))
+
+
+def downgrade():
+    for table in reversed(TABLES):
+        op.alter_column(table, 'created_at', existing_type=sa.DateTime, nullable=True, server_default=None)
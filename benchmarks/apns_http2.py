@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Measure chunk-level and per-token latency of APNs HTTP/2 transport against the local stub server.
+
+    PNSCONF=~/config.ini python benchmarks/apns_http2.py --chunks 20 --connections 2 --streams 100 --delay 0.005
+"""
+
+import time
+import argparse
+from apns_http2_stub import APNsStubServer
+from pns.workers.apns_http2 import APNsHTTP2Transport, build_payload
+from pns.workers.pool import SenderStats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chunks', type=int, default=20)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--connections', type=int, default=2)
+    parser.add_argument('--streams', type=int, default=100)
+    parser.add_argument('--delay', type=float, default=0.005, help='simulated server delay (in seconds)')
+    parser.add_argument('--invalid-ratio', type=float, default=0.01)
+    args = parser.parse_args()
+    server = APNsStubServer(delay=args.delay)
+    server.start()
+    transport = APNsHTTP2Transport('localhost:%d' % server.port, topic='com.example.bench',
+                                   connections=args.connections, max_streams=args.streams, secure=False)
+    payload = build_payload({'alert': 'benchmark', 'data': {'url': 'http://example.com/'}})
+    invalid_every = int(1 / args.invalid_ratio) if args.invalid_ratio else 0
+    stats = SenderStats('http2 %d connections x %d streams' % (args.connections, args.streams))
+    invalid = 0
+    started_at = time.time()
+    for chunk in range(args.chunks):
+        tokens = [('gone%064d' if invalid_every and i % invalid_every == 0 else '%064d') % (chunk * args.chunk_size + i)
+                  for i in range(args.chunk_size)]
+        result = transport.send(tokens, payload, expiration=int(time.time()) + 3600)
+        invalid += len(result.invalid)
+        stats.record(len(tokens), result.elapsed, len(tokens) - len(result.sent), result.latencies)
+    elapsed = time.time() - started_at
+    transport.close()
+    print(stats)
+    print('%d tokens in %.2f seconds, %.0f tokens/s, %d invalid tokens reported inline' %
+          (stats.tokens, elapsed, stats.tokens / elapsed, invalid))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Local APNs HTTP/2 provider API stub (plain text HTTP/2 with prior knowledge, requires `h2`).
+
+Responds to `POST /3/device/<token>` requests like APNs does;
+  * tokens starting with `bad` get 400 BadDeviceToken
+  * tokens starting with `gone` get 410 Unregistered
+  * tokens starting with `busy` get 503 ServiceUnavailable
+  * any other token gets 200
+
+Point `APNSWorker` to the stub with following options in `apns` section;
+
+    transport = http2
+    http2_host = localhost:8443
+    http2_secure = false
+
+    python benchmarks/apns_http2_stub.py --port 8443 --delay 0.01
+"""
+
+import json
+import time
+import socket
+import argparse
+import threading
+import h2.config
+import h2.events
+import h2.connection
+import h2.settings
+
+
+class APNsStubServer(threading.Thread):
+    def __init__(self, host='localhost', port=0, delay=0.0, max_streams=1000):
+        """
+        :param str host: address to listen
+        :param int port: port to listen, 0 picks a free port
+        :param float delay: simulated response time of every read from socket (in seconds)
+        :param int max_streams: maximum number of concurrent streams per connection
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.delay = delay
+        self.max_streams = max_streams
+        self.requests = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(128)
+        self.port = self.sock.getsockname()[1]
+
+    def run(self):
+        while True:
+            client, _ = self.sock.accept()
+            thread = threading.Thread(target=self.handle, args=(client,))
+            thread.daemon = True
+            thread.start()
+
+    def respond(self, token):
+        if token.startswith('bad'):
+            return 400, {'reason': 'BadDeviceToken'}
+        if token.startswith('gone'):
+            return 410, {'reason': 'Unregistered', 'timestamp': int(time.time() * 1000)}
+        if token.startswith('busy'):
+            return 503, {'reason': 'ServiceUnavailable'}
+        return 200, None
+
+    def handle(self, client):
+        conn = h2.connection.H2Connection(config=h2.config.H2Configuration(client_side=False))
+        conn.initiate_connection()
+        conn.update_settings({h2.settings.MAX_CONCURRENT_STREAMS: self.max_streams})
+        client.sendall(conn.data_to_send())
+        paths = {}
+        terminated = False
+        while not terminated:
+            data = client.recv(65535)
+            if not data:
+                break
+            if self.delay:
+                time.sleep(self.delay)
+            for event in conn.receive_data(data):
+                if isinstance(event, h2.events.RequestReceived):
+                    paths[event.stream_id] = dict(event.headers)[':path']
+                elif isinstance(event, h2.events.DataReceived):
+                    conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                elif isinstance(event, h2.events.ConnectionTerminated):
+                    terminated = True
+                elif isinstance(event, h2.events.StreamEnded):
+                    self.requests += 1
+                    status, body = self.respond(paths.pop(event.stream_id).rsplit('/', 1)[-1])
+                    headers = [(':status', str(status)), ('apns-id', str(event.stream_id))]
+                    if body is None:
+                        conn.send_headers(event.stream_id, headers, end_stream=True)
+                    else:
+                        conn.send_headers(event.stream_id, headers)
+                        conn.send_data(event.stream_id, json.dumps(body).encode('utf-8'), end_stream=True)
+            client.sendall(conn.data_to_send())
+        client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--delay', type=float, default=0.0)
+    args = parser.parse_args()
+    server = APNsStubServer(args.host, args.port, args.delay)
+    server.start()
+    print('listening on %s:%d' % (args.host, server.port))
+    while server.is_alive():
+        server.join(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Compare `channel_devices` (denormalized) and `subscriptions` (join) audience resolvers.
+
+Synthetic users, channels and devices are created in the database configured by `PNSCONF` inside a
+single transaction which is rolled back at the end, so the benchmark leaves no rows behind.
+
+    PNSCONF=~/config.ini python benchmarks/audience_resolver.py --users 100000 --channels 5
+
+Reported figures;
+  * registration: time to register all devices with `Device.bulk_upsert` and the number of rows
+    written per device (write amplification)
+  * fan-out: time to stream the platform tokens of a channel audience as the preprocessing worker does
+"""
+
+import argparse
+import time
+import uuid
+from sqlalchemy import text
+from sqlalchemy.sql.expression import false
+from pns import models
+from pns.models import db, Channel, Device
+
+
+def seed(prefix, users, channels):
+    channel_ids = [row[0] for row in db.session.execute(
+        text('INSERT INTO channel (name, created_at) '
+             'SELECT :prefix || g, now() FROM generate_series(1, :n) g RETURNING id'),
+        {'prefix': prefix, 'n': channels})]
+    user_ids = [row[0] for row in db.session.execute(
+        text('INSERT INTO "user" (pns_id, created_at) '
+             'SELECT :prefix || g, now() FROM generate_series(1, :n) g RETURNING id'),
+        {'prefix': prefix, 'n': users})]
+    db.session.execute(
+        text('INSERT INTO subscriptions (user_id, channel_id) '
+             'SELECT u, c FROM unnest(CAST(:user_ids AS integer[])) u, unnest(CAST(:channel_ids AS integer[])) c'),
+        {'user_ids': user_ids, 'channel_ids': channel_ids})
+    return user_ids, channel_ids
+
+
+def register_devices(prefix, user_ids, devices_per_user, batch_size):
+    rows = []
+    for user_id in user_ids:
+        for i in range(devices_per_user):
+            rows.append({'user_id': user_id,
+                         'platform': 'gcm' if i % 2 else 'apns',
+                         'platform_id': '%s%d-%d' % (prefix, user_id, i),
+                         'mobile_app_id': 'com.example.bench',
+                         'mobile_app_ver': 1})
+    started = time.time()
+    for i in range(0, len(rows), batch_size):
+        Device.bulk_upsert(rows[i:i + batch_size])
+    return len(rows), time.time() - started
+
+
+def count_channel_devices(channel_ids):
+    return db.session.execute(text('SELECT count(*) FROM channel_devices WHERE channel_id = ANY(:channel_ids)'),
+                              {'channel_ids': channel_ids}).scalar()
+
+
+def fan_out(channel_id, repeat):
+    timings = []
+    tokens = 0
+    for _ in range(repeat):
+        tokens = 0
+        started = time.time()
+        for platform in ['apns', 'gcm']:
+            query = (Channel
+                     .get_devices_query(channel_id)
+                     .filter(Device.platform == platform)
+                     .filter(Device.mute == false())
+                     .with_entities(Device.platform_id))
+            for _ in query.yield_per(1000):
+                tokens += 1
+        timings.append(time.time() - started)
+    timings.sort()
+    return tokens, timings[0], timings[len(timings) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--channels', type=int, default=5)
+    parser.add_argument('--devices-per-user', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    prefix = 'bench-%s-' % uuid.uuid4().hex[:8]
+    try:
+        user_ids, channel_ids = seed(prefix, args.users, args.channels)
+        db.session.execute(text('ANALYZE'))
+        print('%-16s %10s %12s %14s %16s' % ('resolver', 'devices', 'register (s)', 'rows/device', 'devices/s'))
+        for resolver in [models.AUDIENCE_SUBSCRIPTIONS, models.AUDIENCE_CHANNEL_DEVICES]:
+            models.audience_resolver = resolver
+            savepoint = db.session.begin_nested()
+            devices, elapsed = register_devices(prefix, user_ids, args.devices_per_user, args.batch_size)
+            written = devices + count_channel_devices(channel_ids)
+            if resolver == models.AUDIENCE_SUBSCRIPTIONS:
+                # keep devices registered by the denormalized resolver for the fan-out comparison
+                savepoint.rollback()
+            print('%-16s %10d %12.3f %14.2f %16.0f' % (resolver, devices, elapsed,
+                                                      float(written) / devices, devices / elapsed))
+        db.session.execute(text('ANALYZE'))
+        print('')
+        print('%-16s %10s %12s %14s %16s' % ('resolver', 'tokens', 'best (s)', 'median (s)', 'tokens/s'))
+        for resolver in [models.AUDIENCE_SUBSCRIPTIONS, models.AUDIENCE_CHANNEL_DEVICES]:
+            models.audience_resolver = resolver
+            tokens, best, median = fan_out(channel_ids[0], args.repeat)
+            print('%-16s %10d %12.3f %14.3f %16.0f' % (resolver, tokens, best, median, tokens / median))
+    finally:
+        db.session.rollback()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Compare audience streaming modes of preprocessing worker (`orm`, `cursor` and `copy`).
+
+Synthetic devices are committed to the database configured by `PNSCONF` (server-side cursors and
+COPY read through their own connections, so rows must be visible to them) and deleted at the end.
+Every mode runs in a separate process, so peak RSS figures are not affected by each other.
+
+    PNSCONF=~/config.ini python benchmarks/audience_streaming.py --devices 1000000 --repeat 3
+"""
+
+import sys
+import time
+import uuid
+import argparse
+import resource
+import subprocess
+from sqlalchemy import text
+from sqlalchemy.sql.expression import false
+from pns.models import db, Device
+from pns.workers.audience import stream_platform_ids, STREAM_MODES
+
+
+def seed(prefix, devices):
+    user_id = db.session.execute(
+        text('INSERT INTO "user" (pns_id, created_at) VALUES (:prefix, now()) RETURNING id'),
+        {'prefix': prefix}).scalar()
+    db.session.execute(
+        text('INSERT INTO device (user_id, platform, platform_id, mobile_app_id, mobile_app_ver, mute, created_at) '
+             'SELECT :user_id, \'gcm\', :prefix || g || \'-\' || md5(CAST(g AS text)), :prefix, 1, FALSE, now() '
+             'FROM generate_series(1, :n) g'),
+        {'user_id': user_id, 'prefix': prefix, 'n': devices})
+    db.session.commit()
+    db.session.execute(text('ANALYZE device'))
+    db.session.commit()
+
+
+def cleanup(prefix):
+    db.session.execute(text('DELETE FROM device WHERE mobile_app_id = :prefix'), {'prefix': prefix})
+    db.session.execute(text('DELETE FROM "user" WHERE pns_id = :prefix'), {'prefix': prefix})
+    db.session.commit()
+
+
+def run(prefix, mode, chunk_size):
+    query = (db
+             .session
+             .query(Device.platform_id)
+             .filter(Device.platform == 'gcm')
+             .filter(Device.mute == false())
+             .filter(Device.mobile_app_id == prefix)
+             .filter(Device.mobile_app_ver >= 1))
+    rows = chunks = 0
+    started_at = time.time()
+    for devices in stream_platform_ids(query, chunk_size, mode):
+        chunks += 1
+        rows += len(devices)
+    elapsed = time.time() - started_at
+    # kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    print('%-8s %10d %8d %10.3f %12.0f %14.1f' % (mode, rows, chunks, elapsed, rows / elapsed, peak_rss))
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, default=1000000)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--modes', nargs='+', choices=STREAM_MODES, default=STREAM_MODES)
+    # internal, runs a single mode against already seeded devices
+    parser.add_argument('--run', nargs=2, metavar=('PREFIX', 'MODE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        run(args.run[0], args.run[1], args.chunk_size)
+        return
+    prefix = 'bench-%s-' % uuid.uuid4().hex[:8]
+    seed(prefix, args.devices)
+    try:
+        print('%-8s %10s %8s %10s %12s %14s' % ('mode', 'rows', 'chunks', 'time (s)', 'rows/s', 'peak RSS (MB)'))
+        for _ in range(args.repeat):
+            for mode in args.modes:
+                subprocess.check_call([sys.executable, __file__, '--chunk-size', str(args.chunk_size),
+                                       '--run', prefix, mode])
+    finally:
+        cleanup(prefix)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Compare bytes on the wire of `full` and `compact` chunk messages published by preprocessing worker,
+and (with `--broker`) publish throughput of both formats to the RabbitMQ server configured by `PNSCONF`.
+Messages are published with confirms to a temporary queue, which is deleted at the end.
+
+    PNSCONF=~/config.ini python benchmarks/chunk_wire_format.py --chunks 20000 --data-size 512 --broker
+"""
+
+import os
+import time
+import uuid
+import base64
+import argparse
+import binascii
+import pika
+from flask.json import dumps
+from pns.utils import get_conf, PikaConnectionManager, ConfirmedPublisher
+from pns.workers.chunks import encode_chunk, FORMAT_FULL, FORMAT_COMPACT
+
+FORMATS = [FORMAT_FULL, FORMAT_COMPACT]
+
+
+def make_tokens(platform, count):
+    if platform == 'apns':
+        return [binascii.hexlify(os.urandom(32)) for _ in range(count)]
+    # registration ids are opaque url-safe strings of ~150 characters
+    return ['APA91b' + base64.urlsafe_b64encode(os.urandom(108)) for _ in range(count)]
+
+
+def make_payload(data_size):
+    return {'alert': 'Benchmark alert message with a reasonably long text for a notification',
+            'appid': 'com.example.benchmark',
+            'appver': 1,
+            'ttl': 3600,
+            'gcm': {'collapse_key': 'benchmark'},
+            'apns': {'badge': 1, 'sound': 'default'},
+            'data': {'url': 'http://example.com/', 'blob': 'x' * data_size}}
+
+
+def measure_size(args, payload):
+    print('%-8s %-8s %12s %14s %12s' % ('format', 'platform', 'bytes/chunk', 'bytes/token', 'total (MB)'))
+    bodies = {}
+    for platform in ['apns', 'gcm']:
+        tokens = make_tokens(platform, args.chunk_size)
+        for chunk_format in FORMATS:
+            body = dumps(encode_chunk(tokens, payload, 42, chunk_format), ensure_ascii=False)
+            bodies[(chunk_format, platform)] = body
+            print('%-8s %-8s %12d %14.1f %12.1f' % (chunk_format, platform, len(body),
+                                                    len(body) / float(args.chunk_size),
+                                                    len(body) * args.chunks / 1048576.0))
+    return bodies
+
+
+def measure_broker(args, bodies):
+    conf = get_conf()
+    cm = PikaConnectionManager(username=conf.get('rabbitmq', 'username'),
+                               password=conf.get('rabbitmq', 'password'),
+                               host=conf.get('rabbitmq', 'host'))
+    queue = 'pns_benchmark_%s' % uuid.uuid4().hex[:8]
+    cm.channel.queue_declare(queue=queue, durable=True)
+    # default exchange routes messages by queue name
+    publisher = ConfirmedPublisher(cm.conn_params, '')
+    publisher.start()
+    print('%-8s %-8s %10s %12s %10s' % ('format', 'platform', 'time (s)', 'chunks/s', 'MB/s'))
+    try:
+        for (chunk_format, platform), body in sorted(bodies.items()):
+            started_at = time.time()
+            for _ in range(args.chunks):
+                publisher.publish(routing_key=queue,
+                                  body=body,
+                                  properties=pika.BasicProperties(delivery_mode=2,
+                                                                  content_type='application/json'))
+            publisher.flush()
+            elapsed = time.time() - started_at
+            print('%-8s %-8s %10.2f %12.0f %10.1f' % (chunk_format, platform, elapsed, args.chunks / elapsed,
+                                                      len(body) * args.chunks / 1048576.0 / elapsed))
+            cm.channel.queue_purge(queue=queue)
+    finally:
+        publisher.stop()
+        cm.channel.queue_delete(queue=queue)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chunks', type=int, default=20000, help='chunks per format and platform')
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--data-size', type=int, default=512, help='size of `data` of alert payload')
+    parser.add_argument('--broker', action='store_true', help='measure publish throughput of rabbitmq server')
+    args = parser.parse_args()
+    bodies = measure_size(args, make_payload(args.data_size))
+    if args.broker:
+        measure_broker(args, bodies)
+
+
+if __name__ == '__main__':
+    main()
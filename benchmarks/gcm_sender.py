@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Measure batches per second of a GCM worker process against the local stub server. Sender threads
+share one keep-alive connection pool like `GCMWorker` does, `--concurrency 1` is the behaviour of a
+worker consuming with `prefetch_count=1`.
+
+    PNSCONF=~/config.ini python benchmarks/gcm_sender.py --batches 200 --concurrency 1 8 32 --delay 0.05
+"""
+
+import time
+import Queue
+import argparse
+import threading
+from gcm_stub import GCMStubServer
+from pns.workers.gcm_http import GCMTransport
+from pns.workers.pool import SenderStats
+
+
+def run(server, args, concurrency):
+    transport = GCMTransport('benchmark', url=server.url, connections=concurrency, backoff=0.1)
+    stats = SenderStats('%d concurrent batches' % concurrency)
+    invalid_every = int(1 / args.invalid_ratio) if args.invalid_ratio else 0
+    batches = Queue.Queue()
+    for batch in range(args.batches):
+        batches.put([('gone%d' if invalid_every and i % invalid_every == 0 else 'id%d') % (batch * args.batch_size + i)
+                     for i in range(args.batch_size)])
+
+    def sender():
+        while True:
+            try:
+                registration_ids = batches.get_nowait()
+            except Queue.Empty:
+                return
+            result = transport.send(registration_ids, {'alert': 'benchmark'}, time_to_live=3600)
+            stats.record(len(registration_ids), result.elapsed, len(registration_ids) - result.success)
+
+    requests, connections = server.requests, server.connections
+    started_at = time.time()
+    threads = [threading.Thread(target=sender) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started_at
+    transport.close()
+    print(stats)
+    print('%d batches in %.2f seconds, %.1f batches/s, %d requests over %d connections' %
+          (stats.messages, elapsed, stats.messages / elapsed, server.requests - requests,
+           server.connections - connections))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batches', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--delay', type=float, default=0.05, help='simulated server delay (in seconds)')
+    parser.add_argument('--unavailable-ratio', type=float, default=0.0)
+    parser.add_argument('--invalid-ratio', type=float, default=0.01)
+    args = parser.parse_args()
+    server = GCMStubServer(delay=args.delay, unavailable_ratio=args.unavailable_ratio)
+    server.start()
+    for concurrency in args.concurrency:
+        run(server, args, concurrency)
+    server.stop()
+
+
+if __name__ == '__main__':
+    main()
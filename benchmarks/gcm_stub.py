@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Local GCM HTTP connection server stub (plain text HTTP/1.1 with keep-alive).
+
+Responds to `POST /gcm/send` requests like GCM does;
+  * registration ids starting with `gone` get NotRegistered
+  * registration ids starting with `bad` get InvalidRegistration
+  * registration ids starting with `busy` get Unavailable
+  * registration ids starting with `old` get a canonical id
+  * any other registration id gets a message id
+  * `--unavailable-ratio` of requests get 503 with `Retry-After` header
+  * latency of messages with a `sent_at` timestamp in `data` is recorded (see `benchmarks/priority_latency.py`)
+
+Point `GCMWorker` to the stub with following option in `gcm` section;
+
+    url = http://localhost:8080/gcm/send
+
+    python benchmarks/gcm_stub.py --port 8080 --delay 0.05
+"""
+
+import json
+import time
+import random
+import argparse
+import threading
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+
+class GCMStubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+            self.server.active += 1
+
+    def finish(self):
+        BaseHTTPRequestHandler.finish(self)
+        with self.server.lock:
+            self.server.active -= 1
+
+    def respond(self, reg_id, index):
+        if reg_id.startswith('gone'):
+            return {'error': 'NotRegistered'}
+        if reg_id.startswith('bad'):
+            return {'error': 'InvalidRegistration'}
+        if reg_id.startswith('busy'):
+            return {'error': 'Unavailable'}
+        if reg_id.startswith('old'):
+            return {'message_id': '0:%d' % index, 'registration_id': 'new' + reg_id[3:]}
+        return {'message_id': '0:%d' % index}
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length')))
+        time.sleep(self.server.delay)
+        with self.server.lock:
+            self.server.requests += 1
+        if random.random() < self.server.unavailable_ratio:
+            self.send_response(503)
+            self.send_header('Retry-After', str(self.server.retry_after))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        message = json.loads(body)
+        sent_at = message.get('data', {}).get('sent_at')
+        if sent_at:
+            with self.server.lock:
+                self.server.latencies.append(time.time() - float(sent_at))
+        results = [self.respond(reg_id, i) for i, reg_id in enumerate(message['registration_ids'])]
+        data = json.dumps({'multicast_id': 1,
+                           'success': len([r for r in results if 'message_id' in r]),
+                           'failure': len([r for r in results if 'error' in r]),
+                           'canonical_ids': len([r for r in results if 'registration_id' in r]),
+                           'results': results})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class GCMStubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host='localhost', port=0, delay=0.0, unavailable_ratio=0.0, retry_after=0):
+        """
+        :param str host: address to listen
+        :param int port: port to listen, 0 picks a free port
+        :param float delay: simulated response time of every request (in seconds)
+        :param float unavailable_ratio: ratio of requests responded with 503
+        :param int retry_after: `Retry-After` header of 503 responses (in seconds)
+        """
+        HTTPServer.__init__(self, (host, port), GCMStubHandler)
+        self.port = self.server_address[1]
+        self.delay = delay
+        self.unavailable_ratio = unavailable_ratio
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.active = 0
+        # seconds from `sent_at` of message data to its response
+        self.latencies = []
+
+    @property
+    def url(self):
+        return 'http://localhost:%d/gcm/send' % self.port
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self, timeout=5):
+        """stop listening and wait for clients to close their keep-alive connections
+        """
+        self.shutdown()
+        deadline = time.time() + timeout
+        while self.active and time.time() < deadline:
+            time.sleep(0.01)
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--delay', type=float, default=0.05, help='simulated server delay (in seconds)')
+    parser.add_argument('--unavailable-ratio', type=float, default=0.0)
+    parser.add_argument('--retry-after', type=int, default=1)
+    args = parser.parse_args()
+    server = GCMStubServer(port=args.port, delay=args.delay, unavailable_ratio=args.unavailable_ratio,
+                           retry_after=args.retry_after)
+    print('listening on %s' % server.url)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
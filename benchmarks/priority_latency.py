@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Measure end-to-end latency of one time password alerts sent while a channel broadcast is in flight.
+
+Runs against a running installation; web service (`--api`), preprocessing workers and a GCM worker
+pointed to the stub started by this script (`url = http://localhost:8080/gcm/send` in `gcm` section).
+A channel of `--devices` GCM devices and a single OTP recipient are created in the database configured
+by `PNSCONF` and deleted at the end. For each priority (`normal`, then `high`) a broadcast is created
+with `POST /alerts`, then `--alerts` OTP alerts of that priority are created every `--interval` seconds
+while the broadcast is preprocessed and sent. Latency is measured at the stub from the creation time
+carried in alert data, so it covers API, preprocessing and sender stages and their queues.
+
+    PNSCONF=~/config.ini python benchmarks/priority_latency.py --devices 1000000 --alerts 100 --port 8080
+"""
+
+import time
+import uuid
+import argparse
+import requests
+from sqlalchemy import text
+from gcm_stub import GCMStubServer
+from pns.lanes import NORMAL, PRIORITIES
+from pns.models import db
+from pns.workers.pool import SenderStats
+
+
+def seed(prefix, devices):
+    """
+    create a channel of `devices` users with a GCM device each, and an OTP recipient with a single device
+    :return: tuple of (channel id, `pns_id` of OTP recipient)
+    """
+    otp_pns_id = prefix + 'otp'
+    channel_id = db.session.execute(text('INSERT INTO channel (name, created_at) VALUES (:name, now()) RETURNING id'),
+                                    {'name': prefix + 'broadcast'}).scalar()
+    db.session.execute(
+        text('INSERT INTO "user" (pns_id, created_at) '
+             'SELECT :prefix || g, now() FROM generate_series(1, :n) g UNION ALL SELECT :otp, now()'),
+        {'prefix': prefix, 'n': devices, 'otp': otp_pns_id})
+    db.session.execute(
+        text('INSERT INTO device (user_id, platform, platform_id, mute, created_at) '
+             'SELECT id, \'gcm\', pns_id, FALSE, now() FROM "user" WHERE pns_id LIKE :pattern'),
+        {'pattern': prefix + '%'})
+    db.session.execute(
+        text('INSERT INTO subscriptions (user_id, channel_id) '
+             'SELECT id, :channel_id FROM "user" WHERE pns_id LIKE :pattern AND pns_id <> :otp'),
+        {'channel_id': channel_id, 'pattern': prefix + '%', 'otp': otp_pns_id})
+    db.session.execute(
+        text('INSERT INTO channel_devices (channel_id, device_id) '
+             'SELECT :channel_id, id FROM device WHERE platform_id LIKE :pattern AND platform_id <> :otp'),
+        {'channel_id': channel_id, 'pattern': prefix + '%', 'otp': otp_pns_id})
+    db.session.commit()
+    return channel_id, otp_pns_id
+
+
+def cleanup(prefix, channel_id, otp_pns_id):
+    params = {'channel_id': channel_id, 'pattern': prefix + '%', 'otp': '{"pns_id": ["%s"]}' % otp_pns_id}
+    for sql in ['DELETE FROM alert WHERE channel_id = :channel_id OR payload @> CAST(:otp AS jsonb)',
+                'DELETE FROM channel_devices WHERE channel_id = :channel_id',
+                'DELETE FROM subscriptions WHERE channel_id = :channel_id',
+                'DELETE FROM device WHERE platform_id LIKE :pattern',
+                'DELETE FROM "user" WHERE pns_id LIKE :pattern',
+                'DELETE FROM channel WHERE id = :channel_id']:
+        db.session.execute(text(sql), params)
+    db.session.commit()
+
+
+def create_alert(api, payload):
+    response = requests.post(api + '/alerts', json=payload)
+    response.raise_for_status()
+
+
+def wait_idle(server, idle, timeout):
+    """wait until stub receives no requests for `idle` seconds
+    """
+    deadline = time.time() + timeout
+    requests_seen = -1
+    while server.requests != requests_seen and time.time() < deadline:
+        requests_seen = server.requests
+        time.sleep(idle)
+
+
+def run(server, args, channel_id, otp_pns_id, priority):
+    wait_idle(server, args.idle, args.timeout)
+    del server.latencies[:]
+    create_alert(args.api, {'alert': 'broadcast', 'channel_id': channel_id})
+    for index in range(args.alerts):
+        time.sleep(args.interval)
+        create_alert(args.api, {'alert': 'otp %d' % index, 'pns_id': [otp_pns_id], 'priority': priority,
+                                'data': {'sent_at': time.time()}})
+    deadline = time.time() + args.timeout
+    while len(server.latencies) < args.alerts and time.time() < deadline:
+        time.sleep(0.1)
+    latencies = list(server.latencies)
+    print('%-6s %d/%d alerts, latency p50 %.3fs p99 %.3fs max %.3fs' %
+          (priority, len(latencies), args.alerts, SenderStats.percentile(latencies, 50),
+           SenderStats.percentile(latencies, 99), max(latencies) if latencies else 0.0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--api', default='http://localhost:5000', help='url of web service')
+    parser.add_argument('--devices', type=int, default=1000000, help='audience of broadcast')
+    parser.add_argument('--alerts', type=int, default=100, help='number of OTP alerts per priority')
+    parser.add_argument('--interval', type=float, default=0.05, help='time between OTP alerts')
+    parser.add_argument('--delay', type=float, default=0.01, help='simulated GCM response time (in seconds)')
+    parser.add_argument('--port', type=int, default=8080, help='port of GCM stub')
+    parser.add_argument('--idle', type=float, default=2, help='quiet time of stub before each run (in seconds)')
+    parser.add_argument('--timeout', type=float, default=600, help='time to wait for alerts (in seconds)')
+    args = parser.parse_args()
+    server = GCMStubServer(port=args.port, delay=args.delay)
+    server.start()
+    prefix = 'bench-%s-' % uuid.uuid4().hex[:8]
+    channel_id, otp_pns_id = seed(prefix, args.devices)
+    try:
+        # normal priority first, OTP alerts queue behind the broadcast at every stage
+        for priority in sorted(PRIORITIES, key=lambda p: p != NORMAL):
+            run(server, args, channel_id, otp_pns_id, priority)
+        wait_idle(server, args.idle, args.timeout)
+    finally:
+        cleanup(prefix, channel_id, otp_pns_id)
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of serializer backends over representative queue messages; alert messages of
+preprocessing queue and chunk messages of sender queues in both chunk formats. Backends which are
+not installed (`pip install ujson msgpack-python`) are skipped.
+
+    PNSCONF=~/config.ini python benchmarks/serializers.py --number 200
+"""
+
+import timeit
+import argparse
+from chunk_wire_format import make_tokens, make_payload
+from pns.serializers import get_backend, JSON_BACKENDS
+from pns.workers.chunks import encode_chunk, FORMAT_FULL, FORMAT_COMPACT
+
+
+def make_messages(args):
+    payload = make_payload(args.data_size)
+    messages = [('alert', {'id': 42, 'channel_id': 7, 'payload': payload,
+                           'created_at': 'Sun, 18 Oct 2026 10:00:00 GMT'})]
+    for platform in ['apns', 'gcm']:
+        tokens = make_tokens(platform, args.chunk_size)
+        for chunk_format in [FORMAT_FULL, FORMAT_COMPACT]:
+            messages.append(('%s %s' % (chunk_format, platform), encode_chunk(tokens, payload, 42, chunk_format)))
+    return messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=200, help='iterations per measurement')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--data-size', type=int, default=512, help='size of `data` of alert payload')
+    parser.add_argument('--backends', nargs='+', default=JSON_BACKENDS + ['msgpack'])
+    args = parser.parse_args()
+    messages = make_messages(args)
+    print('%-8s %-14s %10s %14s %14s' % ('backend', 'message', 'bytes', 'encode (us)', 'decode (us)'))
+    for name in args.backends:
+        try:
+            backend = get_backend(name)
+        except ImportError:
+            print('%-8s not installed' % name)
+            continue
+        for label, message in messages:
+            body = backend.dumps(message)
+            encode = min(timeit.repeat(lambda: backend.dumps(message), number=args.number, repeat=args.repeat))
+            decode = min(timeit.repeat(lambda: backend.loads(body), number=args.number, repeat=args.repeat))
+            print('%-8s %-14s %10d %14.1f %14.1f' % (name, label, len(body), encode * 1e6 / args.number,
+                                                     decode * 1e6 / args.number))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Measure GCM requests needed for transactional alerts of one token each, sent by `BatchingDeliveryPool`
+in this process to the local GCM stub. Alerts share their content (`--templates` distinct texts) but
+every alert has its own recipient (`pns_id`), deliveries of the same content are merged into requests.
+
+    PNSCONF=~/config.ini python benchmarks/transactional_batching.py --alerts 5000 --templates 3
+"""
+
+import time
+import argparse
+import threading
+import pika
+from gcm_stub import GCMStubServer
+from pns.workers.gcm_http import GCMTransport
+from pns.workers.pool import BatchingDeliveryPool
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--alerts', type=int, default=5000, help='number of one token deliveries')
+    parser.add_argument('--templates', type=int, default=3, help='number of distinct alert texts')
+    parser.add_argument('--connections', type=int, default=8, help='sender threads')
+    parser.add_argument('--max-wait', type=float, default=0.05, help='maximum wait of a delivery (in seconds)')
+    parser.add_argument('--delay', type=float, default=0.01, help='simulated GCM response time (in seconds)')
+    args = parser.parse_args()
+    server = GCMStubServer(delay=args.delay)
+    server.start()
+    transport = GCMTransport('benchmark', url=server.url, connections=args.connections)
+    completed = threading.Semaphore(0)
+
+    def decoder(properties, body):
+        return body['devices'], body['payload']
+
+    def handler(slot, tokens, payload, attempt):
+        transport.send(tokens, dict(payload['data'], alert=payload['alert']))
+        for _ in tokens:
+            completed.release()
+
+    pool = BatchingDeliveryPool(None, 'pns_gcm_queue', decoder, handler, args.connections, max_wait=args.max_wait)
+    threads = [threading.Thread(target=pool._collect)]
+    threads += [threading.Thread(target=pool._run, args=(slot,)) for slot in range(args.connections)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    started_at = time.time()
+    for index in range(args.alerts):
+        template = index % args.templates
+        payload = {'alert': 'Your code is ready (template %d)' % template, 'pns_id': ['user%d' % index],
+                   'data': {'template': template}}
+        pool.deliveries.put('pns_gcm_queue', (index, pika.BasicProperties(),
+                                              {'devices': ['id%d' % index], 'payload': payload}))
+    for _ in range(args.alerts):
+        completed.acquire()
+    elapsed = time.time() - started_at
+    transport.close()
+    server.stop()
+    print('%d deliveries: %d requests, %d batches, %d deliveries merged with others in %.2f seconds' %
+          (args.alerts, server.requests, pool.flushed, pool.merged, elapsed))
+
+
+if __name__ == '__main__':
+    main()
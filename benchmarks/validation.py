@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Compare `Schema.validate` with precompiled validators of `pns/json_schemas.py` over representative
+request bodies, and check that both raise the same error messages for invalid ones.
+
+    python benchmarks/validation.py --number 20000
+"""
+
+import timeit
+import argparse
+from schema import SchemaError
+from pns.json_schemas import alert_schema, registration_schema, validate_alert, validate_registration
+
+CASES = [
+    ('alert minimal', alert_schema, validate_alert, {u'alert': u'Hello', u'pns_id': [u'user@example.com']}),
+    ('alert full', alert_schema, validate_alert,
+     {u'alert': u'Your order has been shipped', u'pns_id': [u'user%d@example.com' % i for i in range(10)],
+      u'ttl': 3600, u'appid': u'com.example.app', u'appver': 12,
+      u'gcm': {u'collapse_key': u'order', u'delay_while_idle': False},
+      u'apns': {u'badge': 1, u'sound': u'default', u'content_available': 1},
+      u'data': {u'order_id': 1234, u'url': u'http://example.com/orders/1234'}}),
+    ('alert invalid', alert_schema, validate_alert,
+     {u'alert': u'Hello', u'ttl': 3600, u'apns': {u'badge': -1}}),
+    ('alert wrong key', alert_schema, validate_alert, {u'alert': u'Hello', u'channel': 1}),
+    ('registration', registration_schema, validate_registration,
+     {u'pns_id': [u'user%d@example.com' % i for i in range(100)]}),
+    ('registration bad', registration_schema, validate_registration, {u'pns_id': [u'user@example.com', 42]}),
+]
+
+
+def run(validate, data):
+    try:
+        validate(data)
+    except SchemaError as ex:
+        return str(ex)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=20000, help='iterations per measurement')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    print('%-18s %12s %13s %8s  %s' % ('request', 'schema (us)', 'compiled (us)', 'speedup', 'same error'))
+    for label, schema, validate, data in CASES:
+        expected, got = run(schema.validate, data), run(validate, data)
+        elapsed = [min(timeit.repeat(lambda: run(f, data), number=args.number, repeat=args.repeat)) * 1e6 / args.number
+                   for f in [schema.validate, validate]]
+        print('%-18s %12.1f %13.1f %7.1fx  %s' % (label, elapsed[0], elapsed[1], elapsed[0] / elapsed[1],
+                                                  'n/a' if expected is None and got is None else expected == got))
+
+
+if __name__ == '__main__':
+    main()
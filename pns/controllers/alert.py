@@ -1,28 +1,84 @@
 # -*- coding: utf-8 -*-
 
-import pika
-from flask import Blueprint, request, jsonify
-from flask.json import dumps
-from pns.utils import PikaConnectionManager
+import os
+import time
+import uuid
+import datetime
+import threading
+from flask import Blueprint, request
+from pns.utils import PikaChannelPool, PoolTimeout, ConfirmedPublisher, get_connection_parameters, get_conf_value, \
+    iter_ndjson, chunked
 from pns.app import app, conf
-from pns.models import db, Alert
-from pns.json_schemas import alert_schema
+from pns.models import db, Alert, ScheduledTask
+from pns.json_schemas import validate_alert
+from pns.pagination import paginate
+from pns.serializers import jsonify, to_builtin, encode_message, MESSAGE_FORMATS
+from pns.spool import Spool, SpoolFull
+from pns.lanes import PRIORITIES, NORMAL, get_lane, get_priority
 
 
 alert = Blueprint('alert', __name__)
+# maximum number of alerts accepted by a single batch request
+BATCH_MAX_ALERTS = 10000
+# number of alerts resolved together by a preprocessing worker
+BATCH_TASK_SIZE = 1000
 
-conn_manager = PikaConnectionManager(username=conf.get('rabbitmq', 'username'),
-                                     password=conf.get('rabbitmq', 'password'),
-                                     host=conf.get('rabbitmq', 'host'),
-                                     heartbeat_interval=conf.getint('rabbitmq', 'server_heartbeat_interval'))
-conn_manager.channel.exchange_declare(exchange='pns_exchange', type='direct', durable=True)
+conn_params = get_connection_parameters(username=conf.get('rabbitmq', 'username'),
+                                        password=conf.get('rabbitmq', 'password'),
+                                        host=conf.get('rabbitmq', 'host'),
+                                        heartbeat_interval=conf.getint('rabbitmq', 'server_heartbeat_interval'))
+# connections are opened lazily by each web server worker, one channel per concurrent request
+channel_pool = PikaChannelPool(conn_params,
+                               size=get_conf_value(conf, 'rabbitmq', 'channel_pool_size', 4, 'getint'),
+                               max_retries=get_conf_value(conf, 'rabbitmq', 'publish_retries', 5, 'getint'),
+                               on_connect=lambda channel: channel.exchange_declare(exchange='pns_exchange',
+                                                                                   type='direct', durable=True))
+# `json` or `msgpack`, preprocessing workers decode messages of both formats
+content_type = MESSAGE_FORMATS[get_conf_value(conf, 'rabbitmq', 'message_format', 'json')]
+# `direct` publishes alerts within requests, `spool` appends them to a local spool drained in background
+ingestion = get_conf_value(conf, 'application', 'ingestion', 'direct')
+spool = None
+spool_lock = threading.Lock()
+
+
+def get_spool():
+    """
+    get spool of this process, started on first use so web server workers start their own after fork
+    :return: Spool object
+    """
+    global spool
+    with spool_lock:
+        if spool is None or spool.pid != os.getpid():
+            publisher = ConfirmedPublisher(conn_params, 'pns_exchange')
+            publisher.start()
+            spool = Spool(get_conf_value(conf, 'application', 'spool_dir', '/var/lib/pns/alert_spool'),
+                          publisher,
+                          max_bytes=get_conf_value(conf, 'application', 'spool_max_size', 256, 'getint') * 1048576)
+            spool.start()
+        return spool
+
+
+def enqueue(message, priority=NORMAL):
+    """
+    publish a preprocessing task to rabbitmq or append it to the spool
+    :param dict message: preprocessing task
+    :param str priority: priority lane of task
+    :return: True if task is accepted
+    :raises SpoolFull: if spool reached its size limit
+    :raises PoolTimeout: if all rabbitmq channels of this process are busy
+    """
+    routing_key = get_lane('pns_pre_processing', priority)
+    if ingestion == 'spool':
+        get_spool().put(routing_key, encode_message(message, content_type), content_type)
+        return True
+    return channel_pool.publish_message('pns_exchange', routing_key, message, content_type)
 
 
 @alert.route('/alerts', methods=['POST'])
 def notify():
     """
     @api {post} /alerts Create Alert
-    @apiVersion 3.3.0
+    @apiVersion 3.5.0
     @apiName CreateAlert
     @apiGroup Alert
 
@@ -46,6 +102,12 @@ def notify():
     @apiParam {Number=0,1} [apns.content_available=0] Provide this key with a value of 1 to indicate that new content is available
 
     @apiParam {Object} [data] Arbitrary key-value object
+    @apiParam {String="high","normal"} [priority=normal] Alerts of `high` priority (e.g. one time passwords) are
+        queued on separate lanes at every stage, so they are not delayed by broadcasts of `normal` priority
+    @apiParam {Number} [send_at] Time to send the alert (unix timestamp in seconds), alerts are sent immediately
+        if it is omitted or in the past
+    @apiParam {Number} [max_rate] Maximum number of devices per second, the audience is released to sender workers
+        gradually at this pace
 
     @apiParamExample {json} Request-Example:
         {
@@ -73,7 +135,7 @@ def notify():
     """
     json_req = request.get_json(force=True)
     try:
-        alert_schema.validate(json_req)
+        validate_alert(json_req)
     except Exception as ex:
         return jsonify(success=False, message={'error': str(ex)}), 400
     alert_obj = Alert()
@@ -88,55 +150,149 @@ def notify():
             db.session.rollback()
             app.logger.exception(ex)
             return jsonify(success=False), 500
+    message = to_builtin(alert_obj.to_dict())
+    if 'max_rate' in json_req:
+        # identifies slices of a paced alert, also if alerts are not saved
+        message['pace_id'] = uuid.uuid4().hex
+    if json_req.get('send_at', 0) > time.time():
+        # scheduled alerts are kept in database until scheduler worker releases them
+        try:
+            ScheduledTask.schedule(message, datetime.datetime.fromtimestamp(json_req['send_at']),
+                                   get_priority(json_req))
+            db.session.commit()
+        except Exception as ex:
+            db.session.rollback()
+            app.logger.exception(ex)
+            return jsonify(success=False), 500
+        return jsonify(success=True, message={'alert': alert_obj.to_dict()})
     try:
-        if conn_manager.basic_publish(exchange='pns_exchange',
-                                      routing_key='pns_pre_processing',
-                                      body=dumps(alert_obj.to_dict(), ensure_ascii=False),
-                                      mandatory=True,
-                                      properties=pika.BasicProperties(
-                                          delivery_mode=2,  # make message persistent
-                                          content_type='application/json')):
+        if enqueue(message, get_priority(json_req)):
             return jsonify(success=True, message={'alert': alert_obj.to_dict()})
         else:
             app.logger.error('failed to deliver message to rabbitmq server: %r' % alert_obj)
             return jsonify(success=False), 500
+    except (SpoolFull, PoolTimeout) as ex:
+        app.logger.error(str(ex))
+        return jsonify(success=False, message={'error': str(ex)}), 503
     except Exception as ex:
         app.logger.exception(ex)
         return jsonify(success=False), 500
 
 
+@alert.route('/alerts/batch', methods=['POST'])
+def notify_batch():
+    """
+    @api {post} /alerts/batch Create Alerts in Batch
+    @apiVersion 3.5.0
+    @apiName CreateAlerts
+    @apiGroup Alert
+
+    @apiDescription Request body is either a JSON object with an `alerts` array or a newline delimited JSON
+        (`Content-Type: application/x-ndjson`) stream with one alert object per line. Each alert object accepts
+        the same fields as `Create Alert`, but it should have `pns_id` and can not have `channel_id`, `send_at` or
+        `max_rate` (send channel and application broadcasts, scheduled and paced alerts with `Create Alert`).
+        Alerts are saved with a single statement and recipients of up to 1000 alerts are resolved together,
+        alerts with the same payload share notification chunks.
+
+    @apiParam {Array} alerts Alert object array (up to 10000 alerts)
+    @apiParamExample {json} Request-Example:
+        {
+            'alerts': [
+                {'alert': 'Your order #1234 has been shipped', 'pns_id': ['alex@example.com'], 'data': {'order': 1234}},
+                {'alert': 'Your order #1235 has been shipped', 'pns_id': ['neil@example.com'], 'data': {'order': 1235}}
+            ]
+        }
+
+    @apiSuccess {Boolean} success Request status
+    @apiSuccess {Object} message Respond payload
+    @apiSuccess {Array} message.results Per-alert results in request order. `status` is `queued` (with alert `id`
+        if alerts are saved) or `invalid` (with `error`)
+    @apiSuccess {Object} message.counts Number of alerts per `status`
+
+    """
+    try:
+        if request.mimetype == 'application/x-ndjson':
+            alerts = list(iter_ndjson(request.stream))
+        else:
+            alerts = request.get_json(force=True)['alerts']
+        if not isinstance(alerts, list):
+            raise ValueError('`alerts` should be an array')
+    except Exception as ex:
+        return jsonify(success=False, message={'error': str(ex)}), 400
+    if len(alerts) > BATCH_MAX_ALERTS:
+        return jsonify(success=False, message={'error': 'too many alerts, limit is %d' % BATCH_MAX_ALERTS}), 400
+    results = []
+    payloads = []
+    for index, json_req in enumerate(alerts):
+        try:
+            validate_alert(json_req)
+            if 'channel_id' in json_req or not json_req.get('pns_id'):
+                raise ValueError('alerts of a batch should have `pns_id` and no `channel_id`')
+            if 'send_at' in json_req or 'max_rate' in json_req:
+                raise ValueError('alerts of a batch can not have `send_at` or `max_rate`')
+        except Exception as ex:
+            results.append({'index': index, 'status': 'invalid', 'error': str(ex)})
+            continue
+        results.append({'index': index, 'status': 'queued'})
+        payloads.append(json_req)
+    alert_ids = [None] * len(payloads)
+    if payloads and conf.getboolean('application', 'save_alerts'):
+        try:
+            alert_ids = Alert.bulk_create(payloads)
+            db.session.commit()
+        except Exception as ex:
+            db.session.rollback()
+            app.logger.exception(ex)
+            return jsonify(success=False), 500
+    tasks = [{'id': alert_id, 'payload': payload} for alert_id, payload in zip(alert_ids, payloads)]
+    try:
+        for priority in PRIORITIES:
+            lane_tasks = [task for task in tasks if get_priority(task['payload']) == priority]
+            for batch in chunked(lane_tasks, BATCH_TASK_SIZE):
+                if not enqueue({'alerts': batch}, priority):
+                    app.logger.error('failed to deliver batch of %d alerts to rabbitmq server' % len(batch))
+                    return jsonify(success=False), 500
+    except (SpoolFull, PoolTimeout) as ex:
+        app.logger.error(str(ex))
+        return jsonify(success=False, message={'error': str(ex)}), 503
+    except Exception as ex:
+        app.logger.exception(ex)
+        return jsonify(success=False), 500
+    queued = iter(alert_ids)
+    counts = {}
+    for result in results:
+        if result['status'] == 'queued':
+            result['id'] = next(queued)
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+    return jsonify(success=True, message={'results': results, 'counts': counts})
+
 
 @alert.route('/alerts', methods=['GET'])
 def list_alerts():
     """
     @api {get} /alerts List Alerts
-    @apiVersion 1.0.0
+    @apiVersion 3.5.0
     @apiName ListAlerts
     @apiGroup Alert
 
     @apiParam {Number} offset=1
     @apiParam {Number} limit=20
+    @apiParam {Boolean} [count=true] Set `false` to skip counting total number of pages
+    @apiParam {String} [cursor] Use keyset pagination instead of `offset`. Send an empty `cursor` for the first
+        page and `next_cursor` of previous response for following pages
 
     @apiSuccess {Boolean} success Request status
     @apiSuccess {Object} message Respond payload
     @apiSuccess {Array} message.alerts Alert object array
-    @apiSuccess {Number} message.total_pages Total number of available pages
+    @apiSuccess {Number} message.total_pages Total number of available pages (`null` if `count=false`)
     @apiSuccess {Number} message.current_page Current page number
     @apiSuccess {Boolean} message.has_next Next page available flag
+    @apiSuccess {String} message.next_cursor Cursor of next page (only with `cursor` parameter)
 
     """
     try:
-        offset = int(request.values.get('offset', 1))
-        limit = int(request.values.get('limit', 20))
-    except ValueError:
-        offset = 1
-        limit = 20
-    query = (Alert
-             .query
-             .order_by(Alert.created_at.desc())
-             .paginate(page=offset, per_page=limit, error_out=False))
-    alerts = [alert_obj.to_dict() for alert_obj in query.items]
-    return jsonify(success=True, message={'alerts': alerts,
-                                          'total_pages': query.pages,
-                                          'current_page': offset,
-                                          'has_next': query.has_next})
+        items, message = paginate(Alert.query, Alert)
+    except ValueError as ex:
+        return jsonify(success=False, message={'error': str(ex)}), 400
+    message['alerts'] = [alert_obj.to_dict() for alert_obj in items]
+    return jsonify(success=True, message=message)
@@ -1,13 +1,44 @@
 # -*- coding: utf-8 -*-
 
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, request
+from sqlalchemy.exc import SQLAlchemyError
 from pns.app import app
 from pns.forms import CreateChannelForm
 from pns.models import db, Channel, User, Alert
-from pns.json_schemas import registration_schema
+from pns.json_schemas import validate_registration
+from pns.pagination import paginate
+from pns.serializers import jsonify
+from pns.utils import iter_ndjson, chunked
 
 
 channel = Blueprint('channel', __name__)
+# number of `pns_id` handled by a single set-based statement
+MEMBERS_BATCH_SIZE = 10000
+
+
+def get_pns_id_batches():
+    """read `pns_id` list of request either from JSON body or from newline delimited JSON stream
+    (one `pns_id` string per line) and split into batches. every `pns_id` is yielded once, a `pns_id`
+    repeated in the request (also in different batches) is skipped.
+    """
+    if request.mimetype == 'application/x-ndjson':
+        pns_id_list = iter_ndjson(request.stream)
+    else:
+        json_req = request.get_json(force=True)
+        validate_registration(json_req)
+        pns_id_list = json_req['pns_id']
+    seen = set()
+    for batch in chunked(pns_id_list, MEMBERS_BATCH_SIZE):
+        if not all(isinstance(pns_id, basestring) for pns_id in batch):
+            raise ValueError('`pns_id` elements should be string')
+        unique = []
+        for pns_id in batch:
+            pns_id = pns_id.strip()
+            if pns_id not in seen:
+                seen.add(pns_id)
+                unique.append(pns_id)
+        if unique:
+            yield unique
 
 
 @channel.route('/channels', methods=['POST'])
@@ -52,36 +83,31 @@ def create_channel():
 def list_channels():
     """
     @api {get} /channels List Channels
-    @apiVersion 1.0.0
+    @apiVersion 3.5.0
     @apiName ListChannels
     @apiGroup Channel
 
     @apiParam {Number} offset=1
     @apiParam {Number} limit=20
+    @apiParam {Boolean} [count=true] Set `false` to skip counting total number of pages
+    @apiParam {String} [cursor] Use keyset pagination instead of `offset`. Send an empty `cursor` for the first
+        page and `next_cursor` of previous response for following pages
 
     @apiSuccess {Boolean} success Request status
     @apiSuccess {Object} message Respond payload
     @apiSuccess {Array} message.channels Channel object array
-    @apiSuccess {Number} message.total_pages Total number of available pages
+    @apiSuccess {Number} message.total_pages Total number of available pages (`null` if `count=false`)
     @apiSuccess {Number} message.current_page Current page number
     @apiSuccess {Boolean} message.has_next Next page available flag
+    @apiSuccess {String} message.next_cursor Cursor of next page (only with `cursor` parameter)
 
     """
     try:
-        offset = int(request.values.get('offset', 1))
-        limit = int(request.values.get('limit', 20))
-    except ValueError:
-        offset = 1
-        limit = 20
-    query = (Channel
-             .query
-             .order_by(Channel.created_at.desc())
-             .paginate(page=offset, per_page=limit, error_out=False))
-    channels = [channel_obj.to_dict() for channel_obj in query.items]
-    return jsonify(success=True, message={'channels': channels,
-                                          'total_pages': query.pages,
-                                          'current_page': offset,
-                                          'has_next': query.has_next})
+        items, message = paginate(Channel.query, Channel)
+    except ValueError as ex:
+        return jsonify(success=False, message={'error': str(ex)}), 400
+    message['channels'] = [channel_obj.to_dict() for channel_obj in items]
+    return jsonify(success=True, message=message)
 
 
 @channel.route('/channels/<int:channel_id>', methods=['GET'])
@@ -172,10 +198,14 @@ def edit_channel(channel_id):
 def register_user(channel_id):
     """
     @api {post} /channels/:channel_id/members Subscribe to Channel
-    @apiVersion 1.0.0
+    @apiVersion 3.5.0
     @apiName RegisterUserToChannel
     @apiGroup Channel
 
+    @apiDescription Request body is either a JSON object with a `pns_id` array or a newline delimited JSON
+        (`Content-Type: application/x-ndjson`) stream with one `pns_id` string per line. All users are
+        subscribed in a single transaction.
+
     @apiParam {Array} pns_id Recipients list. Array elements correspond to `pns_id`
     @apiParamExample {json} Request-Example:
         {
@@ -185,61 +215,113 @@ def register_user(channel_id):
     @apiSuccess {Boolean} success Request status
     @apiSuccess {Object} message Respond payload
     @apiSuccess {Object} message.channel Channel object
-    @apiSuccess {Object} message.users Users object array
+    @apiSuccess {Number} message.inserted Number of new subscriptions
+    @apiSuccess {Number} message.skipped Number of users already subscribed to the channel
+    @apiSuccess {Number} message.not_found Number of unknown `pns_id`
 
     """
-    json_req = request.get_json(force=True)
+    channel_obj = Channel.query.get(channel_id)
+    if not channel_obj:
+        return jsonify(success=False, message='not found'), 404
+    requested = found = inserted = 0
     try:
-        registration_schema.validate(json_req)
+        for pns_id_list in get_pns_id_batches():
+            batch_found, batch_inserted = channel_obj.subscribe_users(pns_id_list)
+            requested += len(pns_id_list)
+            found += batch_found
+            inserted += batch_inserted
+        db.session.commit()
+    except SQLAlchemyError as ex:
+        db.session.rollback()
+        app.logger.exception(ex)
+        return jsonify(success=False), 500
     except Exception as ex:
+        db.session.rollback()
         return jsonify(success=False, message={'error': str(ex)}), 400
-    pns_id_list = [pns_id.strip() for pns_id in json_req['pns_id']]
+    return jsonify(success=True, message={'channel': channel_obj.to_dict(),
+                                          'inserted': inserted,
+                                          'skipped': found - inserted,
+                                          'not_found': requested - found})
+
+
+@channel.route('/channels/<int:channel_id>/members', methods=['DELETE'])
+def unregister_users(channel_id):
+    """
+    @api {delete} /channels/:channel_id/members Unsubscribe Users from Channel
+    @apiVersion 3.5.0
+    @apiName UnregisterUsers
+    @apiGroup Channel
+
+    @apiDescription Request body is either a JSON object with a `pns_id` array or a newline delimited JSON
+        (`Content-Type: application/x-ndjson`) stream with one `pns_id` string per line. All users are
+        unsubscribed in a single transaction.
+
+    @apiParam {Array} pns_id Users list. Array elements correspond to `pns_id`
+
+    @apiSuccess {Boolean} success Request status
+    @apiSuccess {Object} message Respond payload
+    @apiSuccess {Object} message.channel Channel object
+    @apiSuccess {Number} message.deleted Number of removed subscriptions
+    @apiSuccess {Number} message.skipped Number of users not subscribed to the channel
+    @apiSuccess {Number} message.not_found Number of unknown `pns_id`
+
+    """
     channel_obj = Channel.query.get(channel_id)
     if not channel_obj:
         return jsonify(success=False, message='not found'), 404
-    users = User.query.filter(User.pns_id.in_(pns_id_list)).all()
-    for user in users:
-        channel_obj.subscribe_user(user)
+    requested = found = deleted = 0
+    try:
+        for pns_id_list in get_pns_id_batches():
+            batch_found, batch_deleted = channel_obj.unsubscribe_users(pns_id_list)
+            requested += len(pns_id_list)
+            found += batch_found
+            deleted += batch_deleted
+        db.session.commit()
+    except SQLAlchemyError as ex:
+        db.session.rollback()
+        app.logger.exception(ex)
+        return jsonify(success=False), 500
+    except Exception as ex:
+        db.session.rollback()
+        return jsonify(success=False, message={'error': str(ex)}), 400
     return jsonify(success=True, message={'channel': channel_obj.to_dict(),
-                                          'users': [user.to_dict() for user in users]})
+                                          'deleted': deleted,
+                                          'skipped': found - deleted,
+                                          'not_found': requested - found})
 
 
 @channel.route('/channels/<int:channel_id>/members', methods=['GET'])
 def list_channel_members(channel_id):
     """
     @api {get} /channels/:channel_id/members List Channel Members
-    @apiVersion 1.0.0
+    @apiVersion 3.5.0
     @apiName GetChannelMembers
     @apiGroup Channel
 
     @apiParam {Number} offset=1
     @apiParam {Number} limit=20
+    @apiParam {Boolean} [count=true] Set `false` to skip counting total number of pages
+    @apiParam {String} [cursor] Use keyset pagination instead of `offset`. Send an empty `cursor` for the first
+        page and `next_cursor` of previous response for following pages
 
     @apiSuccess {Boolean} success Request status
     @apiSuccess {Object} message Respond payload
     @apiSuccess {Array} message.users User object array
-    @apiSuccess {Number} message.total_pages Total number of available pages
+    @apiSuccess {Number} message.total_pages Total number of available pages (`null` if `count=false`)
     @apiSuccess {Number} message.current_page Current page number
     @apiSuccess {Boolean} message.has_next Next page available flag
+    @apiSuccess {String} message.next_cursor Cursor of next page (only with `cursor` parameter)
 
     """
-    try:
-        offset = int(request.values.get('offset', 1))
-        limit = int(request.values.get('limit', 20))
-    except ValueError:
-        offset = 1
-        limit = 20
     channel_obj = Channel.query.get(channel_id)
     if not channel_obj:
         return jsonify(success=False, message='not found'), 404
-    query = (channel_obj
-             .subscribers
-             .paginate(page=offset, per_page=limit, error_out=False))
-    users = [user.to_dict() for user in query.items]
-    return jsonify(success=True, message={'users': users,
-                                          'total_pages': query.pages,
-                                          'current_page': offset,
-                                          'has_next': query.has_next})
+    try:
+        items, message = paginate(channel_obj.subscribers, User)
+    except ValueError as ex:
+        return jsonify(success=False, message={'error': str(ex)}), 400
+    message['users'] = [user.to_dict() for user in items]
+    return jsonify(success=True, message=message)
 
 
 @channel.route('/channels/<int:channel_id>/members/<pns_id>', methods=['DELETE'])
@@ -271,36 +353,31 @@ def unregister_user(channel_id, pns_id):
 def list_channel_alerts(channel_id):
     """
     @api {get} /channels/:channel_id/alerts List Channel Alerts
-    @apiVersion 1.0.0
+    @apiVersion 3.5.0
     @apiName GetChannelAlerts
     @apiGroup Channel
 
     @apiParam {Number} offset=1
     @apiParam {Number} limit=20
+    @apiParam {Boolean} [count=true] Set `false` to skip counting total number of pages
+    @apiParam {String} [cursor] Use keyset pagination instead of `offset`. Send an empty `cursor` for the first
+        page and `next_cursor` of previous response for following pages
 
     @apiSuccess {Boolean} success Request status
     @apiSuccess {Object} message Respond payload
     @apiSuccess {Array} message.users User object array
-    @apiSuccess {Number} message.total_pages Total number of available pages
+    @apiSuccess {Number} message.total_pages Total number of available pages (`null` if `count=false`)
     @apiSuccess {Number} message.current_page Current page number
     @apiSuccess {Boolean} message.has_next Next page available flag
+    @apiSuccess {String} message.next_cursor Cursor of next page (only with `cursor` parameter)
 
     """
-    try:
-        offset = int(request.values.get('offset', 1))
-        limit = int(request.values.get('limit', 20))
-    except ValueError:
-        offset = 1
-        limit = 20
     channel_obj = Channel.query.get(channel_id)
     if not channel_obj:
         return jsonify(success=False, message='not found'), 404
-    query = (channel_obj
-             .alerts
-             .order_by(Alert.created_at.desc())
-             .paginate(page=offset, per_page=limit, error_out=False))
-    alerts = [alert.to_dict() for alert in query.items]
-    return jsonify(success=True, message={'alerts': alerts,
-                                          'total_pages': query.pages,
-                                          'current_page': offset,
-                                          'has_next': query.has_next})
+    try:
+        items, message = paginate(channel_obj.alerts, Alert)
+    except ValueError as ex:
+        return jsonify(success=False, message={'error': str(ex)}), 400
+    message['alerts'] = [alert.to_dict() for alert in items]
+    return jsonify(success=True, message=message)
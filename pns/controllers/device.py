@@ -1,13 +1,19 @@
 # -*- coding: utf-8 -*-
 
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request
 from pns.app import app
-from pns.models import db, User, Device
+from pns.models import db, User, Device, Channel
 from pns.forms import CreateDeviceForm, UpdateDevice
+from pns.json_schemas import validate_device
+from pns.pagination import paginate
+from pns.serializers import jsonify
+from pns.utils import iter_ndjson
 
 
 device = Blueprint('device', __name__)
 PLATFORMS = ['gcm', 'apns']
+# maximum number of rows accepted by a single bulk registration request
+BULK_MAX_ROWS = 10000
 
 
 @device.route('/devices/<int:device_id>', methods=['GET'])
@@ -33,36 +39,31 @@ def get_device(device_id):
 def list_devices():
     """
     @api {get} /devices List Devices
-    @apiVersion 1.0.0
+    @apiVersion 3.5.0
     @apiName ListDevices
     @apiGroup Device
 
     @apiParam {Number} offset=1
     @apiParam {Number} limit=20
+    @apiParam {Boolean} [count=true] Set `false` to skip counting total number of pages
+    @apiParam {String} [cursor] Use keyset pagination instead of `offset`. Send an empty `cursor` for the first
+        page and `next_cursor` of previous response for following pages
 
     @apiSuccess {Boolean} success Request status
     @apiSuccess {Object} message Respond payload
     @apiSuccess {Array} message.devices Device object array
-    @apiSuccess {Number} message.total_pages Total number of available pages
+    @apiSuccess {Number} message.total_pages Total number of available pages (`null` if `count=false`)
     @apiSuccess {Number} message.current_page Current page number
     @apiSuccess {Boolean} message.has_next Next page available flag
+    @apiSuccess {String} message.next_cursor Cursor of next page (only with `cursor` parameter)
 
     """
     try:
-        offset = int(request.values.get('offset', 1))
-        limit = int(request.values.get('limit', 20))
-    except ValueError:
-        offset = 1
-        limit = 20
-    query = (Device
-             .query
-             .order_by(Device.created_at.desc())
-             .paginate(page=offset, per_page=limit, error_out=False))
-    devices = [device_obj.to_dict() for device_obj in query.items]
-    return jsonify(success=True, message={'devices': devices,
-                                          'total_pages': query.pages,
-                                          'current_page': offset,
-                                          'has_next': query.has_next})
+        items, message = paginate(Device.query, Device)
+    except ValueError as ex:
+        return jsonify(success=False, message={'error': str(ex)}), 400
+    message['devices'] = [device_obj.to_dict() for device_obj in items]
+    return jsonify(success=True, message=message)
 
 
 @device.route('/devices', methods=['POST'])
@@ -104,8 +105,13 @@ def create_device():
         device_obj = Device.query.filter_by(platform_id=platform_id).first()
         new_record = False
         if not device_obj:
+            # audiences are invalidated when new device is subscribed to channels
             new_record = True
             device_obj = Device()
+        elif ((device_obj.user_id, device_obj.platform, device_obj.mobile_app_id, device_obj.mobile_app_ver) !=
+              (user_obj.id, platform, mobile_app_id, mobile_app_ver)):
+            # device may be moved from another user or its application may be updated
+            Channel.invalidate_audiences(user_ids=[device_obj.user_id, user_obj.id])
         device_obj.platform = platform
         device_obj.platform_id = platform_id
         device_obj.mobile_app_id = mobile_app_id
@@ -125,6 +131,90 @@ def create_device():
         return jsonify(success=False, message=form.errors), 400
 
 
+@device.route('/devices/bulk', methods=['POST'])
+def create_devices():
+    """
+    @api {post} /devices/bulk Create Devices in Bulk
+    @apiVersion 3.5.0
+    @apiName CreateDevices
+    @apiGroup Device
+
+    @apiDescription Request body is either a JSON object with a `devices` array or a newline delimited JSON
+        (`Content-Type: application/x-ndjson`) stream with one device object per line. Each device object
+        accepts the same fields as `Create Device`. Users are resolved with a single query and devices are
+        upserted by `platform_id`, so replaying the same rows is safe.
+
+    @apiParam {Array} devices Device object array (up to 10000 rows)
+    @apiParamExample {json} Request-Example:
+        {
+            'devices': [
+                {'pns_id': 'alex@example.com', 'platform': 'gcm', 'platform_id': 'token1', 'appid': 'com.example', 'appver': 12},
+                {'pns_id': 'neil@example.com', 'platform': 'apns', 'platform_id': 'token2'}
+            ]
+        }
+
+    @apiSuccess {Boolean} success Request status
+    @apiSuccess {Object} message Respond payload
+    @apiSuccess {Array} message.results Per-row results in request order. `status` is one of
+        `created`, `updated`, `not_found` (unknown `pns_id`), `duplicate` (`platform_id` repeated later
+        in the same request) or `invalid`
+    @apiSuccess {Object} message.counts Number of rows per `status`
+
+    """
+    try:
+        if request.mimetype == 'application/x-ndjson':
+            devices = list(iter_ndjson(request.stream))
+        else:
+            devices = request.get_json(force=True)['devices']
+        if not isinstance(devices, list):
+            raise ValueError('`devices` should be an array')
+    except Exception as ex:
+        return jsonify(success=False, message={'error': str(ex)}), 400
+    if len(devices) > BULK_MAX_ROWS:
+        return jsonify(success=False, message={'error': 'too many rows, limit is %d' % BULK_MAX_ROWS}), 400
+    results = []
+    rows = {}
+    for index, device_req in enumerate(devices):
+        try:
+            validate_device(device_req)
+        except Exception as ex:
+            results.append({'index': index, 'status': 'invalid', 'error': str(ex)})
+            continue
+        platform_id = device_req['platform_id']
+        if platform_id in rows:
+            # last occurrence wins like sequential single registrations would do
+            results[rows[platform_id]['index']]['status'] = 'duplicate'
+        results.append({'index': index, 'platform_id': platform_id})
+        rows[platform_id] = {'index': index,
+                             'pns_id': device_req['pns_id'],
+                             'platform': device_req['platform'].lower(),
+                             'platform_id': platform_id,
+                             'mobile_app_id': device_req.get('appid'),
+                             'mobile_app_ver': device_req.get('appver')}
+    user_ids = User.get_ids([row['pns_id'] for row in rows.values()])
+    upsert_rows = []
+    for row in rows.values():
+        if row['pns_id'] in user_ids:
+            row['user_id'] = user_ids[row['pns_id']]
+            upsert_rows.append(row)
+        else:
+            results[row['index']]['status'] = 'not_found'
+    try:
+        upserted = Device.bulk_upsert(upsert_rows)
+        db.session.commit()
+    except Exception as ex:
+        db.session.rollback()
+        app.logger.exception(ex)
+        return jsonify(success=False), 500
+    for row in upsert_rows:
+        device_id, created = upserted[row['platform_id']]
+        results[row['index']].update(device_id=device_id, status='created' if created else 'updated')
+    counts = {}
+    for result in results:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+    return jsonify(success=True, message={'results': results, 'counts': counts})
+
+
 @device.route('/devices/<int:device_id>', methods=['DELETE'])
 def delete_device(device_id):
     """
@@ -141,6 +231,7 @@ def delete_device(device_id):
     device_obj = Device.query.get(device_id)
     if not device_obj:
         return jsonify(success=False, message='not found'), 404
+    Channel.invalidate_audiences(user_ids=[device_obj.user_id])
     db.session.delete(device_obj)
     try:
         db.session.commit()
@@ -172,7 +263,9 @@ def mute_device(device_id):
     device_obj = Device.query.get(device_id)
     if not device_obj:
         return jsonify(success=False, message='not found'), 404
-    device_obj.mute = form.mute.data
+    if device_obj.mute != form.mute.data:
+        device_obj.mute = form.mute.data
+        Channel.invalidate_audiences(user_ids=[device_obj.user_id])
     db.session.add(device_obj)
     try:
         db.session.commit()
@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 
-from flask import Blueprint, jsonify
+from flask import Blueprint
 from pns.app import __version__
+from pns.serializers import jsonify
 
 
 main = Blueprint('main', __name__)
@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request
 from pns.app import app
 from pns.forms import CreateUserForm
-from pns.models import db, User
+from pns.models import db, User, Channel
+from pns.pagination import paginate
+from pns.serializers import jsonify
 
 
 user = Blueprint('user', __name__)
@@ -13,36 +15,31 @@ user = Blueprint('user', __name__)
 def list_users():
     """
     @api {get} /users List Users
-    @apiVersion 1.0.0
+    @apiVersion 3.5.0
     @apiName ListUsers
     @apiGroup User
 
     @apiParam {Number} offset=1
     @apiParam {Number} limit=20
+    @apiParam {Boolean} [count=true] Set `false` to skip counting total number of pages
+    @apiParam {String} [cursor] Use keyset pagination instead of `offset`. Send an empty `cursor` for the first
+        page and `next_cursor` of previous response for following pages
 
     @apiSuccess {Boolean} success Request status
     @apiSuccess {Object} message Respond payload
     @apiSuccess {Array} message.users User object array
-    @apiSuccess {Number} message.total_pages Total number of available pages
+    @apiSuccess {Number} message.total_pages Total number of available pages (`null` if `count=false`)
     @apiSuccess {Number} message.current_page Current page number
     @apiSuccess {Boolean} message.has_next Next page available flag
+    @apiSuccess {String} message.next_cursor Cursor of next page (only with `cursor` parameter)
 
     """
     try:
-        offset = int(request.values.get('offset', 1))
-        limit = int(request.values.get('limit', 20))
-    except ValueError:
-        offset = 1
-        limit = 20
-    query = (User
-             .query
-             .order_by(User.created_at.desc())
-             .paginate(page=offset, per_page=limit, error_out=False))
-    users = [user_obj.to_dict() for user_obj in query.items]
-    return jsonify(success=True, message={'users': users,
-                                          'total_pages': query.pages,
-                                          'current_page': offset,
-                                          'has_next': query.has_next})
+        items, message = paginate(User.query, User)
+    except ValueError as ex:
+        return jsonify(success=False, message={'error': str(ex)}), 400
+    message['users'] = [user_obj.to_dict() for user_obj in items]
+    return jsonify(success=True, message=message)
 
 
 @user.route('/users', methods=['POST'])
@@ -97,6 +94,7 @@ def delete_user(pns_id):
     user_obj = User.query.filter_by(pns_id=pns_id).first()
     if not user_obj:
         return jsonify(success=False, message='not found'), 404
+    Channel.invalidate_audiences(user_ids=[user_obj.id])
     db.session.delete(user_obj)
     try:
         db.session.commit()
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
-from schema import Schema, And, Optional
+from schema import Schema, And, Or, Optional
+from pns.validators import compile_schema
 
 # validate structure of JSON request for `alert` creation
 alert_schema = Schema({
@@ -19,8 +20,25 @@ alert_schema = Schema({
         Optional("badge"): And(int, lambda x: x >= 0),
         Optional("content_available"): And(int, lambda x: x in [0, 1])
     },
-    Optional("data"): dict
+    Optional("data"): dict,
+    Optional("priority"): And(unicode, lambda x: x in ["high", "normal"]),
+    Optional("send_at"): And(int, lambda x: x > 0),
+    Optional("max_rate"): And(int, lambda x: x > 0)
 })
 
 # validate structure of JSON request for `user` registration to a `channel`
 registration_schema = Schema({"pns_id": [unicode]})
+
+# validate structure of a single row in bulk `device` registration
+device_schema = Schema({
+    "pns_id": And(unicode, len),
+    "platform": And(unicode, lambda x: x.lower() in ["gcm", "apns"]),
+    "platform_id": And(unicode, len),
+    Optional("appid"): Or(None, And(unicode, len)),
+    Optional("appver"): Or(None, And(int, lambda x: x > 0))
+})
+
+# precompiled validators, raising the same errors as `validate` of the schemas above
+validate_alert = compile_schema(alert_schema)
+validate_registration = compile_schema(registration_schema)
+validate_device = compile_schema(device_schema)
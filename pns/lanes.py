@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+from pns.utils import get_conf_value
+
+
+# priority lanes of alerts; `normal` alerts use the original queues at every stage, `high` priority
+# alerts use queues and routing keys of the same names with `_high` suffix
+HIGH = 'high'
+NORMAL = 'normal'
+PRIORITIES = [HIGH, NORMAL]
+
+
+def get_priority(payload):
+    """
+    :param dict payload: alert payload
+    :return: priority lane of alert
+    """
+    return HIGH if payload.get('priority') == HIGH else NORMAL
+
+
+def get_lane(name, priority):
+    """
+    :param str name: queue name or routing key of normal lane
+    :param str priority: `high` or `normal`
+    :return: queue name or routing key of the lane
+    """
+    return '%s_high' % name if priority == HIGH else name
+
+
+def get_lane_weights(conf, queue):
+    """
+    :param conf: ConfigParser object
+    :param str queue: queue name of normal lane
+    :return: dict of queue names of both lanes to their consumption weights
+    """
+    return {get_lane(queue, HIGH): get_conf_value(conf, 'rabbitmq', 'high_priority_weight', 4, 'getint'),
+            get_lane(queue, NORMAL): 1}
@@ -1,9 +1,19 @@
 # -*- coding: utf-8 -*-
 
 import datetime
-from sqlalchemy import UniqueConstraint
-from sqlalchemy.dialects.postgresql import JSONB
-from pns.app import app, db
+from sqlalchemy import UniqueConstraint, Index, text, select
+from sqlalchemy.dialects.postgresql import JSONB, ARRAY
+from pns.app import app, db, conf
+from pns.utils import get_conf_value
+from pns.serializers import dumps
+
+
+# audience of channel alerts is resolved either from the denormalized `channel_devices` table
+# (maintained on every subscription and device registration) or by joining `subscriptions` to
+# `device` through `user_id` at sending time
+AUDIENCE_CHANNEL_DEVICES = 'channel_devices'
+AUDIENCE_SUBSCRIPTIONS = 'subscriptions'
+audience_resolver = get_conf_value(conf, 'application', 'audience_resolver', AUDIENCE_CHANNEL_DEVICES)
 
 
 class SerializationMixin():
@@ -23,7 +33,8 @@ class SerializationMixin():
 subscriptions = db.Table('subscriptions',
                          db.Column('user_id', db.Integer, db.ForeignKey('user.id'), nullable=False),
                          db.Column('channel_id', db.Integer, db.ForeignKey('channel.id'), nullable=False),
-                         UniqueConstraint('user_id', 'channel_id'))
+                         UniqueConstraint('user_id', 'channel_id'),
+                         Index('ix_subscriptions_channel_id_user_id', 'channel_id', 'user_id'))
 
 
 channel_devices = db.Table('channel_devices',
@@ -44,8 +55,23 @@ class User(db.Model, SerializationMixin):
                                     backref=db.backref('subscribers', lazy='dynamic'))
     devices = db.relationship('Device', backref='user', lazy='dynamic',
                               cascade='all, delete, delete-orphan')
-    created_at = db.Column(db.DateTime, default=datetime.datetime.now)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.now, server_default=text('now()'))
     updated_at = db.Column(db.DateTime, onupdate=datetime.datetime.now)
+    # supports keyset pagination in descending (created_at, id) order
+    __table_args__ = (Index('ix_user_created_at_id', 'created_at', 'id'),)
+
+    @staticmethod
+    def get_ids(pns_id_list):
+        """resolve a list of `pns_id` with a single query
+        :param list pns_id_list: list of `pns_id`
+        :return: dict of `pns_id` to user id
+        """
+        if not pns_id_list:
+            return {}
+        return dict(db.session
+                    .query(User.pns_id, User.id)
+                    .filter(User.pns_id.in_(set(pns_id_list)))
+                    .all())
 
     def __repr__(self):
         return '<User %r>' % self.id
@@ -63,15 +89,16 @@ class Channel(db.Model, SerializationMixin):
                               backref=db.backref('channels', lazy='dynamic'))
     alerts = db.relationship('Alert', backref='channel', lazy='dynamic',
                              cascade='all, delete, delete-orphan')
-    created_at = db.Column(db.DateTime, default=datetime.datetime.now)
+    # incremented whenever the audience of the channel changes, invalidates cached audiences of workers
+    audience_version = db.Column(db.Integer, nullable=False, server_default='0')
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.now, server_default=text('now()'))
     updated_at = db.Column(db.DateTime, onupdate=datetime.datetime.now)
+    # supports keyset pagination in descending (created_at, id) order
+    __table_args__ = (Index('ix_channel_created_at_id', 'created_at', 'id'),)
 
     def subscribe_user(self, user):
         try:
-            self.subscribers.append(user)
-            for device in user.devices.all():
-                self.devices.append(device)
-            db.session.add(self)
+            self.subscribe_users([user.pns_id])
             db.session.commit()
         except Exception as ex:
             db.session.rollback()
@@ -81,9 +108,7 @@ class Channel(db.Model, SerializationMixin):
 
     def unsubscribe_user(self, user):
         try:
-            self.subscribers.remove(user)
-            for device in user.devices.all():
-                self.devices.remove(device)
+            self.unsubscribe_users([user.pns_id])
             db.session.commit()
         except Exception as ex:
             db.session.rollback()
@@ -91,6 +116,110 @@ class Channel(db.Model, SerializationMixin):
             return False
         return True
 
+    def subscribe_users(self, pns_id_list):
+        """subscribe users and their devices to the channel with a single set-based statement.
+        caller is responsible for commit.
+        :param list pns_id_list: list of `pns_id`
+        :return: tuple of (number of users found, number of new subscriptions)
+        """
+        channel_devices_sql = ''
+        if audience_resolver == AUDIENCE_CHANNEL_DEVICES:
+            channel_devices_sql = (', dev AS (INSERT INTO channel_devices (channel_id, device_id) '
+                                   '        SELECT :channel_id, d.id FROM device d JOIN ins ON ins.user_id = d.user_id '
+                                   '        ON CONFLICT DO NOTHING) ')
+        result = db.session.execute(
+            text('WITH u AS (SELECT id FROM "user" WHERE pns_id = ANY(:pns_ids)), '
+                 'ins AS (INSERT INTO subscriptions (user_id, channel_id) '
+                 '        SELECT id, :channel_id FROM u '
+                 '        ON CONFLICT DO NOTHING '
+                 '        RETURNING user_id) ' +
+                 channel_devices_sql +
+                 'SELECT (SELECT count(*) FROM u), (SELECT count(*) FROM ins)'),
+            {'pns_ids': list(set(pns_id_list)), 'channel_id': self.id}).first()
+        if result[1]:
+            Channel.invalidate_audiences(channel_ids=[self.id])
+        return result
+
+    def unsubscribe_users(self, pns_id_list):
+        """unsubscribe users and their devices from the channel with a single set-based statement.
+        caller is responsible for commit.
+        :param list pns_id_list: list of `pns_id`
+        :return: tuple of (number of users found, number of removed subscriptions)
+        """
+        channel_devices_sql = ''
+        if audience_resolver == AUDIENCE_CHANNEL_DEVICES:
+            channel_devices_sql = (', dev AS (DELETE FROM channel_devices cd USING device d, del '
+                                   '        WHERE cd.channel_id = :channel_id AND cd.device_id = d.id '
+                                   '          AND d.user_id = del.user_id) ')
+        result = db.session.execute(
+            text('WITH u AS (SELECT id FROM "user" WHERE pns_id = ANY(:pns_ids)), '
+                 'del AS (DELETE FROM subscriptions s USING u '
+                 '        WHERE s.user_id = u.id AND s.channel_id = :channel_id '
+                 '        RETURNING s.user_id) ' +
+                 channel_devices_sql +
+                 'SELECT (SELECT count(*) FROM u), (SELECT count(*) FROM del)'),
+            {'pns_ids': list(set(pns_id_list)), 'channel_id': self.id}).first()
+        if result[1]:
+            Channel.invalidate_audiences(channel_ids=[self.id])
+        return result
+
+    @staticmethod
+    def get_devices_query(channel_id):
+        """query of devices subscribed to a channel according to `audience_resolver` setting
+        :param int channel_id: ID of the channel
+        """
+        if audience_resolver == AUDIENCE_SUBSCRIPTIONS:
+            return (Device
+                    .query
+                    .join(subscriptions, subscriptions.c.user_id == Device.user_id)
+                    .filter(subscriptions.c.channel_id == channel_id))
+        return (Device
+                .query
+                .join(channel_devices, channel_devices.c.device_id == Device.id)
+                .filter(channel_devices.c.channel_id == channel_id))
+
+    @staticmethod
+    def get_audience_filter(channel_id):
+        """filter criterion of devices subscribed to a channel according to `audience_resolver`
+        setting, as a semi-join to be combined with other audience sources
+        :param int channel_id: ID of the channel
+        """
+        if audience_resolver == AUDIENCE_SUBSCRIPTIONS:
+            return Device.user_id.in_(select([subscriptions.c.user_id])
+                                      .where(subscriptions.c.channel_id == channel_id))
+        return Device.id.in_(select([channel_devices.c.device_id])
+                             .where(channel_devices.c.channel_id == channel_id))
+
+    @staticmethod
+    def invalidate_audiences(channel_ids=None, user_ids=None):
+        """increment `audience_version` of channels given directly or subscribed by users. channel rows
+        are locked until commit, so call it only when an audience really changes. caller is responsible
+        for commit.
+        :param list channel_ids: list of channel IDs
+        :param list user_ids: list of user IDs
+        """
+        if channel_ids:
+            subquery = 'SELECT id FROM channel WHERE id = ANY(:ids)'
+            ids = list(set(channel_ids))
+        elif user_ids:
+            subquery = 'SELECT channel_id FROM subscriptions WHERE user_id = ANY(:ids)'
+            ids = list(set(user_ids))
+        else:
+            return
+        # rows are locked in id order to avoid deadlocks between concurrent writers
+        db.session.execute(
+            text('UPDATE channel SET audience_version = audience_version + 1 '
+                 'WHERE id IN (SELECT id FROM channel WHERE id IN (' + subquery + ') ORDER BY id FOR UPDATE)'),
+            {'ids': ids})
+
+    @staticmethod
+    def get_audience_version(channel_id):
+        """
+        :param int channel_id: ID of the channel
+        :return: current `audience_version` or None if channel does not exist
+        """
+        return db.session.query(Channel.audience_version).filter(Channel.id == channel_id).scalar()
+
     def __repr__(self):
         return '<Channel %r>' % self.id
 
@@ -101,13 +230,150 @@ class Alert(db.Model, SerializationMixin):
     id = db.Column(db.Integer, primary_key=True)
     channel_id = db.Column(db.Integer, db.ForeignKey('channel.id'), index=True)
     payload = db.Column(JSONB, nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.datetime.now)
+    # large audiences are resolved in shards (device id ranges) by several preprocessing workers,
+    # alert is completed when every shard is published
+    shards_total = db.Column(db.Integer, nullable=False, server_default='1')
+    completed_shards = db.Column(ARRAY(db.Integer), nullable=False, server_default='{}')
+    completed_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.now, server_default=text('now()'))
     updated_at = db.Column(db.DateTime, onupdate=datetime.datetime.now)
+    # supports keyset pagination in descending (created_at, id) order
+    __table_args__ = (Index('ix_alert_created_at_id', 'created_at', 'id'),
+                      Index('ix_alert_channel_id_created_at_id', 'channel_id', 'created_at', 'id'))
+
+    @staticmethod
+    def start_shards(alert_id, shards_total):
+        """record number of shards of an alert. caller is responsible for commit.
+        :param int alert_id: ID of the alert
+        :param int shards_total: number of shards
+        """
+        db.session.execute(
+            text('UPDATE alert SET shards_total = :shards_total WHERE id = :alert_id'),
+            {'alert_id': alert_id, 'shards_total': shards_total})
+
+    @staticmethod
+    def complete_shard(alert_id, index=0):
+        """mark a shard of an alert completed, alerts resolved without sharding have a single
+        shard with index 0. completing a shard again (redelivered sub-task) has no effect.
+        caller is responsible for commit.
+        :param int alert_id: ID of the alert
+        :param int index: index of the shard
+        :return: tuple of (number of completed shards, number of shards) or None if the shard was
+            already completed
+        """
+        return db.session.execute(
+            text('UPDATE alert '
+                 'SET completed_shards = array_append(completed_shards, :index), '
+                 '    completed_at = CASE WHEN cardinality(completed_shards) + 1 >= shards_total '
+                 '                        THEN :now ELSE completed_at END '
+                 'WHERE id = :alert_id AND NOT (:index = ANY(completed_shards)) '
+                 'RETURNING cardinality(completed_shards), shards_total'),
+            {'alert_id': alert_id, 'index': index, 'now': datetime.datetime.now()}).first()
+
+    @staticmethod
+    def bulk_create(payloads):
+        """insert alerts with a single statement. ids are allocated from the sequence in advance,
+        so they are matched to payloads regardless of insertion order. caller is responsible for commit.
+        :param list payloads: alert payloads
+        :return: list of alert ids in order of payloads
+        """
+        if not payloads:
+            return []
+        alert_ids = [alert_id for alert_id, in db.session.execute(
+            text("SELECT nextval('alert_id_seq') FROM generate_series(1, :n)"), {'n': len(payloads)})]
+        db.session.execute(
+            text('INSERT INTO alert (id, payload, created_at) '
+                 'SELECT id, payload, :now '
+                 'FROM unnest(CAST(:alert_ids AS integer[]), CAST(:payloads AS jsonb[])) AS t (id, payload)'),
+            {'alert_ids': alert_ids, 'payloads': [dumps(payload) for payload in payloads],
+             'now': datetime.datetime.now()})
+        return alert_ids
+
+    @staticmethod
+    def complete_alerts(alert_ids):
+        """mark alerts resolved without sharding completed at once. caller is responsible for commit.
+        :param list alert_ids: IDs of the alerts
+        :return: number of completed alerts
+        """
+        if not alert_ids:
+            return 0
+        return db.session.execute(
+            text('UPDATE alert SET completed_shards = ARRAY[0], completed_at = :now '
+                 'WHERE id = ANY(:alert_ids) AND completed_at IS NULL'),
+            {'alert_ids': alert_ids, 'now': datetime.datetime.now()}).rowcount
 
     def __repr__(self):
         return '<Alert %r>' % self.id
 
 
+class ScheduledTask(db.Model, SerializationMixin):
+    """preprocessing task waiting for its time; scheduled alerts and remaining slices of paced alerts
+    are kept in database until scheduler worker releases them to preprocessing queue. released tasks
+    are kept until they are purged, so their keys still reject continuations scheduled again.
+    """
+    __tablename__ = 'scheduled_task'
+    id = db.Column(db.Integer, primary_key=True)
+    # identifies continuations of paced alerts, a slice scheduled again (redelivered task) is ignored
+    key = db.Column(db.String(255), unique=True)
+    priority = db.Column(db.String(10), nullable=False)
+    message = db.Column(JSONB, nullable=False)
+    send_at = db.Column(db.DateTime, nullable=False)
+    released_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.now)
+    # supports polling of tasks waiting for release
+    __table_args__ = (Index('ix_scheduled_task_send_at', 'send_at', postgresql_where=text('released_at IS NULL')),)
+
+    @staticmethod
+    def schedule(message, send_at, priority, key=None):
+        """save a preprocessing task to be released at `send_at`. caller is responsible for commit.
+        :param dict message: preprocessing task
+        :param datetime.datetime send_at: release time
+        :param str priority: priority lane of task
+        :param str key: unique key of task, None for tasks which are never scheduled twice
+        :return: True if task is saved, False if a task with the same key exists
+        """
+        return db.session.execute(
+            text('INSERT INTO scheduled_task (key, priority, message, send_at, created_at) '
+                 'VALUES (:key, :priority, CAST(:message AS jsonb), :send_at, :now) '
+                 'ON CONFLICT (key) DO NOTHING'),
+            {'key': key, 'priority': priority, 'message': dumps(message), 'send_at': send_at,
+             'now': datetime.datetime.now()}).rowcount > 0
+
+    @staticmethod
+    def lock_due(limit):
+        """lock tasks whose time has come, skipping tasks locked by other schedulers. tasks are marked
+        released with `release` and committing, rolling back unlocks them for the next poll.
+        :param int limit: maximum number of tasks
+        :return: list of (id, priority, message) tuples, oldest `send_at` first
+        """
+        return db.session.execute(
+            text('SELECT id, priority, message FROM scheduled_task '
+                 'WHERE send_at <= :now AND released_at IS NULL ORDER BY send_at LIMIT :limit '
+                 'FOR UPDATE SKIP LOCKED'),
+            {'now': datetime.datetime.now(), 'limit': limit}).fetchall()
+
+    @staticmethod
+    def release(task_ids):
+        """mark tasks released. caller is responsible for commit.
+        :param list task_ids: IDs of the tasks
+        """
+        if task_ids:
+            db.session.execute(text('UPDATE scheduled_task SET released_at = :now WHERE id = ANY(:task_ids)'),
+                               {'task_ids': task_ids, 'now': datetime.datetime.now()})
+
+    @staticmethod
+    def purge(released_before):
+        """delete tasks released before a given time. caller is responsible for commit.
+        :param datetime.datetime released_before: release time of the newest task to delete
+        :return: number of deleted tasks
+        """
+        return db.session.execute(text('DELETE FROM scheduled_task WHERE released_at < :released_before'),
+                                  {'released_before': released_before}).rowcount
+
+    def __repr__(self):
+        return '<ScheduledTask %r>' % self.id
+
+
 class Device(db.Model, SerializationMixin):
     """device resource
     """
@@ -118,15 +384,41 @@ class Device(db.Model, SerializationMixin):
     mobile_app_id = db.Column(db.Text, index=True)
     mobile_app_ver = db.Column(db.Integer, index=True)
     mute = db.Column(db.Boolean, default=False, nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.datetime.now)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.now, server_default=text('now()'))
     updated_at = db.Column(db.DateTime, onupdate=datetime.datetime.now)
+    # covering indexes for audience resolution, `platform_id` is included for index-only scans
+    __table_args__ = (Index('ix_device_user_audience',
+                            'user_id', 'platform', 'mute', 'mobile_app_id', 'mobile_app_ver', 'platform_id'),
+                      Index('ix_device_platform_audience',
+                            'platform', 'mute', 'mobile_app_id', 'mobile_app_ver', 'platform_id'),
+                      # supports keyset pagination in descending (created_at, id) order
+                      Index('ix_device_created_at_id', 'created_at', 'id'))
+
+    @staticmethod
+    def get_devices_of_users(pns_id_list, platforms):
+        """resolve devices of many users with a single query
+        :param list pns_id_list: list of `pns_id`
+        :param list platforms: platforms to include
+        :return: list of (pns_id, platform, platform_id, mobile_app_id, mobile_app_ver) tuples of
+            devices which are not muted
+        """
+        if not pns_id_list or not platforms:
+            return []
+        return db.session.execute(
+            text('SELECT u.pns_id, d.platform, d.platform_id, d.mobile_app_id, d.mobile_app_ver '
+                 'FROM device d JOIN "user" u ON u.id = d.user_id '
+                 'WHERE u.pns_id = ANY(:pns_id_list) AND d.platform = ANY(:platforms) AND NOT d.mute'),
+            {'pns_id_list': list(pns_id_list), 'platforms': platforms}).fetchall()
 
     def subscribe_to_channels(self):
-        """subscribe new device to existing channels
+        """subscribe new device to existing channels and invalidate their audiences
         """
         try:
-            for channel in self.user.subscriptions.all():
-                channel.devices.append(self)
+            if audience_resolver == AUDIENCE_CHANNEL_DEVICES:
+                for channel in self.user.subscriptions.all():
+                    channel.devices.append(self)
+            # with `subscriptions` resolver devices are resolved through subscriptions of the user
+            Channel.invalidate_audiences(user_ids=[self.user_id])
             db.session.add(self.user)
             db.session.commit()
         except Exception as ex:
@@ -135,9 +427,166 @@ class Device(db.Model, SerializationMixin):
             return False
         return True
 
+    @staticmethod
+    def bulk_upsert(rows):
+        """insert or update devices with set-based statements and subscribe new ones to channels
+        of their users. rows must be unique by `platform_id`. caller is responsible for commit.
+        :param list rows: dicts with `user_id`, `platform`, `platform_id`, `mobile_app_id`
+            and `mobile_app_ver` keys
+        :return: dict of `platform_id` to (device id, created flag)
+        """
+        if not rows:
+            return {}
+        # audiences of previous and new owners change for new devices, moved devices and devices of
+        # updated applications, registering a device again as it is changes nothing
+        existing = {platform_id: (user_id, platform, mobile_app_id, mobile_app_ver)
+                    for platform_id, user_id, platform, mobile_app_id, mobile_app_ver in db.session.execute(
+                        text('SELECT platform_id, user_id, platform, mobile_app_id, mobile_app_ver '
+                             'FROM device WHERE platform_id = ANY(:platform_ids)'),
+                        {'platform_ids': [row['platform_id'] for row in rows]})}
+        changed_users = []
+        for row in rows:
+            previous = existing.get(row['platform_id'])
+            if previous != (row['user_id'], row['platform'], row['mobile_app_id'], row['mobile_app_ver']):
+                changed_users.append(row['user_id'])
+                if previous:
+                    changed_users.append(previous[0])
+        Channel.invalidate_audiences(user_ids=changed_users)
+        now = datetime.datetime.now()
+        result = db.session.execute(
+            text('INSERT INTO device (user_id, platform, platform_id, mobile_app_id, mobile_app_ver, '
+                 '                    mute, created_at) '
+                 'SELECT r.user_id, r.platform, r.platform_id, r.mobile_app_id, r.mobile_app_ver, '
+                 '       FALSE, :now '
+                 'FROM unnest(CAST(:user_ids AS integer[]), CAST(:platforms AS varchar[]), '
+                 '            CAST(:platform_ids AS text[]), CAST(:mobile_app_ids AS text[]), '
+                 '            CAST(:mobile_app_vers AS integer[])) '
+                 '     AS r (user_id, platform, platform_id, mobile_app_id, mobile_app_ver) '
+                 'ON CONFLICT (platform_id) DO UPDATE '
+                 'SET user_id = EXCLUDED.user_id, platform = EXCLUDED.platform, '
+                 '    mobile_app_id = EXCLUDED.mobile_app_id, mobile_app_ver = EXCLUDED.mobile_app_ver, '
+                 '    updated_at = :now '
+                 'RETURNING id, platform_id, (xmax = 0) AS created'),
+            {'now': now,
+             'user_ids': [row['user_id'] for row in rows],
+             'platforms': [row['platform'] for row in rows],
+             'platform_ids': [row['platform_id'] for row in rows],
+             'mobile_app_ids': [row['mobile_app_id'] for row in rows],
+             'mobile_app_vers': [row['mobile_app_ver'] for row in rows]})
+        devices = {platform_id: (device_id, created) for device_id, platform_id, created in result}
+        new_device_ids = [device_id for device_id, created in devices.values() if created]
+        if new_device_ids and audience_resolver == AUDIENCE_CHANNEL_DEVICES:
+            # subscribe new devices to existing channels of their users
+            db.session.execute(
+                text('INSERT INTO channel_devices (channel_id, device_id) '
+                     'SELECT s.channel_id, d.id '
+                     'FROM device d JOIN subscriptions s ON s.user_id = d.user_id '
+                     'WHERE d.id = ANY(:device_ids) '
+                     'ON CONFLICT DO NOTHING'),
+                {'device_ids': new_device_ids})
+        return devices
+
+    @staticmethod
+    def delete_platform_ids(platform_ids):
+        """delete devices of invalid tokens (or registration ids) with set-based statements.
+        caller is responsible for commit.
+        :param list platform_ids: list of `platform_id`
+        :return: number of deleted devices
+        """
+        platform_ids = list(set(platform_ids))
+        if not platform_ids:
+            return 0
+        db.session.execute(
+            text('DELETE FROM channel_devices cd USING device d '
+                 'WHERE cd.device_id = d.id AND d.platform_id = ANY(:platform_ids)'),
+            {'platform_ids': platform_ids})
+        owners = [user_id for user_id, in db.session.execute(
+            text('DELETE FROM device WHERE platform_id = ANY(:platform_ids) RETURNING user_id'),
+            {'platform_ids': platform_ids})]
+        # tokens already deleted (e.g. reported by several workers) change no audience
+        Channel.invalidate_audiences(user_ids=owners)
+        return len(owners)
+
+    @staticmethod
+    def replace_platform_ids(canonical_ids):
+        """replace stale registration ids with canonical ones reported by GCM. a stale device is
+        deleted instead if its canonical id is already registered (or claimed by another stale id
+        of the same batch). caller is responsible for commit.
+        :param dict canonical_ids: dict of stale `platform_id` to canonical `platform_id`
+        :return: tuple of (number of replaced devices, number of deleted devices)
+        """
+        pairs = {}
+        stale = set()
+        for platform_id, canonical_id in canonical_ids.items():
+            if canonical_id == platform_id:
+                continue
+            if canonical_id in pairs:
+                stale.add(platform_id)
+            else:
+                pairs[canonical_id] = platform_id
+        replaced = set()
+        if pairs:
+            result = db.session.execute(
+                text('UPDATE device d SET platform_id = r.canonical_id, updated_at = :now '
+                     'FROM unnest(CAST(:platform_ids AS text[]), CAST(:canonical_ids AS text[])) '
+                     '     AS r (platform_id, canonical_id) '
+                     'WHERE d.platform_id = r.platform_id '
+                     'AND NOT EXISTS (SELECT 1 FROM device c WHERE c.platform_id = r.canonical_id) '
+                     'RETURNING r.platform_id, d.user_id'),
+                {'now': datetime.datetime.now(),
+                 'platform_ids': list(pairs.values()),
+                 'canonical_ids': list(pairs.keys())}).fetchall()
+            replaced = set(platform_id for platform_id, _ in result)
+            Channel.invalidate_audiences(user_ids=[user_id for _, user_id in result])
+            # canonical id is already registered by client, just delete stale one
+            stale.update(set(pairs.values()) - replaced)
+        return len(replaced), Device.delete_platform_ids(stale)
+
+    @staticmethod
+    def delete_reported_platform_ids(reports):
+        """delete devices of tokens reported by APNS feedback service, unless device is updated
+        (registered again) after the report. caller is responsible for commit.
+        :param list reports: list of (`platform_id`, reported_at) tuples
+        :return: number of deleted devices
+        """
+        if not reports:
+            return 0
+        params = {'platform_ids': [platform_id for platform_id, _ in reports],
+                  'reported_ats': [reported_at for _, reported_at in reports]}
+        reported_sql = ('unnest(CAST(:platform_ids AS text[]), CAST(:reported_ats AS timestamp[])) '
+                        'AS f (platform_id, reported_at) ')
+        expired_sql = ('d.platform_id = f.platform_id '
+                       'AND (d.updated_at IS NULL OR d.updated_at < f.reported_at)')
+        db.session.execute(
+            text('DELETE FROM channel_devices cd USING device d, ' + reported_sql +
+                 'WHERE cd.device_id = d.id AND ' + expired_sql),
+            params)
+        owners = [user_id for user_id, in db.session.execute(
+            text('DELETE FROM device d USING ' + reported_sql + 'WHERE ' + expired_sql + ' RETURNING d.user_id'),
+            params)]
+        Channel.invalidate_audiences(user_ids=owners)
+        return len(owners)
+
     def __repr__(self):
         return '<Device %r>' % self.id
 
 
+def rebuild_channel_devices():
+    """repopulate denormalized `channel_devices` table from `subscriptions`. required when
+    `audience_resolver` is switched back to `channel_devices` after running with `subscriptions`
+    """
+    try:
+        db.session.execute(text('DELETE FROM channel_devices'))
+        db.session.execute(text('INSERT INTO channel_devices (channel_id, device_id) '
+                                'SELECT s.channel_id, d.id '
+                                'FROM subscriptions s JOIN device d ON d.user_id = s.user_id'))
+        db.session.commit()
+    except Exception as ex:
+        db.session.rollback()
+        app.logger.exception(ex)
+        return False
+    return True
+
+
 if __name__ == '__main__':
     db.create_all()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import base64
+import datetime
+from flask import request
+from sqlalchemy import tuple_
+
+
+CURSOR_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(created_at, id_):
+    """build opaque cursor token pointing to a row
+    :param datetime.datetime created_at: creation time of the row
+    :param int id_: ID of the row
+    """
+    return base64.urlsafe_b64encode('%s|%d' % (created_at.strftime(CURSOR_DATETIME_FORMAT), id_))
+
+
+def decode_cursor(cursor):
+    """parse cursor token built by `encode_cursor`
+    :param str cursor: cursor token
+    :return: tuple of (created_at, id)
+    """
+    try:
+        created_at, id_ = base64.urlsafe_b64decode(cursor.encode('ascii')).split('|')
+        return datetime.datetime.strptime(created_at, CURSOR_DATETIME_FORMAT), int(id_)
+    except Exception:
+        raise ValueError('invalid cursor')
+
+
+def paginate(query, model):
+    """paginate query in descending (created_at, id) order according to request parameters
+
+    `offset` and `limit` select a page with OFFSET, `count=false` skips counting total number of pages.
+    Presence of `cursor` parameter switches to keyset pagination; first page is requested with an empty
+    `cursor` and following pages with `next_cursor` of previous response. Keyset pagination never counts
+    and has constant cost for every page.
+
+    :param query: query of the model
+    :param model: model class with `created_at` and `id` columns
+    :return: tuple of (items, pagination fields of respond payload)
+    """
+    try:
+        offset = int(request.values.get('offset', 1))
+        limit = int(request.values.get('limit', 20))
+    except ValueError:
+        offset = 1
+        limit = 20
+    if limit < 1:
+        limit = 20
+    query = query.order_by(model.created_at.desc(), model.id.desc())
+    cursor = request.values.get('cursor')
+    if cursor is not None:
+        if cursor:
+            created_at, id_ = decode_cursor(cursor)
+            query = query.filter(tuple_(model.created_at, model.id) < tuple_(created_at, id_))
+        items = query.limit(limit + 1).all()
+        has_next = len(items) > limit
+        items = items[:limit]
+        next_cursor = encode_cursor(items[-1].created_at, items[-1].id) if has_next else None
+        return items, {'has_next': has_next, 'next_cursor': next_cursor}
+    if request.values.get('count', 'true').lower() in ['false', '0']:
+        items = query.limit(limit + 1).offset((max(offset, 1) - 1) * limit).all()
+        return items[:limit], {'total_pages': None,
+                               'current_page': offset,
+                               'has_next': len(items) > limit}
+    page = query.paginate(page=offset, per_page=limit, error_out=False)
+    return page.items, {'total_pages': page.pages,
+                        'current_page': offset,
+                        'has_next': page.has_next}
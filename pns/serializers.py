@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import uuid
+import datetime
+from flask import current_app
+from werkzeug.http import http_date
+
+
+# content types of queue messages, consumers decode messages by `content_type` property so both
+# formats can be in the queues at the same time
+JSON = 'application/json'
+MSGPACK = 'application/x-msgpack'
+MESSAGE_FORMATS = {'json': JSON, 'msgpack': MSGPACK}
+
+# JSON backends in order of preference, the first importable one is used unless `PNS_JSON_BACKEND`
+# environment variable names another one
+JSON_BACKENDS = ['orjson', 'ujson', 'json']
+
+
+class Backend(object):
+    """
+    serializer backend; `dumps` returns UTF-8 encoded bytes, `loads` accepts bytes or text
+    """
+    def __init__(self, name, dumps, loads):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+    def __repr__(self):
+        return '<Backend %s>' % self.name
+
+
+def _orjson_backend():
+    import orjson
+    return Backend('orjson', orjson.dumps, orjson.loads)
+
+
+def _ujson_backend():
+    import ujson
+
+    def dumps(obj):
+        return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False)
+
+    return Backend('ujson', dumps, ujson.loads)
+
+
+def _json_backend():
+    encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+    def dumps(obj):
+        data = encoder.encode(obj)
+        return data.encode('utf-8') if isinstance(data, unicode) else data
+
+    return Backend('json', dumps, json.loads)
+
+
+def _msgpack_backend():
+    import msgpack
+    # strings are decoded to unicode like JSON backends do, `raw` replaced `encoding` in msgpack 0.5.2
+    try:
+        msgpack.unpackb(msgpack.packb(u''), raw=False)
+        unpack_kwargs = {'raw': False}
+    except TypeError:
+        unpack_kwargs = {'encoding': 'utf-8'}
+
+    def dumps(obj):
+        return msgpack.packb(obj, use_bin_type=False)
+
+    def loads(data):
+        return msgpack.unpackb(data, **unpack_kwargs)
+
+    return Backend('msgpack', dumps, loads)
+
+
+_factories = {'orjson': _orjson_backend, 'ujson': _ujson_backend, 'json': _json_backend,
+              'msgpack': _msgpack_backend}
+
+
+def get_backend(name):
+    """
+    :param str name: `orjson`, `ujson`, `json` or `msgpack`
+    :return: Backend object
+    :raises ImportError: if the backend package is not installed
+    """
+    return _factories[name]()
+
+
+def get_json_backend(name=None):
+    """
+    :param str name: name of JSON backend, fastest installed backend is used if not given
+    :return: Backend object
+    """
+    if name:
+        return get_backend(name)
+    for candidate in JSON_BACKENDS:
+        try:
+            return get_backend(candidate)
+        except ImportError:
+            pass
+
+
+json_backend = get_json_backend(os.getenv('PNS_JSON_BACKEND'))
+_msgpack = None
+
+
+def dumps(obj):
+    """
+    :param obj: JSON serializable object
+    :return: UTF-8 encoded JSON
+    """
+    return json_backend.dumps(obj)
+
+
+def loads(data):
+    """
+    :param data: JSON document
+    :return: decoded object
+    """
+    return json_backend.loads(data)
+
+
+def get_msgpack():
+    global _msgpack
+    if _msgpack is None:
+        _msgpack = get_backend('msgpack')
+    return _msgpack
+
+
+def encode_message(obj, content_type=JSON):
+    """
+    :param obj: queue message
+    :param str content_type: `JSON` or `MSGPACK`
+    :return: message body
+    """
+    if content_type == MSGPACK:
+        return get_msgpack().dumps(obj)
+    return json_backend.dumps(obj)
+
+
+def decode_message(body, content_type=None):
+    """
+    :param body: message body
+    :param str content_type: `content_type` property of the message, messages without it are JSON
+    :return: decoded message
+    """
+    if content_type == MSGPACK:
+        return get_msgpack().loads(body)
+    return json_backend.loads(body)
+
+
+def to_builtin(obj):
+    """
+    convert values not supported by all backends the same way flask JSONEncoder does
+    :param obj: response object
+    :return: JSON serializable object
+    """
+    if isinstance(obj, dict):
+        return {key: to_builtin(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [to_builtin(value) for value in obj]
+    if isinstance(obj, datetime.datetime):
+        return http_date(obj)
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    if hasattr(obj, '__html__'):
+        return unicode(obj.__html__())
+    return obj
+
+
+def jsonify(*args, **kwargs):
+    """
+    drop-in replacement of `flask.jsonify` serializing with the JSON backend, responses are not indented
+    :return: response object
+    """
+    return current_app.response_class(dumps(to_builtin(dict(*args, **kwargs))), mimetype=JSON)
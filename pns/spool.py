@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+
+import os
+import glob
+import time
+import zlib
+import errno
+import fcntl
+import struct
+import logging
+import threading
+import pika
+
+
+# record header; crc32 of the rest of the record, lengths of body, routing key and content type
+HEADER = struct.Struct('>iIHH')
+
+
+class SpoolFull(Exception):
+    """spool reached its size limit, messages are not drained as fast as they are accepted
+    """
+
+
+def encode_record(routing_key, body, content_type):
+    """
+    :param str routing_key: routing key
+    :param str body: message body
+    :param str content_type: content type of message body
+    :return: record bytes
+    """
+    routing_key = routing_key.encode('utf-8') if isinstance(routing_key, unicode) else routing_key
+    content_type = content_type.encode('utf-8') if isinstance(content_type, unicode) else content_type
+    body = body.encode('utf-8') if isinstance(body, unicode) else body
+    data = routing_key + content_type + body
+    return HEADER.pack(zlib.crc32(data), len(body), len(routing_key), len(content_type)) + data
+
+
+def read_records(f, end):
+    """read complete records of a segment file from current position up to `end`
+    :param f: file object of segment
+    :param int end: offset to stop at
+    :return: generator of (offset after record, routing key, body, content type); stops at a torn or
+        corrupt record, leaving the file positioned at its start
+    """
+    while f.tell() + HEADER.size <= end:
+        start = f.tell()
+        crc, body_length, key_length, type_length = HEADER.unpack(f.read(HEADER.size))
+        length = key_length + type_length + body_length
+        if start + HEADER.size + length > end:
+            f.seek(start)
+            return
+        data = f.read(length)
+        if zlib.crc32(data) != crc:
+            f.seek(start)
+            return
+        yield (f.tell(), data[:key_length], data[key_length + type_length:],
+               data[key_length:key_length + type_length])
+
+
+class Segment(object):
+    """append-only spool file. the file is locked while it is open, so segments of a running process
+    are never taken over by another process
+    """
+    def __init__(self, path, create=False):
+        """
+        :param str path: path of segment file
+        :param bool create: create a new segment
+        :raises IOError: if segment is locked by another process
+        """
+        self.path = path
+        # new segments are locked before they are visible to other processes under their final name
+        self.fd = os.open(path + '.new' if create else path,
+                          os.O_RDWR | os.O_APPEND | (os.O_CREAT | os.O_EXCL if create else 0), 0o644)
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            os.close(self.fd)
+            raise
+        if create:
+            os.rename(path + '.new', path)
+        elif not self.is_linked():
+            # owner removed the drained segment after it was opened here, before it was locked
+            os.close(self.fd)
+            raise IOError(errno.ENOENT, 'spool segment is removed', path)
+        self.reader = open(path, 'rb')
+        self.size = os.fstat(self.fd).st_size
+        # records up to `synced` are on disk, records up to `offset` are confirmed by broker
+        self.synced = 0 if create else self.size
+        self.offset = self.read_checkpoint()
+        self.sealed = not create
+
+    def is_linked(self):
+        """
+        :return: True if the open file is still the file at `path`
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            return False
+        fstat = os.fstat(self.fd)
+        return (fstat.st_dev, fstat.st_ino) == (stat.st_dev, stat.st_ino)
+
+    @property
+    def checkpoint_path(self):
+        return self.path + '.offset'
+
+    def read_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path):
+            return 0
+        with open(self.checkpoint_path) as f:
+            return int(f.read().strip() or 0)
+
+    def write_checkpoint(self, offset):
+        with open(self.checkpoint_path + '.tmp', 'w') as f:
+            f.write(str(offset))
+        os.rename(self.checkpoint_path + '.tmp', self.checkpoint_path)
+        self.offset = offset
+
+    def remove(self):
+        # files are removed before the lock is released, so they can't be taken over meanwhile
+        for path in [self.path, self.checkpoint_path]:
+            try:
+                os.remove(path)
+            except OSError as ex:
+                if ex.errno != errno.ENOENT:
+                    raise
+        self.reader.close()
+        os.close(self.fd)
+
+
+class Spool(object):
+    """bounded on-disk spool of messages, drained to RabbitMQ by a background publisher
+
+    `put` appends a record to the active segment and returns as soon as it is on disk. concurrent
+    callers share fsync calls (group commit). a drainer thread publishes records with confirms and
+    checkpoints the offset of confirmed records, drained segments are removed. batches rejected by
+    broker are published again, unroutable records are moved to a dead letter segment. segments left
+    by stopped processes are taken over, so messages are published at least once.
+    """
+    def __init__(self, directory, publisher, max_bytes=268435456, segment_bytes=16777216, batch_size=1000,
+                 poll_interval=0.05, adopt_interval=60):
+        """
+        :param str directory: directory of segment files, can be shared by processes of a host
+        :param ConfirmedPublisher publisher: publisher of drained messages, its returned messages are
+            handled by the spool
+        :param int max_bytes: maximum size of records waiting to be published
+        :param int segment_bytes: size of segment files to roll at
+        :param int batch_size: number of records published before waiting for confirmations
+        :param float poll_interval: how often drainer checks for new records (in seconds)
+        :param float adopt_interval: how often segments of stopped processes are looked for (in seconds)
+        """
+        self.directory = directory
+        self.publisher = publisher
+        self.publisher.on_return = self._on_return
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.adopt_interval = adopt_interval
+        self.logger = logging.getLogger(__name__)
+        self.pid = os.getpid()
+        self.name = '%013d-%d' % (int(time.time() * 1000), self.pid)
+        self.counter = 0
+        self.lock = threading.Condition()
+        # undrained segments, oldest first, the last one is active
+        self.segments = []
+        self.active = None
+        # size of records waiting to be published
+        self.size = 0
+        # sequence numbers of written and fsynced records
+        self.written = 0
+        self.synced = 0
+        self.error = None
+        self.drained = 0
+        # records of the current batch returned by broker as unroutable
+        self.returned = []
+        # segment of unroutable records, created on first use and never drained
+        self.dead_letter = None
+
+    def start(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.adopt()
+        self.roll()
+        for target in [self._sync, self._drain]:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def adopt(self):
+        """take over segments of stopped processes
+        """
+        for path in sorted(glob.glob(os.path.join(self.directory, '*.spool'))):
+            try:
+                segment = Segment(path)
+            except (IOError, OSError):
+                # locked by a running process (or by this one)
+                continue
+            with self.lock:
+                # segments of stopped processes are drained before the active segment
+                self.segments.insert(len(self.segments) - 1 if self.active else len(self.segments), segment)
+                self.size += segment.size - segment.offset
+            self.logger.warning('took over spool segment %s with %d bytes to publish' %
+                                (path, segment.size - segment.offset))
+
+    def roll(self):
+        """start a new active segment, caller holds the lock unless spool is not started yet
+        """
+        self.counter += 1
+        segment = Segment(os.path.join(self.directory, '%s-%06d.spool' % (self.name, self.counter)), create=True)
+        if self.active:
+            self.active.sealed = True
+        self.active = segment
+        self.segments.append(segment)
+
+    def put(self, routing_key, body, content_type):
+        """append a message and wait until it is on disk
+        :param str routing_key: routing key
+        :param str body: message body
+        :param str content_type: content type of message body
+        :raises SpoolFull: if spool reached its size limit
+        """
+        record = encode_record(routing_key, body, content_type)
+        with self.lock:
+            if self.size + len(record) > self.max_bytes:
+                raise SpoolFull('spool is full, %d bytes are waiting to be published' % self.size)
+            if self.active.size >= self.segment_bytes:
+                self.roll()
+            os.write(self.active.fd, record)
+            self.active.size += len(record)
+            self.size += len(record)
+            self.written += 1
+            sequence = self.written
+            self.lock.notify_all()
+            while self.synced < sequence:
+                if self.error:
+                    raise self.error
+                self.lock.wait(1)
+
+    def _sync(self):
+        while True:
+            with self.lock:
+                while self.synced == self.written:
+                    self.lock.wait(1)
+                sequence = self.written
+                ends = [(segment, segment.size) for segment in self.segments if segment.synced < segment.size]
+            try:
+                for segment, end in ends:
+                    os.fsync(segment.fd)
+                error = None
+            except OSError as ex:
+                self.logger.exception(ex)
+                error = ex
+            with self.lock:
+                self.error = error
+                if not error:
+                    for segment, end in ends:
+                        segment.synced = max(segment.synced, end)
+                    self.synced = sequence
+                self.lock.notify_all()
+            if error:
+                time.sleep(self.poll_interval)
+
+    def _drain(self):
+        adopted_at = time.time()
+        while True:
+            try:
+                if not self.drain_once():
+                    if time.time() - adopted_at > self.adopt_interval:
+                        self.adopt()
+                        adopted_at = time.time()
+                    time.sleep(self.poll_interval)
+            except Exception as ex:
+                self.logger.exception(ex)
+                time.sleep(self.poll_interval)
+
+    def _on_return(self, routing_key, body, properties):
+        self.returned.append(encode_record(routing_key, body, properties.content_type))
+
+    def move_to_dead_letter(self, records):
+        """append unroutable records to the dead letter segment of this process and wait until they
+        are on disk. dead letter segments are not taken over, records can be inspected and published
+        again by operators
+        :param list records: encoded records
+        """
+        if self.dead_letter is None:
+            self.dead_letter = Segment(os.path.join(self.directory, '%s.dead' % self.name), create=True)
+        os.write(self.dead_letter.fd, ''.join(records))
+        os.fsync(self.dead_letter.fd)
+        self.logger.error('moved %d unroutable spooled messages to %s' % (len(records), self.dead_letter.path))
+
+    def drain_once(self):
+        """publish a batch of records of the oldest segment, checkpoint is not moved unless every
+        record of the batch is confirmed by broker
+        :return: True if anything is drained
+        """
+        with self.lock:
+            segment = self.segments[0]
+            end = segment.synced
+            if segment.offset >= end:
+                if segment.sealed and segment.offset >= segment.size:
+                    self.segments.pop(0)
+                    segment.remove()
+                    return True
+                return False
+        segment.reader.seek(segment.offset)
+        offset = segment.offset
+        published = 0
+        failed = self.publisher.failed
+        del self.returned[:]
+        for offset, routing_key, body, content_type in read_records(segment.reader, end):
+            self.publisher.publish(routing_key, body,
+                                   properties=pika.BasicProperties(
+                                       delivery_mode=2,  # make message persistent
+                                       content_type=content_type))
+            published += 1
+            if published >= self.batch_size:
+                break
+        if not published:
+            # torn or corrupt record, only possible at the end of a segment of a crashed process
+            self.logger.error('discarding %d bytes of corrupt records in spool segment %s' %
+                              (end - offset, segment.path))
+            offset = end
+        self.publisher.flush()
+        # broker confirms returned messages, the rest of failed messages are rejected
+        rejected = self.publisher.failed - failed - len(self.returned)
+        if rejected > 0:
+            self.logger.error('%d spooled messages are rejected by rabbitmq server, publishing batch again' %
+                              rejected)
+            return False
+        if self.returned:
+            self.move_to_dead_letter(self.returned)
+        with self.lock:
+            self.size -= offset - segment.offset
+        segment.write_checkpoint(offset)
+        self.drained += published
+        return True
+
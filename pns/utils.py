@@ -1,10 +1,18 @@
 # -*- coding: utf-8 -*-
 
 import os
+import time
 import pika
+import Queue
+import random
+import socket
 import logging
+import threading
+import collections
 from ConfigParser import ConfigParser
-from pika.exceptions import ConnectionClosed
+from contextlib import contextmanager
+from pika.exceptions import ConnectionClosed, AMQPConnectionError, ChannelClosed
+from pns.serializers import loads, encode_message, JSON
 
 
 def get_logging_handler():
@@ -33,6 +41,80 @@ def get_conf():
     raise IOError('could not able to read file `%s`' % conf_file)
 
 
+def get_conf_value(conf, section, option, default, getter='get'):
+    """read an optional config parameter, fall back to default for config files of older versions
+    and for options left empty
+    :param conf: ConfigParser object
+    :param str section: section name
+    :param str option: option name
+    :param default: value to return if option is not set
+    :param str getter: ConfigParser method to read option (`get`, `getint`, `getfloat`, `getboolean`)
+    """
+    if conf.has_option(section, option) and conf.get(section, option).strip():
+        return getattr(conf, getter)(section, option)
+    return default
+
+
+def get_stats_logger(name):
+    """get logger of worker statistics (throughput, latency, cache hits). statistics are logged when
+    `log_stats` is enabled in `application` section, regardless of `debug` which also selects sandbox
+    environments of providers
+    :param str name: name of the module logging statistics
+    """
+    conf = get_conf()
+    logger = logging.getLogger('%s.stats' % name)
+    if not logger.handlers:
+        logger.addHandler(get_logging_handler())
+        # handlers of module logger would log statistics a second time
+        logger.propagate = False
+    if get_conf_value(conf, 'application', 'log_stats', True, 'getboolean'):
+        logger.setLevel(logging.INFO)
+    else:
+        logger.setLevel(logging.WARNING)
+    return logger
+
+
+def iter_ndjson(lines):
+    """parse newline delimited JSON (NDJSON) and yield one object per line
+    :param lines: file-like object or any iterable of lines
+    """
+    for line in lines:
+        line = line.strip()
+        if line:
+            yield loads(line)
+
+
+def chunked(iterable, size):
+    """split iterable into lists of at most `size` elements
+    :param iterable: any iterable
+    :param int size: maximum length of yielded lists
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def get_connection_parameters(username=None, password=None, host='localhost', heartbeat_interval=None):
+    """
+    :param str username: RabbitMQ username
+    :param str password: RabbitMQ password
+    :param str host: RabbitMQ host address
+    :param int heartbeat_interval: How often to send heartbeats
+    :return: pika.ConnectionParameters object
+    """
+    credentials = None
+    if username and password:
+        credentials = pika.credentials.PlainCredentials(username=username, password=password)
+    return pika.ConnectionParameters(host=host,
+                                     heartbeat_interval=heartbeat_interval,
+                                     credentials=credentials)
+
+
 class PikaConnectionManager:
     """manage RabbitMQ channel
     handle disconnection and refresh connection
@@ -46,12 +128,7 @@ class PikaConnectionManager:
 
         """
         self.channel = None
-        credentials = None
-        if username and password:
-            credentials = pika.credentials.PlainCredentials(username=username, password=password)
-        self.conn_params = pika.ConnectionParameters(host=host,
-                                                     heartbeat_interval=heartbeat_interval,
-                                                     credentials=credentials)
+        self.conn_params = get_connection_parameters(username, password, host, heartbeat_interval)
         self._connect()
 
     def _connect(self):
@@ -76,3 +153,357 @@ class PikaConnectionManager:
             self._disconnect()
             self._connect()
             return self.channel.basic_publish(*args, **kwargs)
+
+    def publish_message(self, exchange, routing_key, message, content_type=JSON, mandatory=True):
+        """serialize and publish a persistent message
+        :param str exchange: exchange name
+        :param str routing_key: routing key
+        :param message: message object
+        :param str content_type: `serializers.JSON` or `serializers.MSGPACK`
+        :param bool mandatory: the mandatory flag
+        :return: True if message is delivered
+        """
+        return self.basic_publish(exchange=exchange,
+                                  routing_key=routing_key,
+                                  body=encode_message(message, content_type),
+                                  mandatory=mandatory,
+                                  properties=pika.BasicProperties(
+                                      delivery_mode=2,  # make message persistent
+                                      content_type=content_type))
+
+
+class PoolTimeout(Exception):
+    """no channel of the pool became available in time
+    """
+
+
+class PikaChannelPool(object):
+    """pool of RabbitMQ channels with publisher confirms, safe to share by threads of a process
+
+    connections are opened on first use, so a pool created before web server workers fork never
+    shares a socket with its parent; a pool used after fork drops inherited connections without
+    closing them. each channel has its own connection and is checked out by one thread at a time,
+    at most `size` connections are opened. broken connections are replaced and publishing is retried
+    with jittered exponential backoff.
+    """
+    def __init__(self, conn_params, size=4, max_retries=5, backoff=0.1, max_backoff=5, checkout_timeout=10,
+                 on_connect=None):
+        """
+        :param pika.ConnectionParameters conn_params: RabbitMQ connection parameters
+        :param int size: maximum number of connections
+        :param int max_retries: number of retries of a failed publish
+        :param float backoff: delay before first retry (in seconds), doubled for each retry
+        :param float max_backoff: maximum delay between retries (in seconds)
+        :param float checkout_timeout: how long to wait for a free channel (in seconds)
+        :param on_connect: function called with each new channel, e.g. to declare exchanges
+        """
+        self.conn_params = conn_params
+        self.size = size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.checkout_timeout = checkout_timeout
+        self.on_connect = on_connect
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.pid = None
+        self._idle = None
+        self._opened = 0
+
+    def _check_pid(self):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    # connections of parent process are left to it, closing them would close its sockets
+                    self._idle = Queue.LifoQueue()
+                    self._opened = 0
+                    self.pid = os.getpid()
+
+    def _open(self):
+        connection = pika.BlockingConnection(self.conn_params)
+        try:
+            channel = connection.channel()
+            channel.confirm_delivery()
+            if self.on_connect:
+                self.on_connect(channel)
+        except Exception:
+            self._close(connection)
+            raise
+        return channel
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _discard(self, channel):
+        if channel is not None:
+            self._close(channel.connection)
+        with self.lock:
+            self._opened -= 1
+
+    def checkout(self):
+        """
+        :return: channel reserved for the calling thread, open a new one if pool is not full
+        :raises PoolTimeout: if no channel is available in `checkout_timeout` seconds
+        """
+        self._check_pid()
+        with self.lock:
+            opening = self._idle.empty() and self._opened < self.size
+            if opening:
+                self._opened += 1
+        if opening:
+            try:
+                return self._open()
+            except Exception:
+                self._discard(None)
+                raise
+        try:
+            channel = self._idle.get(timeout=self.checkout_timeout)
+        except Queue.Empty:
+            raise PoolTimeout('no rabbitmq channel is available in %s seconds' % self.checkout_timeout)
+        try:
+            # idle blocking connections answer heartbeats only when they are used
+            channel.connection.process_data_events(time_limit=0)
+        except Exception:
+            pass
+        if not channel.is_open or not channel.connection.is_open:
+            self._discard(channel)
+            return self.checkout()
+        return channel
+
+    def checkin(self, channel):
+        """
+        :param channel: channel returned by `checkout`
+        """
+        if self.pid != os.getpid():
+            return
+        if channel.is_open and channel.connection.is_open:
+            self._idle.put(channel)
+        else:
+            self._discard(channel)
+
+    @contextmanager
+    def channel(self):
+        """reserve a channel for the calling thread, broken channels are not returned to the pool
+        """
+        channel = self.checkout()
+        try:
+            yield channel
+        except (AMQPConnectionError, ChannelClosed, socket.error):
+            self._discard(channel)
+            raise
+        except Exception:
+            self.checkin(channel)
+            raise
+        self.checkin(channel)
+
+    def get_delay(self, attempt):
+        """
+        :param int attempt: number of failed attempts so far
+        :return: seconds to wait before next attempt
+        """
+        delay = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+        # jitter spreads reconnections of threads and processes after a broker restart
+        return delay / 2 + random.random() * delay
+
+    def basic_publish(self, *args, **kwargs):
+        """publish over a pooled channel, retry on connection errors
+        :return: True if message is confirmed by broker (and routed if `mandatory` is set)
+        """
+        attempt = 0
+        while True:
+            try:
+                with self.channel() as channel:
+                    return channel.basic_publish(*args, **kwargs)
+            except (AMQPConnectionError, ChannelClosed, socket.error) as ex:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                delay = self.get_delay(attempt)
+                self.logger.warning('publishing to rabbitmq failed (%r), retrying in %.2f seconds' % (ex, delay))
+                time.sleep(delay)
+
+    def publish_message(self, exchange, routing_key, message, content_type=JSON, mandatory=True):
+        """serialize and publish a persistent message
+        :param str exchange: exchange name
+        :param str routing_key: routing key
+        :param message: message object
+        :param str content_type: `serializers.JSON` or `serializers.MSGPACK`
+        :param bool mandatory: the mandatory flag
+        :return: True if message is confirmed by broker
+        """
+        return self.basic_publish(exchange=exchange,
+                                  routing_key=routing_key,
+                                  body=encode_message(message, content_type),
+                                  mandatory=mandatory,
+                                  properties=pika.BasicProperties(
+                                      delivery_mode=2,  # make message persistent
+                                      content_type=content_type))
+
+
+class ConfirmedPublisher(threading.Thread):
+    """publish messages over a dedicated asynchronous connection with publisher confirms
+
+    `publish` can be called from any thread; messages are queued and written to the socket by
+    the IO loop of this thread, so callers keep working (e.g. reading database) while messages are
+    on the wire. at most `max_in_flight` messages wait for broker confirmation at any time and
+    `publish` blocks when the window is full. unconfirmed messages are published again after
+    reconnection.
+    """
+    def __init__(self, conn_params, exchange, max_in_flight=1000, poll_interval=0.005, reconnect_delay=1,
+                 on_return=None):
+        """
+        :param pika.ConnectionParameters conn_params: RabbitMQ connection parameters
+        :param str exchange: exchange to publish messages
+        :param int max_in_flight: maximum number of unconfirmed messages
+        :param float poll_interval: how often IO loop checks for queued messages (in seconds)
+        :param float reconnect_delay: wait before reconnection (in seconds)
+        :param on_return: called by IO loop with routing key, body and properties of returned messages
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.conn_params = conn_params
+        self.exchange = exchange
+        self.on_return = on_return
+        self.poll_interval = poll_interval
+        self.reconnect_delay = reconnect_delay
+        self.logger = logging.getLogger(__name__)
+        self._window = threading.Semaphore(max_in_flight)
+        # messages waiting to be written, shared between caller threads and IO loop
+        self._pending = collections.deque()
+        # messages waiting for confirmation by delivery tag, accessed only by IO loop
+        self._unconfirmed = {}
+        self._delivery_tag = 0
+        self._outstanding = 0
+        self._idle = threading.Condition()
+        self._connection = None
+        self._channel = None
+        self._stopping = False
+        self.confirmed = 0
+        self.failed = 0
+
+    def publish(self, routing_key, body, properties=None, mandatory=True):
+        """queue message to be published, block while `max_in_flight` messages are not confirmed
+        :param str routing_key: routing key
+        :param str body: message body
+        :param pika.BasicProperties properties: message properties
+        :param bool mandatory: the mandatory flag
+        """
+        self._window.acquire()
+        with self._idle:
+            self._outstanding += 1
+        self._pending.append((routing_key, body, properties, mandatory))
+
+    def publish_message(self, routing_key, message, content_type=JSON, mandatory=True):
+        """serialize message and queue it to be published as a persistent message
+        :param str routing_key: routing key
+        :param message: message object
+        :param str content_type: `serializers.JSON` or `serializers.MSGPACK`
+        :param bool mandatory: the mandatory flag
+        :return: size of message body
+        """
+        body = encode_message(message, content_type)
+        self.publish(routing_key, body,
+                     properties=pika.BasicProperties(
+                         delivery_mode=2,  # make message persistent
+                         content_type=content_type),
+                     mandatory=mandatory)
+        return len(body)
+
+    def flush(self, timeout=None):
+        """block until every queued message is confirmed by broker
+        :param float timeout: maximum time to wait (in seconds)
+        :return: True if all messages are confirmed
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._idle:
+            while self._outstanding:
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                # wait with a timeout, otherwise signals can't interrupt the worker
+                self._idle.wait(min(remaining, 1) if remaining is not None else 1)
+        return True
+
+    def stop(self):
+        """close connection after all queued messages are confirmed
+        """
+        self._stopping = True
+        self.join()
+
+    def run(self):
+        while True:
+            self._connection = pika.SelectConnection(self.conn_params,
+                                                     on_open_callback=self._on_connection_open,
+                                                     on_open_error_callback=self._on_connection_error,
+                                                     on_close_callback=self._on_connection_closed)
+            self._connection.ioloop.start()
+            if self._stopping and not self._outstanding:
+                break
+            time.sleep(self.reconnect_delay)
+
+    def _on_connection_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_error(self, connection, error):
+        self.logger.error('could not connect to rabbitmq server: %s' % error)
+        connection.ioloop.stop()
+
+    def _on_connection_closed(self, connection, reply_code, reply_text):
+        self._channel = None
+        if self._unconfirmed:
+            self.logger.warning('connection closed (%s %s), publishing %d unconfirmed messages again' %
+                                (reply_code, reply_text, len(self._unconfirmed)))
+            for delivery_tag in sorted(self._unconfirmed, reverse=True):
+                self._pending.appendleft(self._unconfirmed.pop(delivery_tag))
+
+    def _on_channel_open(self, channel):
+        self._channel = channel
+        self._delivery_tag = 0
+        channel.add_on_return_callback(self._on_return)
+        channel.confirm_delivery(self._on_delivery_confirmation)
+        self._connection.add_timeout(self.poll_interval, self._drain)
+
+    def _drain(self):
+        """write every queued message to the channel
+        """
+        if not self._channel or not self._channel.is_open:
+            return
+        while self._pending:
+            message = self._pending.popleft()
+            routing_key, body, properties, mandatory = message
+            self._delivery_tag += 1
+            self._unconfirmed[self._delivery_tag] = message
+            self._channel.basic_publish(self.exchange, routing_key, body, properties, mandatory)
+        if self._stopping and not self._outstanding:
+            self._connection.close()
+            return
+        self._connection.add_timeout(self.poll_interval, self._drain)
+
+    def _on_delivery_confirmation(self, method_frame):
+        method = method_frame.method
+        if method.multiple:
+            delivery_tags = [tag for tag in self._unconfirmed if tag <= method.delivery_tag]
+        else:
+            delivery_tags = [method.delivery_tag]
+        for delivery_tag in delivery_tags:
+            if self._unconfirmed.pop(delivery_tag, None) is None:
+                continue
+            if isinstance(method, pika.spec.Basic.Nack):
+                self.failed += 1
+                self.logger.error('message is rejected by rabbitmq server')
+            else:
+                self.confirmed += 1
+            self._window.release()
+            with self._idle:
+                self._outstanding -= 1
+                self._idle.notify_all()
+
+    def _on_return(self, channel, method, properties, body):
+        # unroutable message, broker confirms it after returning
+        self.failed += 1
+        self.logger.error('message is returned by rabbitmq server: %s' % method.reply_text)
+        if self.on_return:
+            self.on_return(method.routing_key, body, properties)
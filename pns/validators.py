@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+from schema import Schema, And, Or, Optional, SchemaError
+
+
+# error messages of `Schema.validate`
+TYPE_ERROR = '%r should be instance of %r'
+CALLABLE_ERROR = '%s(%r) should evaluate to True'
+CALLABLE_RAISED = '%s(%r) raised %r'
+OR_ERROR = '%r did not validate %r'
+MATCH_ERROR = '%r does not match %r'
+
+
+class UnsupportedSchema(Exception):
+    """schema construct without a compiled equivalent
+    """
+
+
+def _missing_keys(schema, data):
+    # same set operations as `Schema.validate`, so missing keys are listed in the same order
+    required = set(key for key in schema if type(key) is not Optional)
+    coverage = set(key for key in required if key in data)
+    return 'Missing keys: ' + ', '.join(repr(key) for key in required - coverage)
+
+
+def _wrong_keys(wrong, data):
+    return 'Wrong keys %s in %r' % (', '.join(repr(key) for key in sorted(wrong, key=repr)), data)
+
+
+class SchemaCompiler(object):
+    """generate source of a flat validation function from a `schema.Schema`
+
+    supported constructs are types, callables, constants, `And`, `Or`, lists and dicts with constant
+    (or `Optional` constant) keys, without custom `error` messages and `Optional` defaults. raised
+    `SchemaError` messages are the same as the messages of `Schema.validate`
+    """
+    def __init__(self):
+        self.lines = []
+        self.namespace = {'SchemaError': SchemaError, '_missing_keys': _missing_keys, '_wrong_keys': _wrong_keys,
+                          'TYPE_ERROR': TYPE_ERROR, 'CALLABLE_ERROR': CALLABLE_ERROR,
+                          'CALLABLE_RAISED': CALLABLE_RAISED, 'OR_ERROR': OR_ERROR, 'MATCH_ERROR': MATCH_ERROR}
+        self.counter = 0
+
+    def name(self, prefix):
+        self.counter += 1
+        return '%s%d' % (prefix, self.counter)
+
+    def const(self, value):
+        name = self.name('c')
+        self.namespace[name] = value
+        return name
+
+    def emit(self, indent, line):
+        self.lines.append('    ' * indent + line)
+
+    def compile(self, schema):
+        """
+        :param Schema schema: schema to compile
+        :return: function validating data against schema, returns data as is
+        """
+        self.emit(0, 'def validate(data):')
+        self.node(schema, 'data', 1)
+        self.emit(1, 'return data')
+        source = '\n'.join(self.lines) + '\n'
+        exec compile(source, '<compiled %r>' % schema, 'exec') in self.namespace
+        validate = self.namespace['validate']
+        validate.source = source
+        return validate
+
+    def node(self, s, var, indent):
+        if type(s) is Schema:
+            if s._error is not None:
+                raise UnsupportedSchema(s)
+            return self.node(s._schema, var, indent)
+        if type(s) in (list, tuple, set, frozenset):
+            return self.iterable(s, var, indent)
+        if type(s) is dict:
+            return self.dict(s, var, indent)
+        if issubclass(type(s), type):
+            self.emit(indent, 'if not isinstance(%s, %s):' % (var, self.const(s)))
+            self.emit(indent + 1, 'raise SchemaError(TYPE_ERROR %% (%s, %r), None)' %
+                      (var, s.__name__))
+            return
+        if type(s) is Or:
+            if s._error is not None:
+                raise UnsupportedSchema(s)
+            return self.alternatives(s, s._args, var, indent)
+        if type(s) is And:
+            if s._error is not None:
+                raise UnsupportedSchema(s)
+            for arg in s._args:
+                self.node(arg, var, indent)
+            return
+        if hasattr(s, 'validate'):
+            raise UnsupportedSchema(s)
+        if callable(s):
+            return self.callable(s, var, indent)
+        self.emit(indent, 'if not %s == %s:' % (self.const(s), var))
+        self.emit(indent + 1, 'raise SchemaError(MATCH_ERROR %% (%s, %s), None)' % (self.const(s), var))
+
+    def callable(self, s, var, indent):
+        f = s.__name__ if hasattr(s, '__name__') else str(s)
+        result, ex = self.name('r'), self.name('x')
+        self.emit(indent, 'try:')
+        self.emit(indent + 1, '%s = %s(%s)' % (result, self.const(s), var))
+        self.emit(indent, 'except SchemaError as %s:' % ex)
+        self.emit(indent + 1, 'raise SchemaError([None] + %s.autos, [None] + %s.errors)' % (ex, ex))
+        self.emit(indent, 'except BaseException as %s:' % ex)
+        self.emit(indent + 1, 'raise SchemaError(CALLABLE_RAISED %% (%r, %s, %s), None)' % (f, var, ex))
+        self.emit(indent, 'if not %s:' % result)
+        self.emit(indent + 1, 'raise SchemaError(CALLABLE_ERROR %% (%r, %s), None)' % (f, var))
+
+    def alternatives(self, s, args, var, indent):
+        """
+        validate against every alternative until one of them succeeds, like `Or.validate`
+        :param s: `Or` object, used in error message
+        :param args: alternatives
+        """
+        ex = None
+        for arg in args:
+            self.emit(indent, 'try:')
+            self.node(arg, var, indent + 1)
+            ex = self.name('x')
+            self.emit(indent, 'except SchemaError as %s:' % ex)
+            indent += 1
+        if ex is None:
+            self.emit(indent, 'raise SchemaError(OR_ERROR %% (%s, %s), None)' % (self.const(s), var))
+        else:
+            self.emit(indent, 'raise SchemaError([OR_ERROR %% (%s, %s)] + %s.autos, '
+                              '[None] + %s.errors)' % (self.const(s), var, ex, ex))
+
+    def iterable(self, s, var, indent):
+        self.emit(indent, 'if not isinstance(%s, %s):' % (var, self.const(type(s))))
+        self.emit(indent + 1, 'raise SchemaError(TYPE_ERROR %% (%s, %r), None)' %
+                  (var, type(s).__name__))
+        item = self.name('i')
+        self.emit(indent, 'for %s in %s:' % (item, var))
+        self.alternatives(Or(*s), s, item, indent + 1)
+
+    def dict(self, s, var, indent):
+        keys = []
+        for skey in s:
+            key = skey
+            if type(skey) is Optional:
+                if skey._error is not None or hasattr(skey, 'default'):
+                    raise UnsupportedSchema(skey)
+                key = skey._schema
+            if type(key) in (list, tuple, set, frozenset, dict) or issubclass(type(key), type) or \
+                    hasattr(key, 'validate') or callable(key) or key in [k for k, _, _ in keys]:
+                raise UnsupportedSchema(skey)
+            keys.append((key, s[skey], type(skey) is not Optional))
+        covered, wrong = self.name('n'), self.name('w')
+        key, value = self.name('k'), self.name('v')
+        self.emit(indent, 'if not isinstance(%s, dict):' % var)
+        self.emit(indent + 1, 'raise SchemaError(TYPE_ERROR %% (%s, %r), None)' % (var, 'dict'))
+        self.emit(indent, '%s = 0' % covered)
+        self.emit(indent, '%s = None' % wrong)
+        self.emit(indent, 'for %s, %s in %s.items():' % (key, value, var))
+        for index, (skey, svalue, required) in enumerate(keys):
+            self.emit(indent + 1, '%s %s == %s:' % ('if' if index == 0 else 'elif', key, self.const(skey)))
+            self.node(svalue, value, indent + 2)
+            if required:
+                self.emit(indent + 2, '%s += 1' % covered)
+        if keys:
+            self.emit(indent + 1, 'else:')
+            indent += 1
+        self.emit(indent + 1, 'if %s is None:' % wrong)
+        self.emit(indent + 2, '%s = []' % wrong)
+        self.emit(indent + 1, '%s.append(%s)' % (wrong, key))
+        if keys:
+            indent -= 1
+        self.emit(indent, 'if %s != %d:' % (covered, len([k for k in keys if k[2]])))
+        self.emit(indent + 1, 'raise SchemaError(_missing_keys(%s, %s), None)' % (self.const(s), var))
+        self.emit(indent, 'if %s:' % wrong)
+        self.emit(indent + 1, 'raise SchemaError(_wrong_keys(%s, %s), None)' % (wrong, var))
+
+
+def compile_schema(schema):
+    """precompile a schema into a flat validation function, raising the same `SchemaError` messages as
+    `schema.validate`. schemas with unsupported constructs are not compiled
+    :param Schema schema: schema to compile
+    :return: function validating data against schema
+    """
+    try:
+        return SchemaCompiler().compile(schema)
+    except UnsupportedSchema:
+        return schema.validate
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 
+import os
+import time
 import logging
+from datetime import datetime
 from apns_clerk import APNs, Session
-from pns.utils import get_conf, get_logging_handler
+from pns.utils import get_conf, get_conf_value, get_logging_handler, chunked
 from pns.models import db, Device
 
 
@@ -17,8 +20,16 @@ if conf.getboolean('application', 'debug'):
 else:
     logger.setLevel(logging.WARNING)
 
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
 
 class APNSFeedbackWorker(object):
+    """
+    feedback service returns every token only once, so tokens are spooled to a file before they
+    are processed. spooled tokens are deleted in batches, every batch is committed on its own and
+    its end offset is saved as checkpoint. an interrupted run is resumed from the checkpoint by the
+    next run, spool file is removed once it is processed completely.
+    """
     def __init__(self):
         # apns configuration
         session = Session()
@@ -27,31 +38,102 @@ class APNSFeedbackWorker(object):
         else:
             con = session.new_connection("feedback_production", cert_file=conf.get('apns', 'cert_production'))
         self.srv = APNs(con)
+        # spool and its checkpoint must survive reboots, temporary directories are not suitable
+        self.spool_path = get_conf_value(conf, 'apns', 'feedback_spool', '/var/lib/pns/apns_feedback.spool')
+        self.checkpoint_path = self.spool_path + '.checkpoint'
+        self.batch_size = get_conf_value(conf, 'apns', 'feedback_batch_size', 1000, 'getint')
 
     def start(self):
+        started_at = time.time()
+        received = self.receive()
         try:
-            # on any IO failure after successful connection this generator
-            # will simply stop iterating. you will pick the rest of the tokens
-            # during next feedback session.
-            for token, when in self.srv.feedback():
-                # every time a devices sends you a token, you should store
-                # {token: given_token, last_update: datetime.datetime.now()}
-                device = Device.query.filter_by(platform_id=token).first()
-                if not device:
-                    continue
-                if device.updated_at and device.updated_at < when:
-                    # the token wasn't updated after the failure has
-                    # been reported, so the token is invalid and you should
-                    # stop sending messages to it.
-                    db.session.delete(device)
-                elif not device.updated_at:
-                    db.session.delete(device)
-            db.session.commit()
+            deleted = self.process()
         except Exception as ex:
             db.session.rollback()
             logger.exception(ex)
+            return
+        logger.info('%d tokens received, %d devices removed in %.2f seconds' %
+                    (received, deleted, time.time() - started_at))
+
+    def receive(self):
+        """
+        append tokens reported by feedback service to spool file
+        :return: number of received tokens
+        """
+        received = 0
+        directory = os.path.dirname(self.spool_path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.spool_path, 'a') as spool:
+            try:
+                # on any IO failure after successful connection this generator
+                # will simply stop iterating. you will pick the rest of the tokens
+                # during next feedback session.
+                for token, when in self.srv.feedback():
+                    spool.write('%s\t%s\n' % (token, when.strftime(TIMESTAMP_FORMAT)))
+                    received += 1
+            except Exception as ex:
+                logger.exception(ex)
+            spool.flush()
+            os.fsync(spool.fileno())
+        return received
+
+    def read_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path):
+            return 0
+        with open(self.checkpoint_path) as f:
+            return int(f.read().strip() or 0)
+
+    def write_checkpoint(self, offset):
+        with open(self.checkpoint_path + '.tmp', 'w') as f:
+            f.write(str(offset))
+        os.rename(self.checkpoint_path + '.tmp', self.checkpoint_path)
+
+    def iter_spool(self, spool):
+        """
+        yield spooled reports with end offset of their lines
+        :param spool: spool file positioned at the checkpoint
+        """
+        offset = spool.tell()
+        while True:
+            line = spool.readline()
+            if not line.endswith('\n'):
+                # end of file (or a partially written last line)
+                return
+            offset += len(line)
+            try:
+                token, when = line.rstrip('\n').split('\t')
+                when = datetime.strptime(when, TIMESTAMP_FORMAT)
+            except ValueError:
+                # leftover of an interrupted write
+                logger.warning('skipping malformed spool line: %r' % line)
+                continue
+            yield token, when, offset
+
+    def process(self):
+        """
+        delete devices of spooled tokens in batches, starting from the checkpoint
+        :return: number of deleted devices
+        """
+        deleted = 0
+        with open(self.spool_path) as spool:
+            spool.seek(self.read_checkpoint())
+            for batch in chunked(self.iter_spool(spool), self.batch_size):
+                # the token wasn't updated after the failure has been reported,
+                # so the token is invalid and you should stop sending messages to it.
+                deleted += Device.delete_reported_platform_ids([(token, when) for token, when, _ in batch])
+                db.session.commit()
+                self.write_checkpoint(batch[-1][2])
+        os.remove(self.spool_path)
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+        return deleted
 
 
 if __name__ == '__main__':
-    logger.info('starting APNSFeedbackWorker')
-    APNSFeedbackWorker().start()
+    if get_conf_value(conf, 'apns', 'transport', 'binary') == 'http2':
+        # HTTP/2 provider API reports invalid tokens inline, they are removed by APNSWorker
+        logger.info('feedback service is not used by HTTP/2 transport')
+    else:
+        logger.info('starting APNSFeedbackWorker')
+        APNSFeedbackWorker().start()
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+from pns.serializers import dumps, loads
+
+try:
+    from hyper import HTTP20Connection
+    from hyper.tls import init_context
+except ImportError:
+    HTTP20Connection = None
+
+try:
+    import jwt
+except ImportError:
+    jwt = None
+
+
+PRODUCTION_HOST = 'api.push.apple.com'
+SANDBOX_HOST = 'api.sandbox.push.apple.com'
+# reasons meaning the device token is no longer valid for the topic, device should be removed
+INVALID_TOKEN_REASONS = ['BadDeviceToken', 'DeviceTokenNotForTopic', 'Unregistered']
+# statuses worth to retry later
+RETRY_STATUSES = [429, 500, 503]
+
+
+def build_payload(payload):
+    """
+    build APNs payload from alert payload, `data` is merged into root dictionary next to `aps`
+    :param dict payload: alert payload
+    :return: dict
+    """
+    aps = {'alert': payload['alert'], 'sound': 'default'}
+    if 'apns' in payload:
+        if 'badge' in payload['apns']:
+            aps['badge'] = payload['apns']['badge']
+        if 'sound' in payload['apns']:
+            aps['sound'] = payload['apns']['sound']
+        if payload['apns'].get('content_available'):
+            aps['content-available'] = 1
+    apns_payload = dict(payload.get('data', {}))
+    apns_payload['aps'] = aps
+    return apns_payload
+
+
+class ProviderToken(object):
+    """
+    sign and cache JSON web token for token based provider authentication. APNs rejects tokens
+    older than one hour and refreshing them more often than every 20 minutes, so a signed token is
+    shared by all connections of the process until `ttl` expires.
+    """
+    def __init__(self, key_file, key_id, team_id, ttl=45 * 60):
+        """
+        :param str key_file: path of the signing key (.p8 file)
+        :param str key_id: key identifier
+        :param str team_id: team identifier
+        :param int ttl: lifetime of signed tokens (in seconds)
+        """
+        if jwt is None:
+            raise ImportError('`PyJWT` and `cryptography` packages are required for token authentication')
+        with open(key_file) as f:
+            self.key = f.read()
+        self.key_id = key_id
+        self.team_id = team_id
+        self.ttl = ttl
+        self._token = None
+        self._issued_at = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            now = time.time()
+            if not self._token or now - self._issued_at >= self.ttl:
+                self._token = jwt.encode({'iss': self.team_id, 'iat': int(now)}, self.key,
+                                         algorithm='ES256', headers={'kid': self.key_id})
+                self._issued_at = now
+            return self._token
+
+
+class APNsResult(object):
+    """outcome of sending a notification to a list of tokens
+    """
+    def __init__(self):
+        self.sent = []
+        # token: reason, tokens to be removed
+        self.invalid = {}
+        # tokens failed by temporary errors or connection failures
+        self.retry = []
+        # token: (status, reason), tokens failed by other errors
+        self.errors = {}
+        # seconds from request to response for every token
+        self.latencies = []
+        # seconds to send whole token list
+        self.elapsed = 0.0
+
+    def update(self, result):
+        """merge result of retried tokens
+        """
+        self.sent.extend(result.sent)
+        self.invalid.update(result.invalid)
+        self.retry = result.retry
+        self.errors.update(result.errors)
+        self.latencies.extend(result.latencies)
+        self.elapsed += result.elapsed
+
+    def __repr__(self):
+        return ('<APNsResult sent: %d, invalid: %d, retry: %d, errors: %d>' %
+                (len(self.sent), len(self.invalid), len(self.retry), len(self.errors)))
+
+
+class APNsHTTP2Transport(object):
+    """
+    send notifications through APNs HTTP/2 provider API. every token is a separate request, up to
+    `max_streams` concurrent streams are multiplexed over each of `connections` connections.
+    invalid tokens are reported inline, so feedback service is not needed.
+    """
+    def __init__(self, host, topic=None, cert_file=None, provider_token=None, connections=2, max_streams=100,
+                 secure=True):
+        """
+        :param str host: provider API address, `host` or `host:port`
+        :param str topic: bundle ID of the application (`apns-topic` header), required for token authentication
+        :param str cert_file: certificate (with private key) for certificate based authentication
+        :param ProviderToken provider_token: signer for token based authentication
+        :param int connections: number of HTTP/2 connections
+        :param int max_streams: number of concurrent streams per connection
+        :param bool secure: use TLS, disable only for local stub servers
+        """
+        if HTTP20Connection is None:
+            raise ImportError('`hyper` package is required for APNs HTTP/2 transport')
+        self.host = host
+        self.topic = topic
+        self.provider_token = provider_token
+        self.max_streams = max_streams
+        self.secure = secure
+        self.ssl_context = init_context(cert=cert_file) if secure else None
+        self._connections = [None] * connections
+
+    def _get_connection(self, index):
+        if self._connections[index] is None:
+            self._connections[index] = HTTP20Connection(self.host, secure=self.secure, ssl_context=self.ssl_context)
+        return self._connections[index]
+
+    def _reset_connection(self, index):
+        connection = self._connections[index]
+        self._connections[index] = None
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    def close(self):
+        for index in range(len(self._connections)):
+            self._reset_connection(index)
+
+    def send(self, tokens, payload, expiration=None, priority=10, collapse_id=None):
+        """
+        send same payload to all tokens
+        :param list tokens: device tokens
+        :param dict payload: APNs payload, see `build_payload`
+        :param int expiration: UNIX epoch time the notification is no longer valid
+        :param int priority: 10 to send immediately, 5 to consider power considerations of device
+        :param str collapse_id: identifier to coalesce multiple notifications into one
+        :return: APNsResult
+        """
+        body = dumps(payload)
+        headers = {'apns-priority': str(priority),
+                   'apns-push-type': 'alert' if 'alert' in payload['aps'] else 'background'}
+        if self.topic:
+            headers['apns-topic'] = self.topic
+        if expiration is not None:
+            headers['apns-expiration'] = str(expiration)
+        if collapse_id:
+            headers['apns-collapse-id'] = collapse_id
+        if self.provider_token:
+            headers['authorization'] = 'bearer %s' % self.provider_token.get()
+        result = APNsResult()
+        started_at = time.time()
+        window = len(self._connections) * self.max_streams
+        for offset in range(0, len(tokens), window):
+            streams = []
+            for i, token in enumerate(tokens[offset:offset + window]):
+                index = i % len(self._connections)
+                try:
+                    stream_id = self._get_connection(index).request('POST', '/3/device/%s' % token,
+                                                                    body=body, headers=headers)
+                    streams.append((token, index, stream_id, time.time()))
+                except Exception:
+                    self._reset_connection(index)
+                    result.retry.append(token)
+            for token, index, stream_id, requested_at in streams:
+                try:
+                    response = self._connections[index].get_response(stream_id)
+                    status = response.status
+                    data = response.read()
+                except Exception:
+                    self._reset_connection(index)
+                    result.retry.append(token)
+                    continue
+                result.latencies.append(time.time() - requested_at)
+                if status == 200:
+                    result.sent.append(token)
+                    continue
+                try:
+                    reason = loads(data).get('reason')
+                except Exception:
+                    reason = None
+                if status == 410 or reason in INVALID_TOKEN_REASONS:
+                    result.invalid[token] = reason
+                elif status in RETRY_STATUSES:
+                    result.retry.append(token)
+                else:
+                    result.errors[token] = (status, reason)
+        result.elapsed = time.time() - started_at
+        return result
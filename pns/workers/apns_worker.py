@@ -1,11 +1,20 @@
 # -*- coding: utf-8 -*-
 
+import time
 import logging
 from datetime import timedelta
-from flask.json import loads
 from apns_clerk import APNs, Message, Session
-from pns.utils import get_conf, get_logging_handler, PikaConnectionManager
+from pns.serializers import decode_message, MESSAGE_FORMATS
+from pns.utils import (get_conf, get_conf_value, get_logging_handler, get_stats_logger, PikaConnectionManager,
+                       ConfirmedPublisher)
 from pns.models import db, Device
+from pns.workers.pool import DeliveryPool, BatchingDeliveryPool, SenderStats
+from pns.workers.apns_http2 import (APNsHTTP2Transport, ProviderToken, build_payload,
+                                    PRODUCTION_HOST, SANDBOX_HOST)
+from pns.workers.chunks import PayloadCache, decode_chunk
+from pns.workers.governor import get_governor
+from pns.workers.retry import RetryQueues, get_attempt, parse_delays
+from pns.lanes import PRIORITIES, get_lane, get_lane_weights, get_priority
 
 
 conf = get_conf()
@@ -18,93 +27,261 @@ if conf.getboolean('application', 'debug'):
     logger.setLevel(logging.DEBUG)
 else:
     logger.setLevel(logging.WARNING)
+stats_logger = get_stats_logger(__name__)
+
+# apns transports
+BINARY = 'binary'
+HTTP2 = 'http2'
 
 
 class APNSWorker(object):
     def __init__(self):
-        # apns configuration
-        self.session = Session()
+        # apns configuration, every sender thread keeps its own persistent connection
+        self.transport = get_conf_value(conf, 'apns', 'transport', BINARY)
+        self.pool_size = get_conf_value(conf, 'apns', 'connections', 4, 'getint')
+        self.session = Session(pool_size=self.pool_size)
+        self.apns_connections = [None] * self.pool_size
+        self.stats = [SenderStats('apns connection #%d' % slot) for slot in range(self.pool_size)]
+        # outbound rate shared by worker processes of host and adaptive concurrency of sender threads
+        self.governor = get_governor(conf, 'apns', self.pool_size)
+        # payloads of alerts referenced by compact chunks
+        self.payload_cache = PayloadCache(get_conf_value(conf, 'rabbitmq', 'payload_cache_size', 1000, 'getint'))
+        self.provider_token = None
+        if self.transport == HTTP2 and get_conf_value(conf, 'apns', 'auth', 'certificate') == 'token':
+            self.provider_token = ProviderToken(conf.get('apns', 'key_file'),
+                                                conf.get('apns', 'key_id'),
+                                                conf.get('apns', 'team_id'))
         # rabbitmq configuration
         self.cm = PikaConnectionManager(username=conf.get('rabbitmq', 'username'),
                                         password=conf.get('rabbitmq', 'password'),
                                         host=conf.get('rabbitmq', 'host'),
                                         heartbeat_interval=conf.getint('rabbitmq', 'worker_heartbeat_interval'))
         self.cm.channel.exchange_declare(exchange='pns_exchange', type='direct', durable=True)
-        self.cm.channel.queue_declare(queue='pns_apns_queue', durable=True)
-        self.cm.channel.queue_bind(exchange='pns_exchange', queue='pns_apns_queue', routing_key='pns_apns')
-        self.cm.channel.basic_qos(prefetch_count=1)
-        self.cm.channel.basic_consume(self._callback, queue='pns_apns_queue')
+        for priority in PRIORITIES:
+            self.cm.channel.queue_declare(queue=get_lane('pns_apns_queue', priority), durable=True)
+            self.cm.channel.queue_bind(exchange='pns_exchange', queue=get_lane('pns_apns_queue', priority),
+                                       routing_key=get_lane('pns_apns', priority))
+        # failed tokens are republished to delay queues instead of being retried by sender threads
+        self.publisher = ConfirmedPublisher(self.cm.conn_params, 'pns_exchange')
+        self.publisher.start()
+        self.retries = {}
+        for priority in PRIORITIES:
+            self.retries[priority] = RetryQueues(
+                get_lane('pns_apns', priority), self.publisher,
+                delays=parse_delays(get_conf_value(conf, 'rabbitmq', 'retry_delays', '')),
+                max_attempts=get_conf_value(conf, 'rabbitmq', 'retry_max_attempts', None, 'getint'),
+                content_type=MESSAGE_FORMATS[get_conf_value(conf, 'rabbitmq', 'message_format', 'json')])
+            self.retries[priority].declare(self.cm.channel)
+        # high priority lane is consumed more often while both lanes have deliveries waiting
+        lanes = get_lane_weights(conf, 'pns_apns_queue')
+        prefetch_count = get_conf_value(conf, 'apns', 'prefetch_count', None, 'getint')
+        if get_conf_value(conf, 'apns', 'batching', False, 'getboolean'):
+            # small chunks of identical payloads are merged into sends of up to 1000 tokens
+            self.pool = BatchingDeliveryPool(self.cm, lanes, self.decode, self.send, self.pool_size,
+                                             prefetch_count=prefetch_count,
+                                             max_wait=get_conf_value(conf, 'apns', 'batch_max_wait', 0.05,
+                                                                     'getfloat'),
+                                             on_tick=self._on_tick)
+        else:
+            self.pool = DeliveryPool(self.cm, lanes, self._callback, self.pool_size,
+                                     prefetch_count=prefetch_count, on_tick=self._on_tick)
 
     def start(self):
-        self.cm.channel.start_consuming()
+        self.pool.start()
+
+    def _on_tick(self):
+        # close pooled connections left unused
+        self.session.outdate(timedelta(minutes=5))
+        for stats in self.stats:
+            stats_logger.info(stats)
+        stats_logger.info(self.governor)
+        for retry in self.retries.values():
+            stats_logger.info(retry)
+        if isinstance(self.pool, BatchingDeliveryPool):
+            stats_logger.info('apns batching: %d batches, %d deliveries merged with others' %
+                              (self.pool.flushed, self.pool.merged))
+
+    def get_connection(self, slot):
+        """
+        get persistent apns connection (or HTTP/2 transport) of a sender thread
+        :param slot: index of sender thread
+        :return:
+        """
+        if not self.apns_connections[slot]:
+            if self.transport == HTTP2:
+                if conf.getboolean('application', 'debug'):
+                    host, cert_file = SANDBOX_HOST, conf.get('apns', 'cert_sandbox')
+                else:
+                    host, cert_file = PRODUCTION_HOST, conf.get('apns', 'cert_production')
+                self.apns_connections[slot] = APNsHTTP2Transport(
+                    get_conf_value(conf, 'apns', 'http2_host', '') or host,
+                    topic=get_conf_value(conf, 'apns', 'topic', None),
+                    cert_file=None if self.provider_token else cert_file,
+                    provider_token=self.provider_token,
+                    connections=get_conf_value(conf, 'apns', 'http2_connections', 2, 'getint'),
+                    max_streams=get_conf_value(conf, 'apns', 'http2_max_streams', 100, 'getint'),
+                    secure=get_conf_value(conf, 'apns', 'http2_secure', True, 'getboolean'))
+            elif conf.getboolean('application', 'debug'):
+                self.apns_connections[slot] = self.session.get_connection(
+                    "push_sandbox", cert_file=conf.get('apns', 'cert_sandbox'))
+            else:
+                self.apns_connections[slot] = self.session.get_connection(
+                    "push_production", cert_file=conf.get('apns', 'cert_production'))
+        return self.apns_connections[slot]
 
-    def _callback(self, ch, method, properties, body):
+    def _callback(self, slot, properties, body):
         """
-        send apns notifications
-        :param ch:
-        :param method:
+        send apns notifications, called on sender threads of delivery pool
+        :param slot:
         :param properties:
         :param body:
         :return:
         """
-        self.session.outdate(timedelta(minutes=5))
-        if conf.getboolean('application', 'debug'):
-            self.apns_con = self.session.get_connection("push_sandbox", cert_file=conf.get('apns', 'cert_sandbox'))
-        else:
-            self.apns_con = self.session.get_connection("push_production", cert_file=conf.get('apns', 'cert_production'))
-        message = loads(body)
+        devices, payload = self.decode(properties, body)
+        if payload is not None:
+            self.send(slot, devices, payload, get_attempt(properties))
+
+    def decode(self, properties, body):
+        """
+        :param properties: message properties
+        :param body: message body
+        :return: tokens and alert payload of a chunk, payload is None if alert does not exist
+        """
+        message = decode_message(body, properties.content_type)
         logger.debug('payload: %s' % message)
+        devices, payload = decode_chunk(message, self.payload_cache)
+        if payload is None:
+            logger.error('alert %s of %d apns tokens does not exist' % (message.get('alert_id'), len(devices)))
+        return devices, payload
+
+    def send(self, slot, devices, payload, attempt=0):
+        """
+        send payload to tokens with configured transport, failed ones are scheduled for a delayed retry
+        :param slot: index of sender thread
+        :param list devices: apns tokens
+        :param dict payload: alert payload
+        :param int attempt: number of retries tokens already had
+        :return:
+        """
+        if self.transport == HTTP2:
+            retry = self.send_http2(slot, devices, payload)
+        else:
+            retry = self.send_binary(slot, devices, payload)
+        if retry:
+            routing_key = self.retries[get_priority(payload)].schedule(retry, payload, attempt)
+            logger.warning('%d apns tokens could not be delivered, published to %s' % (len(retry), routing_key))
+
+    def send_binary(self, slot, devices, payload):
+        """
+        send notifications with legacy binary protocol
+        :param slot:
+        :param devices:
+        :param payload:
+        :return: tokens to retry
+        """
         badge = None
         sound = 'default'
         content_available = None
         # time to live
         ttl = timedelta(days=5)
-        if 'apns' in message['payload']:
-            if 'badge' in message['payload']['apns']:
-                badge = message['payload']['apns']['badge']
-            if 'sound' in message['payload']['apns']:
-                sound = message['payload']['apns']['sound']
-            if 'content_available' in message['payload']['apns']:
-                content_available = message['payload']['apns']['content_available']
-        if 'ttl' in message['payload']:
-            ttl = timedelta(seconds=message['payload']['ttl'])
-        message = Message(message['devices'],
-                          alert=message['payload']['alert'],
+        if 'apns' in payload:
+            if 'badge' in payload['apns']:
+                badge = payload['apns']['badge']
+            if 'sound' in payload['apns']:
+                sound = payload['apns']['sound']
+            if 'content_available' in payload['apns']:
+                content_available = payload['apns']['content_available']
+        if 'ttl' in payload:
+            ttl = timedelta(seconds=payload['ttl'])
+        message = Message(devices,
+                          alert=payload['alert'],
                           badge=badge,
                           sound=sound,
                           content_available=content_available,
                           expiry=ttl,
-                          extra=message['payload']['data'] if 'data' in message['payload'] else None)
+                          extra=payload['data'] if 'data' in payload else None)
+        started_at = time.time()
         try:
-            srv = APNs(self.apns_con)
-            response = srv.send(message)
+            response = self.send_message(slot, message)
             logger.debug('apns response: %s' % response)
         except Exception as ex:
-            ch.basic_ack(delivery_tag=method.delivery_tag)
+            self.stats[slot].record(len(devices), time.time() - started_at, len(devices))
             logger.exception(ex)
-            return
+            return devices
+        self.stats[slot].record(len(devices), time.time() - started_at, len(response.failed))
         # Check failures. Check codes in APNs reference docs.
         for token, reason in response.failed.items():
             code, errmsg = reason
             # according to APNs protocol the token reported here
             # is garbage (invalid or empty), stop using and remove it.
             logger.info('delivery failure apns_token: %s, reason: %s' % (token, errmsg))
-            device_obj = Device.query.filter_by(platform_id=token).first()
-            if device_obj:
-                db.session.delete(device_obj)
-        try:
-            db.session.commit()
-        except Exception as ex:
-            db.session.rollback()
-            logger.exception(ex)
+        self.remove_tokens(response.failed.keys())
         # Check failures not related to devices.
         for code, errmsg in response.errors:
             logger.error(errmsg)
         # Check if there are tokens that can be retried
         if response.needs_retry():
-            # repeat with retry_message or reschedule your task
-            srv.send(response.retry())
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+            return response.retry().tokens
+        return []
+
+    def send_message(self, slot, message):
+        """
+        send a binary protocol message through governor
+        :param slot: index of sender thread
+        :param Message message: apns message
+        :return: apns_clerk Result
+        """
+        return self.governor.send(len(message.tokens),
+                                  lambda: APNs(self.get_connection(slot)).send(message),
+                                  lambda response: bool(response.errors))
+
+    def send_http2(self, slot, devices, payload):
+        """
+        send notifications with HTTP/2 provider API, invalid tokens are removed inline
+        :param slot:
+        :param devices:
+        :param payload:
+        :return: tokens to retry
+        """
+        # default time to live value is 5 days (in seconds)
+        ttl = payload.get('ttl', 432000)
+        transport = self.get_connection(slot)
+        apns_payload = build_payload(payload)
+        expiration = int(time.time()) + ttl
+        try:
+            result = self.governor.send(len(devices),
+                                        lambda: transport.send(devices, apns_payload, expiration=expiration),
+                                        lambda result: bool(result.retry))
+            logger.debug('apns response: %r' % result)
+        except Exception as ex:
+            transport.close()
+            self.stats[slot].record(len(devices), 0, len(devices))
+            logger.exception(ex)
+            return devices
+        self.stats[slot].record(len(devices), result.elapsed, len(devices) - len(result.sent), result.latencies)
+        for token, reason in result.invalid.items():
+            logger.info('delivery failure apns_token: %s, reason: %s' % (token, reason))
+        self.remove_tokens(result.invalid.keys())
+        for token, (status, reason) in result.errors.items():
+            logger.error('delivery failure apns_token: %s, status: %s, reason: %s' % (token, status, reason))
+        # temporary failures
+        return result.retry
+
+    def remove_tokens(self, tokens):
+        """
+        remove devices of invalid tokens
+        :param tokens:
+        :return:
+        """
+        if not tokens:
+            return
+        try:
+            deleted = Device.delete_platform_ids(tokens)
+            db.session.commit()
+            logger.info('removed %d devices of invalid apns tokens' % deleted)
+        except Exception as ex:
+            db.session.rollback()
+            logger.exception(ex)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import collections
+from pns.models import db
+from pns.utils import chunked
+
+
+# audience streaming modes of preprocessing worker;
+#   * orm: ORM query with `yield_per`
+#   * cursor: named (server-side) cursor fetching `chunk_size` rows per round-trip
+#   * copy: `COPY (SELECT ...) TO STDOUT`, chunks are split from the byte stream
+STREAM_ORM = 'orm'
+STREAM_CURSOR = 'cursor'
+STREAM_COPY = 'copy'
+STREAM_MODES = [STREAM_ORM, STREAM_CURSOR, STREAM_COPY]
+
+
+def compile_query(query):
+    """
+    compile a query to SQL in psycopg2 parameter style
+    :param query: sqlalchemy Query object
+    :return: tuple of (sql, params)
+    """
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+    return unicode(compiled), compiled.params
+
+
+def estimate_rows(query):
+    """
+    number of rows of a query estimated by query planner, without running it
+    :param query: sqlalchemy Query object
+    :return: estimated number of rows
+    """
+    sql, params = compile_query(query)
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN (FORMAT JSON) %s' % sql, params)
+        plan = cursor.fetchone()[0]
+        cursor.close()
+    finally:
+        connection.rollback()
+        connection.close()
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def stream_orm(query, chunk_size):
+    return chunked(query.yield_per(chunk_size), chunk_size)
+
+
+def stream_cursor(query, chunk_size):
+    sql, params = compile_query(query)
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor(name='pns_audience_%d' % id(query))
+        cursor.itersize = chunk_size
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+        cursor.close()
+    finally:
+        connection.rollback()
+        connection.close()
+
+
+def parse_copy_value(value):
+    # escaping in text format is only needed for backslashes and control characters
+    return value.decode('string_escape') if '\\' in value else value
+
+
+def stream_copy(query, chunk_size):
+    sql, params = compile_query(query)
+    connection = db.engine.raw_connection()
+    read_fd, write_fd = os.pipe()
+    reader = os.fdopen(read_fd, 'rb')
+    errors = []
+
+    def copy():
+        writer = os.fdopen(write_fd, 'wb')
+        try:
+            cursor = connection.cursor()
+            cursor.copy_expert('COPY (%s) TO STDOUT' % cursor.mogrify(sql, params), writer)
+        except Exception as ex:
+            errors.append(ex)
+        finally:
+            try:
+                writer.close()
+            except Exception:
+                pass
+
+    # COPY writes into a pipe on a separate thread, so rows are consumed as they arrive
+    thread = threading.Thread(target=copy)
+    thread.daemon = True
+    thread.start()
+    completed = False
+    try:
+        for chunk in chunked(reader, chunk_size):
+            yield [tuple(parse_copy_value(value) for value in line[:-1].split('\t')) for line in chunk]
+        completed = True
+    finally:
+        reader.close()
+        thread.join()
+        if completed and not errors:
+            connection.rollback()
+        else:
+            # an interrupted COPY leaves the connection in an unknown state
+            connection.invalidate()
+        connection.close()
+    if errors:
+        raise errors[0]
+
+
+def stream_rows(query, chunk_size, mode=STREAM_ORM):
+    """
+    yield result rows of a query in lists of at most `chunk_size` tuples
+    :param query: sqlalchemy Query object
+    :param int chunk_size: number of rows per list
+    :param str mode: one of `STREAM_MODES`
+    """
+    if mode == STREAM_CURSOR:
+        return stream_cursor(query, chunk_size)
+    if mode == STREAM_COPY:
+        return stream_copy(query, chunk_size)
+    return stream_orm(query, chunk_size)
+
+
+def stream_platform_ids(query, chunk_size, mode=STREAM_ORM):
+    """
+    yield `platform_id` values of a device query in lists of at most `chunk_size`
+    :param query: query selecting `Device.platform_id` as the only column
+    :param int chunk_size: number of tokens per list
+    :param str mode: one of `STREAM_MODES`
+    """
+    for rows in stream_rows(query, chunk_size, mode):
+        yield [row[0] for row in rows]
+
+
+def stream_by_platform(query, chunk_size, mode=STREAM_ORM):
+    """
+    route `platform_id` values of a multi-platform device query into per-platform buffers and
+    yield every buffer as soon as it is full
+    :param query: query selecting `Device.platform` and `Device.platform_id`
+    :param int chunk_size: number of tokens per list
+    :param str mode: one of `STREAM_MODES`
+    :return: generator of (platform, list of `platform_id`) tuples
+    """
+    buffers = {}
+    for rows in stream_rows(query, chunk_size, mode):
+        for platform, platform_id in rows:
+            buffer = buffers.setdefault(platform, [])
+            buffer.append(platform_id)
+            if len(buffer) == chunk_size:
+                yield platform, buffer
+                buffers[platform] = []
+    for platform, buffer in buffers.items():
+        if buffer:
+            yield platform, buffer
+
+
+class AudienceCache(object):
+    """
+    size bounded LRU cache of resolved channel audiences. an entry keeps `platform_id` values of every
+    platform packed into a single newline separated string. keys include `audience_version` of the
+    channel, so entries of changed audiences are never hit again and are evicted in time.
+    """
+    def __init__(self, max_bytes):
+        """
+        :param int max_bytes: upper limit of total size of packed entries
+        """
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def entry_size(entry):
+        return sum(len(packed) for packed in entry.values())
+
+    def get(self, key, chunk_size):
+        """
+        :param key: hashable cache key
+        :param int chunk_size: number of tokens per list
+        :return: generator of (platform, list of `platform_id`) tuples or None if key is not cached
+        """
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # move to the most recently used end
+        self.entries[key] = entry
+        return self._iter_entry(entry, chunk_size)
+
+    @staticmethod
+    def _iter_entry(entry, chunk_size):
+        for platform, packed in entry.items():
+            tokens = packed.split('\n') if packed else []
+            for offset in range(0, len(tokens), chunk_size):
+                yield platform, tokens[offset:offset + chunk_size]
+
+    def count(self, key):
+        """
+        :param key: hashable cache key
+        :return: number of tokens of a cached audience or None if key is not cached, neither a hit nor a miss
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        return sum(packed.count('\n') + 1 for packed in entry.values() if packed)
+
+    def put(self, key, entry):
+        """
+        :param key: hashable cache key
+        :param dict entry: platform to packed `platform_id` values
+        """
+        size = self.entry_size(entry)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.size -= self.entry_size(self.entries.pop(key))
+        while self.entries and self.size + size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= self.entry_size(evicted)
+            self.evictions += 1
+        self.entries[key] = entry
+        self.size += size
+
+    def capture(self, key, chunks):
+        """
+        pass through chunks of a resolved audience and cache them once the audience is exhausted.
+        collecting stops as soon as the audience does not fit into the cache.
+        :param key: hashable cache key
+        :param chunks: generator of (platform, list of `platform_id`) tuples
+        """
+        collected = {}
+        size = 0
+        for platform, tokens in chunks:
+            if collected is not None:
+                collected.setdefault(platform, []).extend(tokens)
+                size += sum(len(token) + 1 for token in tokens)
+                if size > self.max_bytes:
+                    collected = None
+            yield platform, tokens
+        if collected is not None:
+            self.put(key, {platform: u'\n'.join(tokens).encode('utf-8') for platform, tokens in collected.items()})
+
+    def __str__(self):
+        requests = max(self.hits + self.misses, 1)
+        return ('audience cache: %d entries, %.1f/%.1f MB, %d hits, %d misses (%.0f%% hit rate), %d evictions' %
+                (len(self.entries), self.size / 1048576.0, self.max_bytes / 1048576.0, self.hits, self.misses,
+                 100.0 * self.hits / requests, self.evictions))
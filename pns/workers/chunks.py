@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+import re
+import base64
+import binascii
+import threading
+import collections
+from pns.models import db, Alert
+
+
+# chunk message formats published by preprocessing worker;
+#   * full: `{'devices': [tokens], 'payload': payload}`, alert payload is copied into every chunk
+#   * compact: `{'alert_id': id, 'tokens': packed}`, payload is loaded once by sender workers. APNs
+#     tokens are packed as base64 of concatenated 32 byte binary tokens, other tokens are joined with
+#     newlines. alerts not saved to database still carry their payload.
+FORMAT_FULL = 'full'
+FORMAT_COMPACT = 'compact'
+APNS_TOKEN_LENGTH = 32
+# only lower case tokens are packed, unpacked tokens must match `platform_id` values of devices
+APNS_TOKEN_RE = re.compile(r'^[0-9a-f]{%d}$' % (2 * APNS_TOKEN_LENGTH))
+
+
+def pack_tokens(tokens):
+    """
+    :param list tokens: device tokens
+    :return: tuple of (encoding, packed string)
+    """
+    if tokens and all(APNS_TOKEN_RE.match(token) for token in tokens):
+        return 'apns', base64.b64encode(''.join(binascii.unhexlify(token) for token in tokens))
+    return 'lines', u'\n'.join(tokens)
+
+
+def unpack_tokens(encoding, packed):
+    """
+    :param str encoding: `apns` or `lines`
+    :param packed: packed tokens
+    :return: list of tokens
+    """
+    if encoding == 'apns':
+        data = base64.b64decode(packed)
+        return [binascii.hexlify(data[offset:offset + APNS_TOKEN_LENGTH])
+                for offset in range(0, len(data), APNS_TOKEN_LENGTH)]
+    return packed.split(u'\n') if packed else []
+
+
+def encode_chunk(tokens, payload, alert_id=None, chunk_format=FORMAT_FULL):
+    """
+    :param list tokens: device tokens
+    :param dict payload: alert payload
+    :param int alert_id: ID of the saved alert
+    :param str chunk_format: `full` or `compact`
+    :return: chunk message
+    """
+    if chunk_format != FORMAT_COMPACT:
+        return {'devices': tokens, 'payload': payload}
+    encoding, packed = pack_tokens(tokens)
+    message = {'encoding': encoding, 'tokens': packed}
+    if alert_id:
+        message['alert_id'] = alert_id
+    else:
+        message['payload'] = payload
+    return message
+
+
+class PayloadCache(object):
+    """
+    thread-safe LRU cache of alert payloads, referenced by `alert_id` of compact chunk messages
+    """
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, alert_id):
+        """
+        :param int alert_id: ID of the alert
+        :return: payload or None if alert does not exist
+        """
+        with self.lock:
+            payload = self.entries.pop(alert_id, None)
+            if payload is not None:
+                self.hits += 1
+                self.entries[alert_id] = payload
+                return payload
+            self.misses += 1
+        try:
+            payload = db.session.query(Alert.payload).filter(Alert.id == alert_id).scalar()
+        finally:
+            db.session.rollback()
+        if payload is None:
+            return None
+        with self.lock:
+            self.entries[alert_id] = payload
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return payload
+
+
+def decode_chunk(message, payload_cache):
+    """
+    :param dict message: chunk message in any format
+    :param PayloadCache payload_cache: cache to resolve `alert_id` references
+    :return: tuple of (tokens, payload), payload is None if referenced alert does not exist.
+        payload may be shared, it must not be modified
+    """
+    if 'devices' in message:
+        return message['devices'], message['payload']
+    tokens = unpack_tokens(message['encoding'], message['tokens'])
+    if 'payload' in message:
+        return tokens, message['payload']
+    return tokens, payload_cache.get(message['alert_id'])
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+import time
+import random
+import calendar
+import requests
+from email.utils import parsedate
+from requests.adapters import HTTPAdapter
+from pns.serializers import dumps, loads
+
+
+GCM_URL = 'https://gcm-http.googleapis.com/gcm/send'
+# errors meaning the registration id is no longer valid, device should be removed
+INVALID_REGISTRATION_ERRORS = ['NotRegistered', 'InvalidRegistration', 'MismatchSenderId']
+# per registration id errors worth to retry later
+RETRY_ERRORS = ['Unavailable', 'InternalServerError']
+
+
+class GCMError(Exception):
+    """request is rejected and retrying it would not help (malformed request, authentication error)
+    """
+    pass
+
+
+def get_retry_after(headers):
+    """
+    parse `Retry-After` header, either delay in seconds or an HTTP-date
+    :param headers: response headers
+    :return: seconds to wait or None
+    """
+    value = headers.get('Retry-After')
+    if not value:
+        return None
+    if value.isdigit():
+        return int(value)
+    parsed = parsedate(value)
+    if parsed is None:
+        return None
+    return max(calendar.timegm(parsed) - time.time(), 0)
+
+
+class GCMResult(object):
+    """outcome of sending a message to a list of registration ids
+    """
+    def __init__(self):
+        self.success = 0
+        # error: [registration ids]
+        self.errors = {}
+        # registration id: canonical id
+        self.canonical = {}
+        # registration ids still failing after all attempts
+        self.retry = []
+        # number of HTTP requests made
+        self.requests = 0
+        # seconds to send whole list, including backoff delays
+        self.elapsed = 0.0
+
+    def __repr__(self):
+        return ('<GCMResult success: %d, errors: %d, canonical: %d, retry: %d, requests: %d>' %
+                (self.success, sum(len(ids) for ids in self.errors.values()), len(self.canonical),
+                 len(self.retry), self.requests))
+
+
+class GCMTransport(object):
+    """
+    send messages through GCM HTTP connection server over a keep-alive connection pool. transport
+    is shared by sender threads, every thread keeps a batch in flight and up to `connections`
+    connections are reused between them.
+
+    failed batches are retried with exponential backoff, delay announced by `Retry-After` header
+    is honored. registration ids failed with `Unavailable` or `InternalServerError` are retried
+    the same way, other ids of the batch are not sent again.
+    """
+    def __init__(self, api_key, url=GCM_URL, connections=8, timeout=10, max_retries=5, backoff=1.0,
+                 max_backoff=64.0, governor=None):
+        """
+        :param str api_key: server key
+        :param str url: GCM HTTP connection server address
+        :param int connections: maximum number of pooled keep-alive connections
+        :param float timeout: connect and read timeout of every request (in seconds)
+        :param int max_retries: number of retries of a batch
+        :param float backoff: initial backoff delay (in seconds), doubled on every retry
+        :param float max_backoff: upper limit of backoff delay (in seconds)
+        :param pns.workers.governor.Governor governor: rate and concurrency governor of requests
+        """
+        self.url = url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.governor = governor
+        self.session = requests.Session()
+        self.session.headers.update({'Authorization': 'key=%s' % api_key,
+                                     'Content-Type': 'application/json'})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connections, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def close(self):
+        self.session.close()
+
+    def get_delay(self, attempt, retry_after=None):
+        """
+        :param int attempt: number of failed attempts so far
+        :param retry_after: delay requested by server
+        :return: seconds to wait before next attempt
+        """
+        delay = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+        # jitter spreads retries of concurrent batches
+        delay = delay / 2 + random.random() * delay
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def send(self, registration_ids, data, collapse_key=None, delay_while_idle=False, time_to_live=None):
+        """
+        send same message to all registration ids (at most 1000)
+        :param list registration_ids:
+        :param dict data: payload of the message
+        :param str collapse_key:
+        :param bool delay_while_idle:
+        :param int time_to_live: in seconds
+        :return: GCMResult
+        :raises GCMError: if the request is rejected
+        """
+        message = {'data': data, 'delay_while_idle': delay_while_idle}
+        if collapse_key:
+            message['collapse_key'] = collapse_key
+        if time_to_live is not None:
+            message['time_to_live'] = time_to_live
+        result = GCMResult()
+        started_at = time.time()
+        pending = list(registration_ids)
+        attempt = 0
+        retry_after = None
+        while pending:
+            if attempt:
+                if attempt > self.max_retries:
+                    result.retry = pending
+                    break
+                time.sleep(self.get_delay(attempt, retry_after))
+            attempt += 1
+            retry_after = None
+            message['registration_ids'] = pending
+            result.requests += 1
+            if self.governor:
+                self.governor.acquire(len(pending))
+            request_started_at = time.time()
+            # throttling, unavailability and connection errors slow down the governor
+            overloaded = True
+            try:
+                response = self.session.post(self.url, data=dumps(message), timeout=self.timeout)
+            except requests.RequestException:
+                continue
+            else:
+                if response.status_code in (400, 401):
+                    overloaded = False
+                if response.status_code == 400:
+                    raise GCMError('request could not be parsed as JSON: %s' % response.text)
+                if response.status_code == 401:
+                    raise GCMError('there was an error authenticating the sender account')
+                retry_after = get_retry_after(response.headers)
+                if response.status_code != 200:
+                    # 5xx, retry the whole batch
+                    continue
+                failed = []
+                for reg_id, item in zip(pending, loads(response.content)['results']):
+                    error = item.get('error')
+                    if error in RETRY_ERRORS:
+                        failed.append(reg_id)
+                    elif error:
+                        result.errors.setdefault(error, []).append(reg_id)
+                    else:
+                        result.success += 1
+                        if 'registration_id' in item:
+                            result.canonical[reg_id] = item['registration_id']
+                overloaded = bool(failed)
+            finally:
+                if self.governor:
+                    self.governor.release(overloaded, time.time() - request_started_at)
+            pending = failed
+        result.elapsed = time.time() - started_at
+        return result
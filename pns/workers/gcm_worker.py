@@ -1,10 +1,16 @@
 # -*- coding: utf-8 -*-
 
 import logging
-from flask.json import loads
-from gcm import GCM
-from pns.utils import get_conf, get_logging_handler, PikaConnectionManager
+from pns.serializers import decode_message, MESSAGE_FORMATS
+from pns.utils import (get_conf, get_conf_value, get_logging_handler, get_stats_logger, PikaConnectionManager,
+                       ConfirmedPublisher)
 from pns.models import db, Device
+from pns.workers.pool import DeliveryPool, BatchingDeliveryPool, SenderStats
+from pns.workers.gcm_http import GCMTransport, GCMError, GCM_URL, INVALID_REGISTRATION_ERRORS
+from pns.workers.chunks import PayloadCache, decode_chunk
+from pns.workers.governor import get_governor
+from pns.workers.retry import RetryQueues, get_attempt, parse_delays
+from pns.lanes import PRIORITIES, get_lane, get_lane_weights, get_priority
 
 
 conf = get_conf()
@@ -17,103 +23,174 @@ if conf.getboolean('application', 'debug'):
     logger.setLevel(logging.DEBUG)
 else:
     logger.setLevel(logging.WARNING)
+stats_logger = get_stats_logger(__name__)
 
 
 class GCMWorker(object):
     def __init__(self):
-        # GCM configuration
-        self.gcm = GCM(conf.get('gcm', 'key'))
-        if conf.getboolean('application', 'debug'):
-            GCM.enable_logging(logging.DEBUG, get_logging_handler())
-        else:
-            GCM.enable_logging(logging.ERROR, get_logging_handler())
+        # GCM configuration, sender threads share the keep-alive connection pool of transport
+        self.pool_size = get_conf_value(conf, 'gcm', 'connections', 8, 'getint')
+        # outbound rate shared by worker processes of host and adaptive concurrency of sender threads
+        self.governor = get_governor(conf, 'gcm', self.pool_size)
+        self.transport = GCMTransport(conf.get('gcm', 'key'),
+                                      url=get_conf_value(conf, 'gcm', 'url', GCM_URL),
+                                      connections=self.pool_size,
+                                      max_retries=get_conf_value(conf, 'gcm', 'max_retries', 2, 'getint'),
+                                      governor=self.governor)
+        self.stats = [SenderStats('gcm sender #%d' % slot) for slot in range(self.pool_size)]
+        # payloads of alerts referenced by compact chunks
+        self.payload_cache = PayloadCache(get_conf_value(conf, 'rabbitmq', 'payload_cache_size', 1000, 'getint'))
         # rabbitmq configuration
         self.cm = PikaConnectionManager(username=conf.get('rabbitmq', 'username'),
                                         password=conf.get('rabbitmq', 'password'),
                                         host=conf.get('rabbitmq', 'host'),
                                         heartbeat_interval=conf.getint('rabbitmq', 'worker_heartbeat_interval'))
         self.cm.channel.exchange_declare(exchange='pns_exchange', type='direct', durable=True)
-        self.cm.channel.queue_declare(queue='pns_gcm_queue', durable=True)
-        self.cm.channel.queue_bind(exchange='pns_exchange', queue='pns_gcm_queue', routing_key='pns_gcm')
-        self.cm.channel.basic_qos(prefetch_count=1)
-        self.cm.channel.basic_consume(self._callback, queue='pns_gcm_queue')
+        for priority in PRIORITIES:
+            self.cm.channel.queue_declare(queue=get_lane('pns_gcm_queue', priority), durable=True)
+            self.cm.channel.queue_bind(exchange='pns_exchange', queue=get_lane('pns_gcm_queue', priority),
+                                       routing_key=get_lane('pns_gcm', priority))
+        # failed registration ids are republished to delay queues instead of being retried by sender threads
+        self.publisher = ConfirmedPublisher(self.cm.conn_params, 'pns_exchange')
+        self.publisher.start()
+        self.retries = {}
+        for priority in PRIORITIES:
+            self.retries[priority] = RetryQueues(
+                get_lane('pns_gcm', priority), self.publisher,
+                delays=parse_delays(get_conf_value(conf, 'rabbitmq', 'retry_delays', '')),
+                max_attempts=get_conf_value(conf, 'rabbitmq', 'retry_max_attempts', None, 'getint'),
+                content_type=MESSAGE_FORMATS[get_conf_value(conf, 'rabbitmq', 'message_format', 'json')])
+            self.retries[priority].declare(self.cm.channel)
+        # high priority lane is consumed more often while both lanes have deliveries waiting
+        lanes = get_lane_weights(conf, 'pns_gcm_queue')
+        prefetch_count = get_conf_value(conf, 'gcm', 'prefetch_count', None, 'getint')
+        if get_conf_value(conf, 'gcm', 'batching', False, 'getboolean'):
+            # small chunks of identical payloads are merged into requests of up to 1000 registration ids
+            self.pool = BatchingDeliveryPool(self.cm, lanes, self.decode, self.send, self.pool_size,
+                                             prefetch_count=prefetch_count,
+                                             max_wait=get_conf_value(conf, 'gcm', 'batch_max_wait', 0.05, 'getfloat'),
+                                             on_tick=self._on_tick)
+        else:
+            self.pool = DeliveryPool(self.cm, lanes, self._callback, self.pool_size,
+                                     prefetch_count=prefetch_count, on_tick=self._on_tick)
 
     def start(self):
-        self.cm.channel.start_consuming()
+        self.pool.start()
+
+    def _on_tick(self):
+        for stats in self.stats:
+            stats_logger.info(stats)
+        stats_logger.info(self.governor)
+        for retry in self.retries.values():
+            stats_logger.info(retry)
+        if isinstance(self.pool, BatchingDeliveryPool):
+            stats_logger.info('gcm batching: %d batches, %d deliveries merged with others' %
+                              (self.pool.flushed, self.pool.merged))
 
-    def _callback(self, ch, method, properties, body):
+    def _callback(self, slot, properties, body):
         """
-        send gcm notifications
-        :param ch:
-        :param method:
+        send gcm notifications, called on sender threads of delivery pool. delivery is acknowledged
+        when the batch is completed (including retries)
+        :param slot:
         :param properties:
         :param body:
         :return:
         """
-        message = loads(body)
+        devices, payload = self.decode(properties, body)
+        if payload is not None:
+            self.send(slot, devices, payload, get_attempt(properties))
+
+    def decode(self, properties, body):
+        """
+        :param properties: message properties
+        :param body: message body
+        :return: registration ids and alert payload of a chunk, payload is None if alert does not exist
+        """
+        message = decode_message(body, properties.content_type)
         logger.debug('payload: %s' % message)
+        devices, payload = decode_chunk(message, self.payload_cache)
+        if payload is None:
+            logger.error('alert %s of %d gcm registration ids does not exist' % (message.get('alert_id'),
+                                                                               len(devices)))
+        return devices, payload
+
+    def send(self, slot, devices, payload, attempt=0):
+        """
+        send payload to at most 1000 registration ids, failed ones are scheduled for a delayed retry
+        :param slot: index of sender thread
+        :param list devices: registration ids
+        :param dict payload: alert payload
+        :param int attempt: number of retries registration ids already had
+        :return:
+        """
         # default time to live value is 5 days (in seconds)
         ttl = 432000
         collapse_key = None
         delay_while_idle = False
-        if 'gcm' in message['payload']:
-            if 'collapse_key' in message['payload']['gcm']:
-                collapse_key = message['payload']['gcm']['collapse_key']
-            if 'delay_while_idle' in message['payload']['gcm']:
-                delay_while_idle = message['payload']['gcm']['delay_while_idle']
-        if 'ttl' in message['payload']:
-            if 0 < message['payload']['ttl'] < 2419200:
-                ttl = message['payload']['ttl']
+        if 'gcm' in payload:
+            if 'collapse_key' in payload['gcm']:
+                collapse_key = payload['gcm']['collapse_key']
+            if 'delay_while_idle' in payload['gcm']:
+                delay_while_idle = payload['gcm']['delay_while_idle']
+        if 'ttl' in payload:
+            if 0 < payload['ttl'] < 2419200:
+                ttl = payload['ttl']
             else:
                 # use default value
                 logger.warning('`time_to_live` is out of boundary')
-        if 'data' not in message['payload']:
-            message['payload']['data'] = {}
-        message['payload']['data']['alert'] = message['payload']['alert']
+        # cached payloads are shared by sender threads, data is copied instead of modified
+        data = dict(payload.get('data', {}))
+        data['alert'] = payload['alert']
         try:
-            response = self.gcm.json_request(registration_ids=message['devices'],
-                                             data=message['payload']['data'],
-                                             collapse_key=collapse_key,
-                                             delay_while_idle=delay_while_idle,
-                                             time_to_live=ttl)
-            logger.debug('gcm response: %s' % response)
+            response = self.transport.send(devices,
+                                           data=data,
+                                           collapse_key=collapse_key,
+                                           delay_while_idle=delay_while_idle,
+                                           time_to_live=ttl)
+            logger.debug('gcm response: %r' % response)
+        except GCMError as ex:
+            # rejected request, retrying it would not help
+            self.stats[slot].record(len(devices), 0, len(devices))
+            logger.exception(ex)
+            return
         except Exception as ex:
-            ch.basic_ack(delivery_tag=method.delivery_tag)
+            self.stats[slot].record(len(devices), 0, len(devices))
             logger.exception(ex)
+            self.retries[get_priority(payload)].schedule(devices, payload, attempt)
+            return
+        self.stats[slot].record(len(devices), response.elapsed, len(devices) - response.success)
+        if response.retry:
+            routing_key = self.retries[get_priority(payload)].schedule(response.retry, payload, attempt)
+            logger.warning('%d gcm registration ids could not be delivered after %d requests, published to %s' %
+                           (len(response.retry), response.requests, routing_key))
+        invalid = []
+        for error, reg_ids in response.errors.items():
+            # Check for errors and act accordingly
+            if error in INVALID_REGISTRATION_ERRORS:
+                invalid.extend(reg_ids)
+            else:
+                logger.error('delivery failure gcm error: %s, %d registration ids' % (error, len(reg_ids)))
+        self.cleanup(invalid, response.canonical)
+
+    def cleanup(self, invalid, canonical):
+        """
+        remove devices of invalid registration ids and replace stale ones with canonical ids,
+        all in a single transaction
+        :param list invalid: invalid registration ids
+        :param dict canonical: stale registration id to canonical id
+        :return:
+        """
+        if not invalid and not canonical:
             return
-        # Handling errors
-        if 'errors' in response:
-            for error, reg_ids in response['errors'].items():
-                # Check for errors and act accordingly
-                if error in ['NotRegistered', 'InvalidRegistration', 'MismatchSenderId']:
-                    # Remove reg_ids from database
-                    for reg_id in reg_ids:
-                        device_obj = Device.query.filter_by(platform_id=reg_id).first()
-                        if device_obj:
-                            db.session.delete(device_obj)
-            try:
-                db.session.commit()
-            except Exception as ex:
-                db.session.rollback()
-                logger.exception(ex)
-        if 'canonical' in response:
-            for reg_id, canonical_id in response['canonical'].items():
-                # Replace reg_id with canonical_id in your database
-                device_obj = Device.query.filter_by(platform_id=reg_id).first()
-                if device_obj:
-                    if Device.query.filter_by(platform_id=canonical_id).first():
-                        # canonical_id has already registered by client, just delete stale reg_id
-                        db.session.delete(device_obj)
-                    else:
-                        # replace with canonical_id
-                        device_obj.platform_id = canonical_id
-                        db.session.add(device_obj)
-                    try:
-                        db.session.commit()
-                    except Exception as ex:
-                        db.session.rollback()
-                        logger.exception(ex)
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+        try:
+            deleted = Device.delete_platform_ids(invalid)
+            replaced, duplicates = Device.replace_platform_ids(canonical)
+            db.session.commit()
+            logger.info('removed %d invalid devices, replaced %d and removed %d duplicate devices by canonical ids' %
+                        (deleted, replaced, duplicates))
+        except Exception as ex:
+            db.session.rollback()
+            logger.exception(ex)
 
 
 if __name__ == '__main__':
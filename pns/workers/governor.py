@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import errno
+import fcntl
+import struct
+import tempfile
+import threading
+from pns.utils import get_conf_value
+
+
+# bucket state; available tokens and time of last refill
+STATE = struct.Struct('>dd')
+
+
+class TokenBucket(object):
+    """token bucket shared by worker processes of a host through a locked state file
+
+    every process refills the bucket by the time elapsed since the last update while it holds the
+    lock, so no coordinator process is needed. tokens are reserved even if the bucket runs into debt
+    and callers sleep until their reservation is covered, so requests larger than `burst` are
+    admitted with a proportional delay instead of waiting forever.
+    """
+    def __init__(self, path, rate, burst=None):
+        """
+        :param str path: path of state file, processes using the same file share the rate
+        :param float rate: tokens added per second
+        :param float burst: maximum number of tokens, defaults to `rate`
+        """
+        self.path = path
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.lock = threading.Lock()
+        self.pid = None
+        self.fd = None
+
+    def _open(self):
+        # locks belong to open files, a forked process opens its own
+        if self.pid != os.getpid():
+            try:
+                os.makedirs(os.path.dirname(self.path))
+            except OSError as ex:
+                if ex.errno != errno.EEXIST:
+                    raise
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            self.pid = os.getpid()
+        return self.fd
+
+    def reserve(self, tokens):
+        """
+        :param int tokens: number of tokens to take
+        :return: seconds to wait until reserved tokens are available
+        """
+        # flock does not exclude threads sharing the file, they are serialized by the thread lock
+        with self.lock:
+            fd = self._open()
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                os.lseek(fd, 0, os.SEEK_SET)
+                data = os.read(fd, STATE.size)
+                now = time.time()
+                if len(data) == STATE.size:
+                    available, updated_at = STATE.unpack(data)
+                    available = min(self.burst, available + max(now - updated_at, 0) * self.rate)
+                else:
+                    available = self.burst
+                available -= tokens
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.write(fd, STATE.pack(available, now))
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        return max(-available / self.rate, 0)
+
+    def consume(self, tokens):
+        """take tokens, sleep until they are available
+        :param int tokens: number of tokens to take
+        :return: seconds slept
+        """
+        delay = self.reserve(tokens)
+        if delay:
+            time.sleep(delay)
+        return delay
+
+
+class AdaptiveConcurrency(object):
+    """AIMD limit of concurrent requests of a process
+
+    the limit grows by one after as many successful requests as the limit (about once per round of
+    requests) and is multiplied by `decrease` when a request is overloaded (throttled, unavailable or
+    slower than `target_latency`), at most once per `cooldown` seconds, so a burst of failures of
+    requests already in flight does not collapse it.
+    """
+    def __init__(self, max_limit, min_limit=1, decrease=0.5, target_latency=None, cooldown=1.0):
+        """
+        :param int max_limit: maximum number of concurrent requests, also the initial limit
+        :param int min_limit: minimum number of concurrent requests
+        :param float decrease: multiplier of limit on overload
+        :param float target_latency: requests slower than this are considered overloaded (in seconds)
+        :param float cooldown: minimum time between decreases (in seconds)
+        """
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.decrease = decrease
+        self.target_latency = target_latency
+        self.cooldown = cooldown
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.successes = 0
+        self.decreased_at = 0
+        self.decreases = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= max(int(self.limit), self.min_limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, overloaded=False, latency=None):
+        """
+        :param bool overloaded: request failed by throttling or temporary unavailability
+        :param float latency: duration of request (in seconds)
+        """
+        with self.condition:
+            self.in_flight -= 1
+            if self.target_latency and latency is not None and latency > self.target_latency:
+                overloaded = True
+            if overloaded:
+                now = time.time()
+                if now - self.decreased_at >= self.cooldown:
+                    self.limit = max(self.limit * self.decrease, self.min_limit)
+                    self.decreased_at = now
+                    self.decreases += 1
+                self.successes = 0
+            else:
+                self.successes += 1
+                if self.successes >= self.limit:
+                    self.limit = min(self.limit + 1, self.max_limit)
+                    self.successes = 0
+            self.condition.notify_all()
+
+
+class Governor(object):
+    """outbound rate and concurrency of a provider; a request takes a concurrency slot and its tokens
+    from the shared bucket before it is sent, and reports its outcome when it is completed
+    """
+    def __init__(self, name, concurrency, bucket=None):
+        """
+        :param str name: provider name used in logs
+        :param AdaptiveConcurrency concurrency: concurrency limit of this process
+        :param TokenBucket bucket: rate limit shared by processes, None for no rate limit
+        """
+        self.name = name
+        self.concurrency = concurrency
+        self.bucket = bucket
+        self.throttled = 0.0
+
+    def acquire(self, tokens):
+        """
+        :param int tokens: number of tokens (devices) of request
+        """
+        self.concurrency.acquire()
+        if self.bucket:
+            try:
+                self.throttled += self.bucket.consume(tokens)
+            except Exception:
+                self.concurrency.release()
+                raise
+
+    def release(self, overloaded=False, latency=None):
+        """
+        :param bool overloaded: request failed by throttling or temporary unavailability
+        :param float latency: duration of request (in seconds)
+        """
+        self.concurrency.release(overloaded, latency)
+
+    def send(self, tokens, send, overloaded):
+        """call `send` within a concurrency slot after taking tokens from bucket
+        :param int tokens: number of tokens (devices) of request
+        :param send: function sending the request
+        :param overloaded: function telling if the result of `send` shows an overloaded provider,
+            exceptions are always considered overloaded
+        :return: result of `send`
+        """
+        self.acquire(tokens)
+        started_at = time.time()
+        is_overloaded = True
+        try:
+            result = send()
+            is_overloaded = overloaded(result)
+            return result
+        finally:
+            self.release(is_overloaded, time.time() - started_at)
+
+    def __str__(self):
+        return ('%s governor: concurrency limit %.1f, %d in flight, %d decreases, %.1fs throttled by rate limit' %
+                (self.name, self.concurrency.limit, self.concurrency.in_flight, self.concurrency.decreases,
+                 self.throttled))
+
+
+def get_governor(conf, section, connections):
+    """
+    build governor of a provider from its config section
+    :param conf: ConfigParser object
+    :param str section: `gcm` or `apns`
+    :param int connections: number of sender threads, the maximum concurrency
+    :return: Governor object
+    """
+    concurrency = AdaptiveConcurrency(connections,
+                                      target_latency=get_conf_value(conf, section, 'target_latency', None, 'getfloat'))
+    bucket = None
+    rate = get_conf_value(conf, section, 'rate_limit', 0, 'getfloat')
+    if rate > 0:
+        directory = get_conf_value(conf, 'application', 'governor_dir',
+                                   os.path.join(tempfile.gettempdir(), 'pns_governor'))
+        bucket = TokenBucket(os.path.join(directory, '%s.bucket' % section), rate,
+                             get_conf_value(conf, section, 'rate_burst', None, 'getfloat'))
+    return Governor(section, concurrency, bucket)
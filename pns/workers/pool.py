@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import Queue
+import logging
+import functools
+import threading
+import collections
+from pns.utils import get_conf, get_logging_handler
+from pns.workers.retry import get_attempt
+
+
+conf = get_conf()
+
+# configure logger
+logger = logging.getLogger(__name__)
+logger.addHandler(get_logging_handler())
+if conf.getboolean('application', 'debug'):
+    logger.setLevel(logging.DEBUG)
+else:
+    logger.setLevel(logging.WARNING)
+
+# fields of alert payload which make up the notification sent to providers; deliveries differing only
+# in other fields (recipients, audience filters, scheduling) are merged
+PROVIDER_FIELDS = ('alert', 'data', 'ttl', 'gcm', 'apns')
+
+
+def get_merge_key(payload):
+    """
+    :param dict payload: alert payload
+    :return: serialized provider fields of payload
+    """
+    return json.dumps({field: payload[field] for field in PROVIDER_FIELDS if field in payload}, sort_keys=True)
+
+
+class SenderStats(object):
+    """throughput counters of a single sender connection
+    """
+    def __init__(self, name):
+        self.name = name
+        self.messages = 0
+        self.tokens = 0
+        self.failures = 0
+        self.busy = 0.0
+        self.started_at = time.time()
+        # recent chunk and per-token latencies (in seconds)
+        self.chunk_latencies = collections.deque(maxlen=1000)
+        self.token_latencies = collections.deque(maxlen=10000)
+
+    def record(self, tokens, elapsed, failures=0, latencies=None):
+        """
+        :param int tokens: number of tokens sent
+        :param float elapsed: time spent for sending (in seconds)
+        :param int failures: number of failed tokens
+        :param list latencies: per-token latencies if transport can measure them
+        """
+        self.messages += 1
+        self.tokens += tokens
+        self.failures += failures
+        self.busy += elapsed
+        self.chunk_latencies.append(elapsed)
+        if latencies:
+            self.token_latencies.extend(latencies)
+
+    @staticmethod
+    def percentile(values, percent):
+        if not values:
+            return 0.0
+        values = sorted(values)
+        return values[min(int(len(values) * percent / 100.0), len(values) - 1)]
+
+    def __str__(self):
+        uptime = max(time.time() - self.started_at, 0.001)
+        text = ('%s: %d messages, %d tokens, %d failures, %.1f tokens/s, %.0f%% busy, '
+                'chunk latency p50 %.3fs p99 %.3fs' %
+                (self.name, self.messages, self.tokens, self.failures,
+                 self.tokens / uptime, 100 * self.busy / uptime,
+                 self.percentile(self.chunk_latencies, 50), self.percentile(self.chunk_latencies, 99)))
+        if self.token_latencies:
+            text += (', token latency p50 %.3fs p99 %.3fs' %
+                     (self.percentile(self.token_latencies, 50), self.percentile(self.token_latencies, 99)))
+        return text
+
+
+class WeightedQueue(object):
+    """FIFO queues of several lanes, `get` takes items of lanes with waiting items in proportion to
+    their weights (smooth weighted round robin), so a busy lane never starves the others
+    """
+    def __init__(self, weights):
+        """
+        :param dict weights: lane name to weight
+        """
+        self.weights = weights
+        self.items = dict((lane, collections.deque()) for lane in weights)
+        self.credits = dict((lane, 0) for lane in weights)
+        self.condition = threading.Condition()
+
+    def put(self, lane, item):
+        with self.condition:
+            self.items[lane].append(item)
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        """
+        :param float timeout: maximum time to wait for an item (in seconds), None to wait forever
+        :return: (lane, item)
+        :raises Queue.Empty: if no item is available in `timeout` seconds
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.condition:
+            while not self.qsize():
+                remaining = deadline - time.time() if deadline is not None else 1
+                if remaining <= 0:
+                    raise Queue.Empty()
+                # wait with a timeout, otherwise signals can't interrupt the worker
+                self.condition.wait(min(remaining, 1))
+            lanes = [lane for lane in self.items if self.items[lane]]
+            for lane in self.items:
+                if lane in lanes:
+                    self.credits[lane] += self.weights[lane]
+                else:
+                    self.credits[lane] = 0
+            lane = max(lanes, key=lambda name: self.credits[name])
+            self.credits[lane] -= sum(self.weights[name] for name in lanes)
+            return lane, self.items[lane].popleft()
+
+    def qsize(self):
+        return sum(len(items) for items in self.items.values())
+
+
+class DeliveryPool(object):
+    """handle RabbitMQ deliveries concurrently on a pool of sender threads
+
+    consumer callback only queues deliveries, sender threads run `handler` and report completed
+    deliveries back. pika connections are not thread-safe, so deliveries are acknowledged on the
+    consumer thread and only after their handler returns. deliveries of several queues (priority
+    lanes) are handled in proportion to the weights of their queues.
+    """
+    def __init__(self, cm, queue, handler, size, prefetch_count=None, tick_interval=60, on_tick=None):
+        """
+        :param pns.utils.PikaConnectionManager cm: RabbitMQ connection manager
+        :param queue: queue name to consume, or dict of queue names to weights
+        :param handler: called as `handler(slot, properties, body)` on sender threads, `slot` is
+            the index of the thread to keep per-thread resources (connections etc.)
+        :param int size: number of sender threads
+        :param int prefetch_count: number of unacknowledged deliveries per queue, defaults to twice of `size`
+        :param float tick_interval: how often `on_tick` is called (in seconds)
+        :param on_tick: called periodically on consumer thread
+        """
+        self.cm = cm
+        self.queues = queue if isinstance(queue, dict) else {queue: 1}
+        self.handler = handler
+        self.size = size
+        self.prefetch_count = prefetch_count or 2 * size
+        self.tick_interval = tick_interval
+        self.on_tick = on_tick
+        self.poll_interval = 0.01
+        self.deliveries = WeightedQueue(self.queues)
+        self.completed = Queue.Queue()
+
+    def start(self):
+        for slot in range(self.size):
+            thread = threading.Thread(target=self._run, args=(slot,))
+            thread.daemon = True
+            thread.start()
+        for queue in sorted(self.queues):
+            # prefetch window applies to each consumer, a busy lane can't take the window of others
+            self.cm.channel.basic_qos(prefetch_count=self.prefetch_count)
+            self.cm.channel.basic_consume(functools.partial(self._on_message, queue), queue=queue)
+        connection = self.cm.channel.connection
+        next_tick = time.time() + self.tick_interval
+        while True:
+            connection.process_data_events(time_limit=self.poll_interval)
+            self._acknowledge()
+            if self.on_tick and time.time() >= next_tick:
+                next_tick = time.time() + self.tick_interval
+                self.on_tick()
+
+    def _on_message(self, queue, ch, method, properties, body):
+        self.deliveries.put(queue, (method.delivery_tag, properties, body))
+
+    def _acknowledge(self):
+        while True:
+            try:
+                delivery_tag = self.completed.get_nowait()
+            except Queue.Empty:
+                return
+            self.cm.channel.basic_ack(delivery_tag=delivery_tag)
+
+    def _run(self, slot):
+        while True:
+            queue, (delivery_tag, properties, body) = self.deliveries.get()
+            try:
+                self.handler(slot, properties, body)
+            except Exception as ex:
+                logger.exception(ex)
+            finally:
+                self.completed.put(delivery_tag)
+
+
+class Batch(object):
+    """tokens of deliveries with identical payloads and retry attempts, sent with a single request
+    """
+    def __init__(self, queue, payload, attempt, deadline):
+        self.queue = queue
+        self.payload = payload
+        self.attempt = attempt
+        self.deadline = deadline
+        self.tokens = []
+        self.delivery_tags = []
+
+
+class BatchingDeliveryPool(DeliveryPool):
+    """merge small deliveries of identical notifications before sending
+
+    a collector thread decodes deliveries and groups their tokens by queue, provider fields of payload
+    (see `PROVIDER_FIELDS`) and retry attempt, so transactional alerts of the same content to different
+    users are sent together; a batch is sent with the payload of its first delivery.
+    a batch is handed to sender threads when it reaches `batch_size` tokens or `max_wait` seconds after
+    its first delivery, batches of several queues are sent in proportion to the weights of queues.
+    deliveries are never split across batches, every delivery of a batch is acknowledged on its own
+    after the batch is sent.
+    """
+    def __init__(self, cm, queue, decoder, handler, size, prefetch_count=None, batch_size=1000, max_wait=0.05,
+                 tick_interval=60, on_tick=None):
+        """
+        :param pns.utils.PikaConnectionManager cm: RabbitMQ connection manager
+        :param queue: queue name to consume, or dict of queue names to weights
+        :param decoder: called as `decoder(properties, body)` on collector thread, returns `(tokens, payload)`
+            of a delivery, deliveries of `None` payloads are acknowledged without sending
+        :param handler: called as `handler(slot, tokens, payload, attempt)` on sender threads
+        :param int size: number of sender threads
+        :param int prefetch_count: number of unacknowledged deliveries per queue, defaults to `batch_size`
+        :param int batch_size: maximum number of tokens of a batch
+        :param float max_wait: maximum time a delivery waits for others to be merged with (in seconds)
+        :param float tick_interval: how often `on_tick` is called (in seconds)
+        :param on_tick: called periodically on consumer thread
+        """
+        DeliveryPool.__init__(self, cm, queue, handler, size, prefetch_count=prefetch_count or batch_size,
+                              tick_interval=tick_interval, on_tick=on_tick)
+        self.decoder = decoder
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.batches = WeightedQueue(self.queues)
+        # pending batches by payload, accessed only by collector thread
+        self.pending = {}
+        # number of sent batches and of deliveries merged into them with others
+        self.flushed = 0
+        self.merged = 0
+
+    def start(self):
+        thread = threading.Thread(target=self._collect)
+        thread.daemon = True
+        thread.start()
+        DeliveryPool.start(self)
+
+    def _collect(self):
+        while True:
+            timeout = self.max_wait
+            if self.pending:
+                timeout = max(min(batch.deadline for batch in self.pending.values()) - time.time(), 0)
+            try:
+                queue, (delivery_tag, properties, body) = self.deliveries.get(timeout=timeout)
+            except Queue.Empty:
+                pass
+            else:
+                self._add(queue, delivery_tag, properties, body)
+            now = time.time()
+            for key in [key for key, batch in self.pending.items() if batch.deadline <= now]:
+                self._flush(key)
+
+    def _add(self, queue, delivery_tag, properties, body):
+        try:
+            tokens, payload = self.decoder(properties, body)
+        except Exception as ex:
+            logger.exception(ex)
+            payload = None
+        if payload is None:
+            self.completed.put(delivery_tag)
+            return
+        attempt = get_attempt(properties)
+        key = (queue, attempt, get_merge_key(payload))
+        if key in self.pending and len(self.pending[key].tokens) + len(tokens) > self.batch_size:
+            self._flush(key)
+        if key not in self.pending:
+            self.pending[key] = Batch(queue, payload, attempt, time.time() + self.max_wait)
+        else:
+            self.merged += 1
+        batch = self.pending[key]
+        batch.tokens.extend(tokens)
+        batch.delivery_tags.append(delivery_tag)
+        if len(batch.tokens) >= self.batch_size:
+            self._flush(key)
+
+    def _flush(self, key):
+        self.flushed += 1
+        batch = self.pending.pop(key)
+        self.batches.put(batch.queue, batch)
+
+    def _run(self, slot):
+        while True:
+            queue, batch = self.batches.get()
+            try:
+                self.handler(slot, batch.tokens, batch.payload, batch.attempt)
+            except Exception as ex:
+                logger.exception(ex)
+            finally:
+                for delivery_tag in batch.delivery_tags:
+                    self.completed.put(delivery_tag)
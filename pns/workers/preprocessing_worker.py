@@ -1,11 +1,21 @@
 # -*- coding: utf-8 -*-
 
+import json
+import time
+import datetime
+import Queue
 import logging
-import pika
+import functools
+from sqlalchemy import func, select, or_
 from sqlalchemy.sql.expression import false
-from flask.json import loads, dumps
-from pns.utils import get_conf, get_logging_handler, PikaConnectionManager
-from pns.models import db, User, Device, Channel
+from pns.serializers import decode_message, MESSAGE_FORMATS
+from pns.utils import (get_conf, get_conf_value, get_logging_handler, get_stats_logger, chunked,
+                       PikaConnectionManager, ConfirmedPublisher)
+from pns.models import db, User, Device, Channel, Alert, ScheduledTask
+from pns.workers.audience import stream_by_platform, estimate_rows, AudienceCache, STREAM_ORM
+from pns.workers.chunks import encode_chunk, FORMAT_FULL
+from pns.workers.pool import WeightedQueue
+from pns.lanes import PRIORITIES, get_lane, get_lane_weights, get_priority
 
 
 conf = get_conf()
@@ -18,6 +28,7 @@ if conf.getboolean('application', 'debug'):
     logger.setLevel(logging.DEBUG)
 else:
     logger.setLevel(logging.WARNING)
+stats_logger = get_stats_logger(__name__)
 
 
 class PreProcessingWorker(object):
@@ -25,6 +36,23 @@ class PreProcessingWorker(object):
         self.GCM = "gcm"
         self.APNS = "apns"
         self.chunk_size = 1000
+        # `orm`, `cursor` (server-side cursor) or `copy` (COPY ... TO STDOUT)
+        self.stream_mode = get_conf_value(conf, 'application', 'audience_stream', STREAM_ORM)
+        # broadcasts of more devices are split into shards of about this many devices, resolved by several
+        # workers in parallel
+        self.shard_size = get_conf_value(conf, 'application', 'shard_size', 1000000, 'getint')
+        # audiences are counted before sharding only when planner estimates more than `shard_size` devices
+        # divided by this margin, estimates of semi-joins can be a few times off
+        self.shard_estimate_margin = 4
+        # paced alerts are published in slices of devices allowed by their `max_rate` in this many seconds
+        self.pace_interval = get_conf_value(conf, 'application', 'pace_interval', 5, 'getfloat')
+        # resolved channel audiences are cached in memory of the worker (in megabytes), 0 disables caching
+        cache_size = get_conf_value(conf, 'application', 'audience_cache_size', 0, 'getint')
+        self.audience_cache = AudienceCache(cache_size * 1048576) if cache_size > 0 else None
+        # `full` chunks carry the alert payload, `compact` chunks refer saved alerts by id and pack tokens
+        self.chunk_format = get_conf_value(conf, 'rabbitmq', 'chunk_format', FORMAT_FULL)
+        # `json` or `msgpack`, consumers decode messages of both formats
+        self.content_type = MESSAGE_FORMATS[get_conf_value(conf, 'rabbitmq', 'message_format', 'json')]
         # rabbitmq configuration
         self.cm = PikaConnectionManager(username=conf.get('rabbitmq', 'username'),
                                         password=conf.get('rabbitmq', 'password'),
@@ -32,14 +60,38 @@ class PreProcessingWorker(object):
                                         heartbeat_interval=conf.getint('rabbitmq', 'worker_heartbeat_interval'))
         self.cm.channel.exchange_declare(exchange='pns_exchange', type='direct', durable=True)
         self.cm.channel.exchange_declare(exchange='pns_exchange', type='direct', durable=True)
-        self.cm.channel.queue_declare(queue='pns_pre_processing_queue', durable=True)
-        self.cm.channel.queue_bind(exchange='pns_exchange', queue='pns_pre_processing_queue',
-                                   routing_key='pns_pre_processing')
-        self.cm.channel.basic_qos(prefetch_count=1)
-        self.cm.channel.basic_consume(self._callback, queue='pns_pre_processing_queue')
+        # deliveries of both priority lanes are buffered and handled one by one in proportion to lane weights
+        self.lanes = get_lane_weights(conf, 'pns_pre_processing_queue')
+        self.deliveries = WeightedQueue(self.lanes)
+        for priority in PRIORITIES:
+            queue = get_lane('pns_pre_processing_queue', priority)
+            self.cm.channel.queue_declare(queue=queue, durable=True)
+            self.cm.channel.queue_bind(exchange='pns_exchange', queue=queue,
+                                       routing_key=get_lane('pns_pre_processing', priority))
+            # prefetch window applies to each consumer, as many deliveries as lane weight are buffered
+            self.cm.channel.basic_qos(prefetch_count=self.lanes[queue])
+            self.cm.channel.basic_consume(functools.partial(self._on_message, queue), queue=queue)
+        # chunks are published asynchronously while next chunks are read from database
+        self.publisher = ConfirmedPublisher(self.cm.conn_params, 'pns_exchange',
+                                            max_in_flight=get_conf_value(conf, 'rabbitmq', 'publisher_max_in_flight',
+                                                                         1000, 'getint'))
+        self.published_messages = 0
+        self.published_tokens = 0
+        self.published_bytes = 0
 
     def start(self):
-        self.cm.channel.start_consuming()
+        self.publisher.start()
+        connection = self.cm.channel.connection
+        while True:
+            connection.process_data_events(time_limit=0 if self.deliveries.qsize() else 1)
+            try:
+                queue, (method, properties, body) = self.deliveries.get(timeout=0)
+            except Queue.Empty:
+                continue
+            self._callback(self.cm.channel, method, properties, body)
+
+    def _on_message(self, queue, ch, method, properties, body):
+        self.deliveries.put(queue, (method, properties, body))
 
     def _callback(self, ch, method, properties, body):
         """
@@ -51,8 +103,18 @@ class PreProcessingWorker(object):
         :param body:
         :return:
         """
-        message = loads(body)
+        message = decode_message(body, properties.content_type)
         logger.debug('message: %s' % message)
+        if 'alerts' in message:
+            # grouped task of batch endpoint
+            self.process_batch(message['alerts'])
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+        started_at = time.time()
+        self.published_messages = 0
+        self.published_tokens = 0
+        self.published_bytes = 0
+        failed = self.publisher.failed
         mobile_app_id = None
         mobile_app_ver = None
         pns_id_list = None
@@ -65,139 +127,316 @@ class PreProcessingWorker(object):
             pns_id_list = message['payload']['pns_id']
         if 'channel_id' in message and message['channel_id']:
             channel_id = message['channel_id']
-        if pns_id_list:
-            # filter by pns_id
-            if conf.getboolean('apns', 'enabled'):
-                for devices in self.get_user_devices(pns_id_list, self.APNS, mobile_app_id, mobile_app_ver):
-                    self.publish_apns(devices, message['payload'])
-            if conf.getboolean('gcm', 'enabled'):
-                for devices in self.get_user_devices(pns_id_list, self.GCM, mobile_app_id, mobile_app_ver):
-                    self.publish_gcm(devices, message['payload'])
-        if channel_id:
-            # filter by channel_id
-            if conf.getboolean('apns', 'enabled'):
-                for devices in self.get_channel_devices(channel_id, self.APNS, mobile_app_id, mobile_app_ver):
-                    self.publish_apns(devices, message['payload'])
-            if conf.getboolean('gcm', 'enabled'):
-                for devices in self.get_channel_devices(channel_id, self.GCM, mobile_app_id, mobile_app_ver):
-                    self.publish_gcm(devices, message['payload'])
-        if not pns_id_list and not channel_id and mobile_app_id and mobile_app_ver:
-            # filter by application id and min application version number
-            if conf.getboolean('apns', 'enabled'):
-                for devices in self.get_by_app_ver(self.APNS, mobile_app_id, mobile_app_ver):
-                    self.publish_apns(devices, message['payload'])
-            if conf.getboolean('gcm', 'enabled'):
-                for devices in self.get_by_app_ver(self.GCM, mobile_app_id, mobile_app_ver):
-                    self.publish_gcm(devices, message['payload'])
+        shard = message.get('shard')
+        platforms = [platform for platform in [self.APNS, self.GCM] if conf.getboolean(platform, 'enabled')]
+        if message['payload'].get('max_rate'):
+            # paced alerts are resolved slice by slice instead of shards
+            self.publish_slice(message, platforms, pns_id_list, channel_id, mobile_app_id, mobile_app_ver)
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+        device_id_range = (shard['min_id'], shard['max_id']) if shard else None
+        query = self.get_audience_query(platforms, pns_id_list, channel_id, mobile_app_id, mobile_app_ver,
+                                        device_id_range)
+        cache_key = None
+        if query is not None and self.audience_cache and channel_id and not pns_id_list:
+            audience_version = Channel.get_audience_version(channel_id)
+            if audience_version is not None:
+                cache_key = (channel_id, audience_version, tuple(platforms), mobile_app_id, mobile_app_ver,
+                             device_id_range)
+        if not shard and (channel_id or (not pns_id_list and mobile_app_id and mobile_app_ver)):
+            # large broadcasts are split into shards, published back to preprocessing queue as sub-tasks
+            shards = self.get_shards(query, self.audience_cache.count(cache_key) if cache_key else None)
+            if len(shards) > 1:
+                self.publish_shards(message, shards)
+                ch.basic_ack(delivery_tag=method.delivery_tag)
+                return
+        if query is not None:
+            chunks = self.audience_cache.get(cache_key, self.chunk_size) if cache_key else None
+            if chunks is None:
+                chunks = stream_by_platform(query, self.chunk_size, self.stream_mode)
+                if cache_key:
+                    chunks = self.audience_cache.capture(cache_key, chunks)
+            publish = {self.APNS: self.publish_apns, self.GCM: self.publish_gcm}
+            for platform, devices in chunks:
+                publish[platform](devices, message['payload'], message.get('id'))
+        # wait for broker confirmations before acknowledging the alert
+        self.publisher.flush()
+        elapsed = max(time.time() - started_at, 0.001)
+        if self.publisher.failed > failed:
+            logger.error('%d chunks of alert %s could not be delivered to rabbitmq server' %
+                         (self.publisher.failed - failed, message.get('id')))
+        name = message.get('id')
+        if shard:
+            name = '%s shard %d/%d' % (name, shard['index'] + 1, shard['total'])
+        stats_logger.info('alert %s: published %d chunks (%d tokens, %.1f MB) in %.2f seconds, %.0f chunks/s, '
+                          '%.0f tokens/s' % (name, self.published_messages, self.published_tokens,
+                                             self.published_bytes / 1048576.0, elapsed,
+                                             self.published_messages / elapsed, self.published_tokens / elapsed))
+        if self.audience_cache:
+            stats_logger.info(self.audience_cache)
+        if message.get('id'):
+            self.complete_shard(message['id'], shard['index'] if shard else 0)
         ch.basic_ack(delivery_tag=method.delivery_tag)
 
-    def get_user_devices(self, pns_id_list, platform, mobile_app_id, mobile_app_ver):
+    def process_batch(self, alerts):
         """
-        Yield registered devices of users
-        :param pns_id_list:
-        :param platform:
+        resolve recipients of all alerts of a batch task with a single query and publish tokens grouped
+        by distinct payloads, alerts differing only in `pns_id` share chunks
+        :param list alerts: dicts with `id` (None if alerts are not saved) and `payload` keys
         :return:
         """
-        device_list = []
-        device_list_query = (db
-                             .session
-                             .query(Device.platform_id)
-                             .join(User)
-                             .filter(User.pns_id.in_(pns_id_list))
-                             .filter(Device.platform == platform)
-                             .filter(Device.mute == false()))
-        if mobile_app_id and mobile_app_ver:
-            device_list_query = (device_list_query
-                                 .filter(Device.mobile_app_id == mobile_app_id)
-                                 .filter(Device.mobile_app_ver >= mobile_app_ver))
-        for device in device_list_query.yield_per(self.chunk_size):
-            device_list.append(device[0])
-            if len(device_list) % self.chunk_size == 0:
-                yield device_list
-                device_list = []
-        if len(device_list) % self.chunk_size > 0:
-            yield device_list
-
-    def get_channel_devices(self, channel_id, platform, mobile_app_id, mobile_app_ver):
-        """
-        Yield registered devices of channel
+        started_at = time.time()
+        self.published_messages = 0
+        self.published_tokens = 0
+        self.published_bytes = 0
+        failed = self.publisher.failed
+        platforms = [platform for platform in [self.APNS, self.GCM] if conf.getboolean(platform, 'enabled')]
+        pns_id_list = set()
+        for alert in alerts:
+            pns_id_list.update(alert['payload'].get('pns_id') or [])
+        rows = Device.get_devices_of_users(pns_id_list, platforms)
+        db.session.commit()
+        devices = {}
+        for pns_id, platform, platform_id, mobile_app_id, mobile_app_ver in rows:
+            devices.setdefault(pns_id, []).append((platform, platform_id, mobile_app_id, mobile_app_ver))
+        # payload without `pns_id` to (alert id, payload, platform to token list, seen tokens)
+        groups = {}
+        order = []
+        for alert in alerts:
+            payload = alert['payload']
+            key = json.dumps(dict(payload, pns_id=None), sort_keys=True)
+            if key not in groups:
+                groups[key] = (alert.get('id'), payload, {}, set())
+                order.append(key)
+            alert_id, _, tokens, seen = groups[key]
+            app_id = payload.get('appid')
+            app_ver = payload.get('appver')
+            for pns_id in payload.get('pns_id') or []:
+                for platform, platform_id, mobile_app_id, mobile_app_ver in devices.get(pns_id, []):
+                    if app_id and app_ver and (mobile_app_id != app_id or mobile_app_ver is None or
+                                               mobile_app_ver < app_ver):
+                        continue
+                    if platform_id not in seen:
+                        seen.add(platform_id)
+                        tokens.setdefault(platform, []).append(platform_id)
+        publish = {self.APNS: self.publish_apns, self.GCM: self.publish_gcm}
+        for key in order:
+            alert_id, payload, tokens, _ = groups[key]
+            for platform, platform_ids in tokens.items():
+                for chunk in chunked(platform_ids, self.chunk_size):
+                    publish[platform](chunk, payload, alert_id)
+        self.publisher.flush()
+        elapsed = max(time.time() - started_at, 0.001)
+        if self.publisher.failed > failed:
+            logger.error('%d chunks of a batch of %d alerts could not be delivered to rabbitmq server' %
+                         (self.publisher.failed - failed, len(alerts)))
+        stats_logger.info('batch of %d alerts (%d distinct payloads): published %d chunks (%d tokens) in %.2f '
+                          'seconds, %.0f alerts/s' % (len(alerts), len(order), self.published_messages,
+                                                      self.published_tokens, elapsed, len(alerts) / elapsed))
+        alert_ids = [alert['id'] for alert in alerts if alert.get('id')]
+        if alert_ids:
+            try:
+                Alert.complete_alerts(alert_ids)
+                db.session.commit()
+            except Exception as ex:
+                db.session.rollback()
+                logger.exception(ex)
+
+    def get_shards(self, query, audience_size=None):
+        """
+        split device id range of the audience into as many ranges as shards of `shard_size` devices it
+        needs, audiences of up to `shard_size` devices are not sharded. devices of the audience are
+        counted only when its cached size or the estimate of query planner may exceed `shard_size`
+        :param query: audience query
+        :param int audience_size: number of devices of the audience if it is cached
+        :return: list of (min_id, max_id) tuples
+        """
+        if self.shard_size <= 0 or query is None:
+            return []
+        if audience_size is not None:
+            if audience_size <= self.shard_size:
+                return []
+        elif estimate_rows(query) * self.shard_estimate_margin <= self.shard_size:
+            return []
+        min_id, max_id, total = query.with_entities(func.min(Device.id), func.max(Device.id),
+                                                    func.count(Device.id)).first()
+        db.session.commit()
+        if total <= self.shard_size:
+            return []
+        # ranges of equal width, assuming ids of the audience are spread evenly over its range
+        shards_total = -(-total // self.shard_size)
+        width = -(-(max_id - min_id + 1) // shards_total)
+        return [(lo, min(lo + width - 1, max_id)) for lo in range(min_id, max_id + 1, width)]
+
+    def publish_shards(self, message, shards):
+        """
+        publish shards of an alert to preprocessing queue. shards are not published unless number of
+        shards is saved, an error leaves the alert unacknowledged to be redelivered
+        :param message: alert message
+        :param shards: list of (min_id, max_id) tuples
+        :return:
+        """
+        if message.get('id'):
+            # shards published without `shards_total` would never complete the alert
+            try:
+                Alert.start_shards(message['id'], len(shards))
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+        for index, (min_id, max_id) in enumerate(shards):
+            sub_task = dict(message, shard={'index': index, 'total': len(shards), 'min_id': min_id, 'max_id': max_id})
+            self.publisher.publish_message(get_lane('pns_pre_processing', get_priority(message['payload'])),
+                                           sub_task, self.content_type)
+        self.publisher.flush()
+        logger.info('alert %s: split into %d shards of about %d devices' % (message.get('id'), len(shards),
+                                                                            self.shard_size))
+
+    def publish_slice(self, message, platforms, pns_id_list, channel_id, mobile_app_id, mobile_app_ver):
+        """
+        publish the next slice of a paced alert. a slice holds as many devices as `max_rate` allows in
+        `pace_interval` seconds, in device id order. the task of the following slice continues after the
+        last device of this one and is saved for scheduler worker before the slice is published, so paced
+        alerts survive worker restarts; a redelivered task republishes its slice but schedules nothing twice.
+        :param message: alert message, continuations have `after_id` and `slice_at` (planned release time)
+        :param platforms: enabled platforms
+        :param pns_id_list:
         :param channel_id:
-        :param platform:
+        :param mobile_app_id:
+        :param mobile_app_ver:
         :return:
         """
-        device_list = []
-        device_list_query = (Channel
-                             .query
-                             .get(channel_id)
-                             .devices
-                             .filter(Device.platform == platform)
-                             .filter(Device.mute == false()))
-        if mobile_app_id and mobile_app_ver:
-            device_list_query = (device_list_query
-                                 .filter(Device.mobile_app_id == mobile_app_id)
-                                 .filter(Device.mobile_app_ver >= mobile_app_ver))
-        for device in device_list_query.with_entities(Device.platform_id).yield_per(self.chunk_size):
-            device_list.append(device[0])
-            if len(device_list) % self.chunk_size == 0:
-                yield device_list
-                device_list = []
-        if len(device_list) % self.chunk_size > 0:
-            yield device_list
-
-    def get_by_app_ver(self, platform, mobile_app_id, mobile_app_ver):
-        """
-        Yield registered devices by filtering application id and min version number
-        :param platform:
+        started_at = time.time()
+        failed = self.publisher.failed
+        payload = message['payload']
+        max_rate = payload['max_rate']
+        slice_size = max(int(max_rate * self.pace_interval), 1)
+        rows = []
+        query = self.get_audience_query(platforms, pns_id_list, channel_id, mobile_app_id, mobile_app_ver)
+        if query is not None:
+            rows = (query
+                    .add_columns(Device.id)
+                    .filter(Device.id > message.get('after_id', 0))
+                    .order_by(Device.id)
+                    .limit(slice_size)
+                    .all())
+        db.session.commit()
+        if len(rows) == slice_size:
+            # slices released late (e.g. while workers were down) are not caught up with bursts
+            slice_at = message.get('slice_at', started_at)
+            if started_at - slice_at > self.pace_interval:
+                slice_at = started_at
+            slice_at += float(len(rows)) / max_rate
+            after_id = rows[-1][2]
+            pace_id = message.get('pace_id') or message.get('id')
+            ScheduledTask.schedule(dict(message, after_id=after_id, slice_at=slice_at),
+                                   datetime.datetime.fromtimestamp(slice_at), get_priority(payload),
+                                   key='%s:%d' % (pace_id, after_id) if pace_id else None)
+            db.session.commit()
+        devices = {}
+        for platform, platform_id, _ in rows:
+            devices.setdefault(platform, []).append(platform_id)
+        publish = {self.APNS: self.publish_apns, self.GCM: self.publish_gcm}
+        for platform, platform_ids in devices.items():
+            for chunk in chunked(platform_ids, self.chunk_size):
+                publish[platform](chunk, payload, message.get('id'))
+        self.publisher.flush()
+        if self.publisher.failed > failed:
+            logger.error('%d chunks of alert %s could not be delivered to rabbitmq server' %
+                         (self.publisher.failed - failed, message.get('id')))
+        stats_logger.info('alert %s: published slice of %d tokens after device %d in %.2f seconds, max rate %d '
+                          'devices/s' % (message.get('id'), len(rows), message.get('after_id', 0),
+                                         time.time() - started_at, max_rate))
+        if len(rows) < slice_size and message.get('id'):
+            self.complete_shard(message['id'], 0)
+
+    def complete_shard(self, alert_id, index):
+        """
+        mark shard (or whole alert if it is not sharded) completed
+        :param alert_id:
+        :param index:
+        :return:
+        """
+        try:
+            result = Alert.complete_shard(alert_id, index)
+            db.session.commit()
+        except Exception as ex:
+            db.session.rollback()
+            logger.exception(ex)
+            return
+        if result and result[0] >= result[1]:
+            logger.info('alert %s: completed' % alert_id)
+
+    def get_audience_query(self, platforms, pns_id_list, channel_id, mobile_app_id, mobile_app_ver,
+                           device_id_range=None):
+        """
+        Build a single query of (platform, platform_id) for all platforms. Devices of users in `pns_id_list`
+        and devices of the channel are combined with semi-joins, so a device in both sources is selected once.
+        Without `pns_id_list` and `channel_id`, devices are filtered by application id and min version number.
+        :param platforms: enabled platforms
+        :param pns_id_list:
+        :param channel_id:
         :param mobile_app_id:
         :param mobile_app_ver:
+        :param device_id_range: (min_id, max_id) of shard
+        :return: query or None if alert has no audience
+        """
+        sources = []
+        if pns_id_list:
+            sources.append(Device.user_id.in_(select([User.id]).where(User.pns_id.in_(pns_id_list))))
+        if channel_id:
+            sources.append(Channel.get_audience_filter(channel_id))
+        if not platforms or not (sources or (mobile_app_id and mobile_app_ver)):
+            return None
+        query = (db
+                 .session
+                 .query(Device.platform, Device.platform_id)
+                 .filter(Device.platform.in_(platforms))
+                 .filter(Device.mute == false()))
+        if sources:
+            query = query.filter(or_(*sources))
+        if mobile_app_id and mobile_app_ver:
+            query = (query
+                     .filter(Device.mobile_app_id == mobile_app_id)
+                     .filter(Device.mobile_app_ver >= mobile_app_ver))
+        if device_id_range:
+            query = query.filter(Device.id.between(*device_id_range))
+        return query
+
+    def publish_chunk(self, routing_key, devices, payload, alert_id=None):
+        """
+        publish token list and message payload (or reference of saved alert) to a sender worker
+        :param routing_key:
+        :param devices:
+        :param payload:
+        :param alert_id:
         :return:
         """
-        device_list = []
-        device_list_query = (db
-                             .session
-                             .query(Device.platform_id)
-                             .join(User)
-                             .filter(Device.platform == platform)
-                             .filter(Device.mute == false())
-                             .filter(Device.mobile_app_id == mobile_app_id)
-                             .filter(Device.mobile_app_ver >= mobile_app_ver))
-        for device in device_list_query.yield_per(self.chunk_size):
-            device_list.append(device[0])
-            if len(device_list) % self.chunk_size == 0:
-                yield device_list
-                device_list = []
-        if len(device_list) % self.chunk_size > 0:
-            yield device_list
-
-    def publish_gcm(self, gcm_devices, payload):
-        """
-        publish gcm token list and message payload to gcm worker
+        size = self.publisher.publish_message(routing_key, encode_chunk(devices, payload, alert_id, self.chunk_format),
+                                              self.content_type)
+        self.published_messages += 1
+        self.published_tokens += len(devices)
+        self.published_bytes += size
+
+    def publish_gcm(self, gcm_devices, payload, alert_id=None):
+        """
+        publish gcm token list and message payload to gcm worker, on the priority lane of alert
         :param gcm_devices:
         :param payload:
+        :param alert_id:
         :return:
         """
-        self.cm.basic_publish(exchange='pns_exchange',
-                              routing_key='pns_gcm',
-                              body=dumps({'devices': gcm_devices, 'payload': payload}, ensure_ascii=False),
-                              mandatory=True,
-                              properties=pika.BasicProperties(
-                                  delivery_mode=2,  # make message persistent
-                                  content_type='application/json'))
+        self.publish_chunk(get_lane('pns_gcm', get_priority(payload)), gcm_devices, payload, alert_id)
 
-    def publish_apns(self, apns_devices, payload):
+    def publish_apns(self, apns_devices, payload, alert_id=None):
         """
-        publish apns token list and message payload to apns worker
+        publish apns token list and message payload to apns worker, on the priority lane of alert
         :param apns_devices:
         :param payload:
+        :param alert_id:
         :return:
         """
-        self.cm.basic_publish(exchange='pns_exchange',
-                              routing_key='pns_apns',
-                              body=dumps({'devices': apns_devices, 'payload': payload}, ensure_ascii=False),
-                              mandatory=True,
-                              properties=pika.BasicProperties(
-                                  delivery_mode=2,  # make message persistent
-                                  content_type='application/json'))
+        self.publish_chunk(get_lane('pns_apns', get_priority(payload)), apns_devices, payload, alert_id)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+import pika
+from pns.serializers import encode_message, JSON
+from pns.utils import chunked
+from pns.workers.chunks import encode_chunk
+
+
+# message header counting how many times tokens of a chunk were retried
+ATTEMPT_HEADER = 'x-pns-attempt'
+# delays of retry attempts (in seconds), last one is repeated up to `max_attempts`
+DEFAULT_DELAYS = [5, 30, 120, 600, 1800]
+# maximum number of tokens of a republished chunk
+CHUNK_SIZE = 1000
+
+
+def get_attempt(properties):
+    """
+    :param pika.BasicProperties properties: properties of a delivery
+    :return: number of retries the delivery already had
+    """
+    return int((properties.headers or {}).get(ATTEMPT_HEADER, 0))
+
+
+def parse_delays(value):
+    """
+    :param str value: comma separated delays (in seconds)
+    :return: list of delays
+    """
+    return [int(delay) for delay in value.split(',') if delay.strip()]
+
+
+class RetryQueues(object):
+    """delayed retries of a sender queue through tiered delay queues
+
+    every delay has a queue with a message TTL; expired messages are dead-lettered to `pns_exchange`
+    with the routing key of the sender queue, so they are consumed again after the delay without
+    keeping any consumer busy. tokens failed more than `max_attempts` times are parked in a queue
+    which is not consumed, to be inspected (or moved back) by operators.
+    """
+    def __init__(self, routing_key, publisher, delays=None, max_attempts=None, content_type=JSON):
+        """
+        :param str routing_key: routing key of sender queue (`pns_gcm` or `pns_apns`)
+        :param pns.utils.ConfirmedPublisher publisher: publisher to `pns_exchange`
+        :param list delays: delay of every attempt (in seconds)
+        :param int max_attempts: number of retries before parking, defaults to number of delays
+        :param str content_type: content type of republished chunks
+        """
+        self.routing_key = routing_key
+        self.publisher = publisher
+        self.delays = delays or DEFAULT_DELAYS
+        self.max_attempts = max_attempts or len(self.delays)
+        self.content_type = content_type
+        self.parking_queue = '%s_parking' % routing_key
+        self.scheduled = 0
+        self.parked = 0
+
+    def get_delay_queue(self, delay):
+        return '%s_retry_%ds' % (self.routing_key, delay)
+
+    def declare(self, channel):
+        """
+        declare and bind delay queues and parking queue
+        :param channel: pika channel
+        """
+        for delay in sorted(set(self.delays)):
+            queue = self.get_delay_queue(delay)
+            channel.queue_declare(queue=queue, durable=True,
+                                  arguments={'x-message-ttl': delay * 1000,
+                                             'x-dead-letter-exchange': 'pns_exchange',
+                                             'x-dead-letter-routing-key': self.routing_key})
+            channel.queue_bind(exchange='pns_exchange', queue=queue, routing_key=queue)
+        channel.queue_declare(queue=self.parking_queue, durable=True)
+        channel.queue_bind(exchange='pns_exchange', queue=self.parking_queue, routing_key=self.parking_queue)
+
+    def schedule(self, tokens, payload, attempt):
+        """
+        republish failed tokens to the delay queue of their next attempt, or to parking queue after
+        `max_attempts` retries, and wait until broker confirms them
+        :param list tokens: failed tokens
+        :param dict payload: alert payload
+        :param int attempt: number of retries tokens already had
+        :return: routing key tokens are published to
+        """
+        if not tokens:
+            return None
+        attempt += 1
+        if attempt > self.max_attempts:
+            routing_key = self.parking_queue
+            self.parked += len(tokens)
+        else:
+            routing_key = self.get_delay_queue(self.delays[min(attempt, len(self.delays)) - 1])
+            self.scheduled += len(tokens)
+        for chunk in chunked(tokens, CHUNK_SIZE):
+            # payload travels with retried tokens, alert might be deleted meanwhile
+            self.publisher.publish(routing_key,
+                                   encode_message(encode_chunk(chunk, payload), self.content_type),
+                                   properties=pika.BasicProperties(
+                                       delivery_mode=2,  # make message persistent
+                                       content_type=self.content_type,
+                                       headers={ATTEMPT_HEADER: attempt}))
+        self.publisher.flush()
+        return routing_key
+
+    def __str__(self):
+        return '%s retries: %d tokens scheduled, %d tokens parked' % (self.routing_key, self.scheduled, self.parked)
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+import datetime
+from pns.serializers import MESSAGE_FORMATS
+from pns.utils import get_conf, get_conf_value, get_logging_handler, get_connection_parameters, ConfirmedPublisher
+from pns.models import db, ScheduledTask
+from pns.lanes import get_lane
+
+
+conf = get_conf()
+
+# configure logger
+logging.captureWarnings(True)
+logger = logging.getLogger(__name__)
+logger.addHandler(get_logging_handler())
+if conf.getboolean('application', 'debug'):
+    logger.setLevel(logging.DEBUG)
+else:
+    logger.setLevel(logging.WARNING)
+
+
+class SchedulerWorker(object):
+    """
+    release scheduled alerts and slices of paced alerts to preprocessing queues on time. due tasks are
+    locked with `SKIP LOCKED` and every task is marked released once broker confirms it, so several
+    schedulers can run side by side and tasks are released at least once across restarts. released
+    tasks are purged after `scheduler_retention` days.
+    """
+    def __init__(self):
+        # how often due tasks are looked for (in seconds)
+        self.poll_interval = get_conf_value(conf, 'application', 'scheduler_poll_interval', 1, 'getfloat')
+        self.batch_size = 100
+        # released tasks are kept this many days, continuations of slices redelivered meanwhile are rejected
+        self.retention = get_conf_value(conf, 'application', 'scheduler_retention', 7, 'getint')
+        self.purge_interval = 3600
+        self.purged_at = 0
+        # `json` or `msgpack`, preprocessing workers decode messages of both formats
+        self.content_type = MESSAGE_FORMATS[get_conf_value(conf, 'rabbitmq', 'message_format', 'json')]
+        conn_params = get_connection_parameters(username=conf.get('rabbitmq', 'username'),
+                                                password=conf.get('rabbitmq', 'password'),
+                                                host=conf.get('rabbitmq', 'host'),
+                                                heartbeat_interval=conf.getint('rabbitmq',
+                                                                               'worker_heartbeat_interval'))
+        self.publisher = ConfirmedPublisher(conn_params, 'pns_exchange')
+        self.released = 0
+
+    def start(self):
+        self.publisher.start()
+        while True:
+            try:
+                released = self.release_due()
+                if time.time() - self.purged_at > self.purge_interval:
+                    self.purge()
+            except Exception as ex:
+                db.session.rollback()
+                logger.exception(ex)
+                released = 0
+            # a full batch means more tasks may be due already
+            if released < self.batch_size:
+                time.sleep(self.poll_interval)
+
+    def release_due(self):
+        """
+        publish a batch of due tasks to preprocessing queues of their priority lanes
+        :return: number of released tasks, tasks which could not be delivered are not counted
+        """
+        tasks = ScheduledTask.lock_due(self.batch_size)
+        if not tasks:
+            db.session.commit()
+            return 0
+        released = []
+        for task_id, priority, message in tasks:
+            # every task waits for its own confirmation, a rejected task does not release others again
+            failed = self.publisher.failed
+            self.publisher.publish_message(get_lane('pns_pre_processing', priority), message, self.content_type)
+            self.publisher.flush()
+            if self.publisher.failed > failed:
+                # task is unlocked on commit and released again by the next poll
+                logger.error('scheduled task %d could not be delivered to rabbitmq server' % task_id)
+                continue
+            released.append(task_id)
+        ScheduledTask.release(released)
+        db.session.commit()
+        self.released += len(released)
+        logger.info('released %d scheduled tasks, %d in total' % (len(released), self.released))
+        return len(released)
+
+    def purge(self):
+        """
+        delete tasks released more than `retention` days ago
+        """
+        deleted = ScheduledTask.purge(datetime.datetime.now() - datetime.timedelta(days=self.retention))
+        db.session.commit()
+        self.purged_at = time.time()
+        if deleted:
+            logger.info('purged %d released tasks' % deleted)
+
+
+if __name__ == '__main__':
+    logger.info('starting SchedulerWorker')
+    SchedulerWorker().start()
@@ -13,7 +13,7 @@ def read(filename):
 
 setup(
     name='pns',
-    version='3.4.2',
+    version='3.5.0',
     author='Alper IPEK',
     author_email='3denizotesi@gmail.com',
     url='https://github.com/Turksat/pns',
@@ -23,8 +23,10 @@ setup(
     license="Apache 2.0",
     keywords='gcm apns push notification service',
     install_requires=['Flask==0.10.1', 'Flask-SQLAlchemy==2.1', 'Flask-WTF==0.12',
-                      'pika==0.10.0', 'psycopg2==2.6.1', 'python-gcm==0.3', 'apns-clerk==0.2.0',
+                      'pika==0.10.0', 'psycopg2==2.6.1', 'requests==2.8.1', 'apns-clerk==0.2.0',
                       'alembic==0.8.3'],
+    extras_require={'http2': ['hyper==0.7.0', 'PyJWT==1.4.2'],
+                    'speedups': ['ujson==1.35', 'msgpack-python==0.4.6']},
     classifiers=['Development Status :: 2 - Pre-Alpha',
                  'Intended Audience :: Developers',
                  'License :: OSI Approved :: Apache Software License',